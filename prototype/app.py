@@ -0,0 +1,217 @@
+"""
+Single entry point for the map editor
+
+Only Qt and this file are loaded before the first frame. Each tool lives in
+its own prototype, imported and built the first time its tab is opened;
+exporters and dialogs are imported when their action is triggered.
+
+    python app.py --startup-report
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import importlib
+import json
+import sys
+
+from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout
+from PyQt6.QtCore import Qt, QObject, QEvent, QTimer, QThread, pyqtSignal
+from PyQt6.QtGui import QAction
+
+
+def load_prototype(name):
+    # Imported here so that even the loader waits until a tool is needed
+    from prototype_loader import load_prototype
+    return load_prototype(name)
+
+
+def embed(window):
+    """Use a prototype's main window as a tab page"""
+    window.setWindowFlags(Qt.WindowType.Widget)
+    return window
+
+
+# Tab title and the function building its page, in display order
+TOOLS = {
+    "Figures": lambda: embed(importlib.import_module("complex_editable").MainWindow()),
+    "Drawing": lambda: embed(load_prototype("vector-zooming-efficient-memory").DrawingWindow()),
+    "Freehand": lambda: embed(importlib.import_module("keep_same_width").MainWindow()),
+    # Same map view as graduation2, with the scale measured on the ground
+    "Map": lambda: embed(importlib.import_module("measurement").MainWindow()),
+    "Labels": lambda: embed(importlib.import_module("label_placement").MainWindow()),
+}
+
+
+class StartupTimer(QObject):
+    """Notes when the main window paints for the first time"""
+
+    def __init__(self, window, on_first_frame):
+        super().__init__(window)
+        self.on_first_frame = on_first_frame
+        window.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint:
+            obj.removeEventFilter(self)
+            # Let the paint finish before reading the clock
+            QTimer.singleShot(0, self.on_first_frame)
+        return False
+
+
+class TileExportThread(QThread):
+    """
+    Runs the tile exporter away from the GUI thread
+
+    The exporter waits on its process pool until every tile is written,
+    which would otherwise freeze the window for the whole export.
+    """
+
+    progress = pyqtSignal(int, int)
+    finished_export = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, map_path, output, parent=None):
+        super().__init__(parent)
+        self.map_path = map_path
+        self.output = output
+
+    def run(self):
+        try:
+            tile_export = importlib.import_module("tile_export")
+            document = importlib.import_module("map_document").load_map(self.map_path)
+            boxes = [shape.bbox() for shape in document.strokes + document.figures]
+            if not boxes:
+                self.finished_export.emit(0)
+                return
+            left, top = min(b[0] for b in boxes), min(b[1] for b in boxes)
+            region = (left, top, max(b[2] for b in boxes) - left, max(b[3] for b in boxes) - top)
+            # Workers load their own copy
+            del document, boxes
+            written = tile_export.export_tiles(self.map_path, self.output, region, 0, 2,
+                                               progress=self.progress.emit)
+        except Exception as error:
+            # Shown in the status bar, a thread's exception would go unnoticed
+            self.failed.emit(str(error))
+            return
+        self.finished_export.emit(written)
+
+
+class MainWindow(QMainWindow):
+    def __init__(self, first_tool):
+        super().__init__()
+        self.setWindowTitle("Map Creator")
+        self.setGeometry(100, 100, 1100, 800)
+        self.timings = {}
+        self.export_thread = None
+
+        # Every tab starts as an empty page, filled when first shown
+        self.tabs = QTabWidget()
+        self.pages = {}
+        for name in TOOLS:
+            page = QWidget()
+            QVBoxLayout(page).setContentsMargins(0, 0, 0, 0)
+            self.tabs.addTab(page, name)
+            self.pages[name] = page
+        self.built = set()
+        self.tabs.currentChanged.connect(self.build_current)
+        self.setCentralWidget(self.tabs)
+        self.tabs.setCurrentIndex(list(TOOLS).index(first_tool))
+        self.build_current()
+
+        self.init_menu()
+
+    def build_current(self):
+        name = self.tabs.tabText(self.tabs.currentIndex())
+        if name in self.built:
+            return
+        start = time.perf_counter()
+        self.pages[name].layout().addWidget(TOOLS[name]())
+        self.built.add(name)
+        self.timings[f"build {name}"] = time.perf_counter() - start
+
+    def init_menu(self):
+        menu = self.menuBar().addMenu("File")
+        self.export_action = QAction("Export tiles...", self)
+        self.export_action.triggered.connect(self.export_tiles)
+        menu.addAction(self.export_action)
+
+        color_action = QAction("Color...", self)
+        color_action.triggered.connect(self.choose_color)
+        self.menuBar().addMenu("Edit").addAction(color_action)
+
+    def current_tool(self):
+        page = self.tabs.currentWidget()
+        return page.layout().itemAt(0).widget() if page.layout().count() else None
+
+    def export_tiles(self):
+        """Export a map document with the tile exporter, imported on demand, in the background"""
+        from PyQt6.QtWidgets import QFileDialog
+        map_path, _ = QFileDialog.getOpenFileName(self, "Map document", "", "Map (*.json)")
+        if not map_path:
+            return
+        output = QFileDialog.getExistingDirectory(self, "Tile directory")
+        if not output:
+            return
+        # One export at a time, the action comes back when it is over
+        self.export_action.setEnabled(False)
+        self.statusBar().showMessage("Exporting tiles...")
+        self.export_thread = TileExportThread(map_path, output, self)
+        self.export_thread.progress.connect(self.show_export_progress)
+        self.export_thread.finished_export.connect(
+            lambda written: self.end_export(f"{written} tiles written"))
+        self.export_thread.failed.connect(
+            lambda error: self.end_export(f"Tile export failed: {error}"))
+        self.export_thread.start()
+
+    def show_export_progress(self, done, total):
+        self.statusBar().showMessage(f"Exporting tiles: {done} / {total}")
+
+    def end_export(self, message):
+        self.statusBar().showMessage(message)
+        self.export_action.setEnabled(True)
+        self.export_thread.wait()
+        self.export_thread = None
+
+    def choose_color(self):
+        from PyQt6.QtWidgets import QColorDialog
+        color = QColorDialog.getColor()
+        tool = self.current_tool()
+        # Only the vector drawing tool has a current colour so far
+        if color.isValid() and tool is not None and hasattr(tool, "canvas"):
+            tool.canvas.current_color = color
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Map Creator")
+    parser.add_argument("--open", choices=list(TOOLS), default="Figures",
+                        help="Tool shown at startup")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="Print startup timings as JSON once the first frame is shown")
+    parser.add_argument("--exit-after-first-frame", action="store_true",
+                        help="Quit right after the report, to measure startup in scripts")
+    args = parser.parse_args()
+
+    report = {"imports": time.perf_counter() - STARTED}
+    app = QApplication(sys.argv)
+    report["qapplication"] = time.perf_counter() - STARTED
+    window = MainWindow(args.open)
+    report["main_window"] = time.perf_counter() - STARTED
+
+    def first_frame():
+        report["first_frame"] = time.perf_counter() - STARTED
+        report.update(window.timings)
+        report["modules"] = len(sys.modules)
+        if args.startup_report:
+            print(json.dumps(report, indent=2))
+        if args.exit_after_first_frame:
+            app.quit()
+
+    StartupTimer(window, first_frame)
+    window.show()
+    sys.exit(app.exec())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Rendering benchmarks on synthetic maps
+
+Builds maps of configurable size, replays scripted zoom, pan, draw and edit
+sessions against the drawing prototypes through real Qt events, and prints
+per-frame latency percentiles and peak memory as JSON.
+
+Each target runs in a process of its own, so that its peak RSS is its own.
+Frames are timed with tracemalloc off, since tracing every allocation slows
+Python down several times; the peak of Python allocations comes from a
+second, traced run of the same seeded session.
+
+    python bench_render.py --strokes 20000 --figures 500 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import Qt, QPoint, QPointF, QEvent
+from PyQt6.QtGui import QColor
+
+from event_replay import send_mouse, send_wheel
+from prototype_loader import load_prototype
+import keep_same_width
+import complex_editable
+from label_placement import LabelLayerItem
+from map_document import map_elements
+
+vector_zooming = load_prototype("vector-zooming-efficient-memory")
+
+VIEW_SIZE = (1024, 768)
+
+
+def show_view(view):
+    """Show a view and let it be exposed, otherwise repaint() draws nothing"""
+    view.resize(*VIEW_SIZE)
+    view.show()
+    QApplication.processEvents()
+
+
+def percentiles(samples):
+    """Latency summary in milliseconds"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": ordered[-1] * 1000,
+    }
+
+
+class Recorder:
+    """Per-frame timings, grouped by the kind of step that produced the frame"""
+
+    def __init__(self, view):
+        self.view = view
+        self.samples = {}
+
+    def frame(self, kind, action):
+        """Run one step and repaint synchronously, timing both"""
+        start = time.perf_counter()
+        action()
+        self.view.viewport().repaint()
+        self.samples.setdefault(kind, []).append(time.perf_counter() - start)
+
+    def report(self):
+        return {kind: percentiles(samples) for kind, samples in self.samples.items()}
+
+
+def random_elements(rng, count, extent):
+    elements = []
+    for i in range(count):
+        coordinates = [map_elements.Coordinates(rng.uniform(0, extent), rng.uniform(0, extent))]
+        if i % 10 == 0:
+            altitude = map_elements.Altitude(max_height=rng.uniform(200, 8800))
+            elements.append(map_elements.Mountain(f"Mount {i}", coordinates, altitude))
+        else:
+            elements.append(map_elements.City(f"City {i}", coordinates,
+                                              population=rng.randint(100, 5000000)))
+    return elements
+
+
+def random_polyline(rng, vertices, extent, step=20.0):
+    x, y = rng.uniform(0, extent), rng.uniform(0, extent)
+    points = [QPointF(x, y)]
+    for _ in range(vertices - 1):
+        x += rng.uniform(-step, step)
+        y += rng.uniform(-step, step)
+        points.append(QPointF(x, y))
+    return points
+
+
+def zoom_pan_session(recorder, view, rng, frames, modifiers=Qt.KeyboardModifier.NoModifier):
+    centre = QPoint(VIEW_SIZE[0] // 2, VIEW_SIZE[1] // 2)
+    for i in range(frames):
+        delta = 120 if (i // 5) % 2 == 0 else -120
+        pos = centre + QPoint(rng.randint(-200, 200), rng.randint(-150, 150))
+        recorder.frame("zoom", lambda: send_wheel(view, pos, delta, modifiers))
+    for i in range(frames):
+        dx, dy = rng.randint(-40, 40), rng.randint(-40, 40)
+        recorder.frame("pan", lambda: (
+            view.horizontalScrollBar().setValue(view.horizontalScrollBar().value() + dx),
+            view.verticalScrollBar().setValue(view.verticalScrollBar().value() + dy)))
+
+
+def bench_canvas(args, rng):
+    """DrawingCanvas: one VectorLine per segment, re-rendered after every zoom"""
+    canvas = vector_zooming.DrawingCanvas()
+    show_view(canvas)
+    for _ in range(args.strokes):
+        points = random_polyline(rng, 2, args.extent)
+        canvas.vector_lines.append(vector_zooming.VectorLine(points[0], points[1],
+                                                             QColor(Qt.GlobalColor.black)))
+    recorder = Recorder(canvas)
+    recorder.frame("render_lines", canvas.render_lines)
+    zoom_pan_session(recorder, canvas, rng, args.frames)
+    for _ in range(args.frames):
+        start = QPoint(rng.randint(0, VIEW_SIZE[0]), rng.randint(0, VIEW_SIZE[1]))
+        end = start + QPoint(rng.randint(-100, 100), rng.randint(-100, 100))
+        recorder.frame("draw", lambda: (
+            send_mouse(canvas, QEvent.Type.MouseButtonPress, start),
+            send_mouse(canvas, QEvent.Type.MouseMove, end),
+            send_mouse(canvas, QEvent.Type.MouseButtonRelease, end)))
+    canvas.close()
+    return recorder.report()
+
+
+def bench_view(args, rng):
+    """DrawingView: freehand polylines whose width is kept constant on screen"""
+    view = keep_same_width.DrawingView()
+    show_view(view)
+    for _ in range(args.strokes // args.vertices + 1):
+        view.vector_lines.append(keep_same_width.VectorLine(
+            random_polyline(rng, args.vertices, args.extent), width=2))
+    recorder = Recorder(view)
+    recorder.frame("redraw_lines", view.redraw_lines)
+    zoom_pan_session(recorder, view, rng, args.frames)
+    for _ in range(max(1, args.frames // 5)):
+        pos = QPoint(rng.randint(100, VIEW_SIZE[0] - 100), rng.randint(100, VIEW_SIZE[1] - 100))
+        recorder.frame("draw", lambda: send_mouse(view, QEvent.Type.MouseButtonPress, pos))
+        for _ in range(5):
+            pos = pos + QPoint(rng.randint(-10, 10), rng.randint(-10, 10))
+            recorder.frame("draw", lambda: send_mouse(view, QEvent.Type.MouseMove, pos))
+        recorder.frame("draw", lambda: send_mouse(view, QEvent.Type.MouseButtonRelease, pos))
+    view.close()
+    return recorder.report()
+
+
+def bench_scene(args, rng):
+    """DrawingScene: editable figures with control points, plus map labels"""
+    scene = complex_editable.DrawingScene()
+    scene.setSceneRect(0, 0, args.extent, args.extent)
+    view = complex_editable.ZoomableView(scene)
+    show_view(view)
+
+    figures = []
+    for _ in range(args.figures):
+        figure = complex_editable.FigureGraphicsItem()
+        scene.addItem(figure)
+        for point in random_polyline(rng, args.vertices, args.extent):
+            figure.add_point(point)
+        figures.append(figure)
+    scene.addItem(LabelLayerItem(random_elements(rng, args.elements, args.extent)))
+
+    recorder = Recorder(view)
+    view.fitInView(scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
+    zoom_pan_session(recorder, view, rng, args.frames, Qt.KeyboardModifier.ControlModifier)
+
+    # Hot paths called directly, without the cost of the event machinery
+    hot = {"update_path": [], "find_closest_segment": []}
+    for _ in range(args.frames):
+        figure = rng.choice(figures)
+        point = rng.choice(figure.points)
+        start = time.perf_counter()
+        figure.update_path()
+        hot["update_path"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        figure.find_closest_segment(point + QPointF(1, 1))
+        hot["find_closest_segment"].append(time.perf_counter() - start)
+
+    # Draw new figures, then insert points on existing ones in edit mode
+    view.resetTransform()
+    scene.mode = "draw"
+    for _ in range(args.frames):
+        pos = QPoint(rng.randint(0, VIEW_SIZE[0]), rng.randint(0, VIEW_SIZE[1]))
+        recorder.frame("draw", lambda: (
+            send_mouse(view, QEvent.Type.MouseButtonPress, pos),
+            send_mouse(view, QEvent.Type.MouseMove, pos + QPoint(5, 5),
+                       Qt.MouseButton.NoButton)))
+    scene.current_figure = None
+    scene.mode = "edit"
+    for _ in range(args.frames):
+        figure = rng.choice(figures)
+        view.centerOn(figure.points[0])
+        first, second = figure.points[0], figure.points[1]
+        pos = view.mapFromScene((first + second) / 2)
+        recorder.frame("edit", lambda: (
+            send_mouse(view, QEvent.Type.MouseButtonPress, pos),
+            send_mouse(view, QEvent.Type.MouseButtonRelease, pos)))
+    view.close()
+
+    report = recorder.report()
+    report.update({name: percentiles(samples) for name, samples in hot.items()})
+    return report
+
+
+TARGETS = {
+    "DrawingCanvas": bench_canvas,
+    "DrawingView": bench_view,
+    "DrawingScene": bench_scene,
+}
+
+
+def run_target(name, args) -> dict:
+    """Timed run of one target, then a traced one for its memory"""
+    start = time.perf_counter()
+    results = TARGETS[name](args, random.Random(args.seed))
+    results["total_seconds"] = time.perf_counter() - start
+
+    tracemalloc.start()
+    TARGETS[name](args, random.Random(args.seed))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results["peak_python_bytes"] = peak
+    # Linux reports kilobytes; the process only ran this target
+    results["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark map rendering on synthetic maps")
+    parser.add_argument("--strokes", type=int, default=5000, help="Stroke segments")
+    parser.add_argument("--figures", type=int, default=200)
+    parser.add_argument("--vertices", type=int, default=50, help="Vertices per figure/polyline")
+    parser.add_argument("--elements", type=int, default=2000)
+    parser.add_argument("--extent", type=float, default=5000.0, help="Size of the map")
+    parser.add_argument("--frames", type=int, default=30, help="Frames per session step")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--run-target", choices=list(TARGETS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_target:
+        # In the process started below for this target only
+        app = QApplication(sys.argv)
+        results = run_target(args.run_target, args)
+        results["qt_platform"] = app.platformName()
+        print(json.dumps(results))
+        return
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("output", "run_target")}
+    report = {
+        "config": config,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": {},
+    }
+    options = [item for key, value in config.items() if key != "targets"
+               for item in (f"--{key}", str(value))]
+    for name in args.targets:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), *options,
+                                  "--run-target", name],
+                                 stdout=subprocess.PIPE, check=True, text=True)
+        results = json.loads(process.stdout.strip().splitlines()[-1])
+        report["qt_platform"] = results.pop("qt_platform")
+        report["results"][name] = results
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
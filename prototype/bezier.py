@@ -0,0 +1,313 @@
+"""
+Cubic Bézier strokes fitted to freehand input
+
+Freehand points are fitted with piecewise cubic Béziers (Schneider's
+algorithm, from "An Algorithm for Automatically Fitting Digitized Curves",
+Graphics Gems, 1990), which keeps a few control points where the input had
+hundreds of vertices. Curves are flattened back to polylines adaptively:
+each cubic gets just enough segments for the current zoom, so they stay
+smooth close up and cheap far away, for painting and for hit testing alike.
+
+    python bezier.py --points 2000 --error 1.5
+"""
+import argparse
+import math
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from PyQt6.QtCore import QPointF
+from PyQt6.QtGui import QPainterPath, QPolygonF
+
+from memory_budget import LOW, array_bytes, memory_budget
+
+FIT_ERROR = 1.5  # Default distance in scene units the fitted curve may stray from the input
+FLATNESS = 0.25  # Pixels a flattened segment may stray from the curve
+MAX_SEGMENTS = 256  # Per cubic, whatever the zoom
+MAX_ITERATIONS = 4  # Newton-Raphson reparameterizations before splitting
+
+
+def _normalize(v):
+    length = math.hypot(v[0], v[1])
+    return v / length if length else v
+
+
+def _bezier(controls, t):
+    """Points of one cubic at the parameters t"""
+    t = t[:, None]
+    s = 1 - t
+    return (s ** 3 * controls[0] + 3 * s ** 2 * t * controls[1] +
+            3 * s * t ** 2 * controls[2] + t ** 3 * controls[3])
+
+
+def _derivatives(controls, t):
+    """First and second derivatives of one cubic at the parameters t"""
+    t = t[:, None]
+    s = 1 - t
+    d = 3 * np.diff(controls, axis=0)
+    dd = 2 * np.diff(d, axis=0)
+    return s ** 2 * d[0] + 2 * s * t * d[1] + t ** 2 * d[2], s * dd[0] + t * dd[1]
+
+
+def _chord_parameters(points):
+    lengths = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+    return lengths / lengths[-1] if lengths[-1] else np.linspace(0, 1, len(points))
+
+
+def _generate(points, u, tangent1, tangent2):
+    """Least squares cubic through points at parameters u, with fixed end tangents"""
+    first, last = points[0], points[-1]
+    s = 1 - u
+    a1 = (3 * s ** 2 * u)[:, None] * tangent1
+    a2 = (3 * s * u ** 2)[:, None] * tangent2
+    c00, c01, c11 = (a1 * a1).sum(), (a1 * a2).sum(), (a2 * a2).sum()
+    rest = points - _bezier(np.array([first, first, last, last]), u)
+    x0, x1 = (a1 * rest).sum(), (a2 * rest).sum()
+
+    determinant = c00 * c11 - c01 * c01
+    alpha1 = (x0 * c11 - x1 * c01) / determinant if determinant else 0.0
+    alpha2 = (c00 * x1 - c01 * x0) / determinant if determinant else 0.0
+    # Degenerate or backwards handles fall back to a third of the chord
+    chord = math.hypot(*(last - first))
+    epsilon = 1e-6 * chord
+    if alpha1 < epsilon or alpha2 < epsilon:
+        alpha1 = alpha2 = chord / 3
+    return np.array([first, first + tangent1 * alpha1, last + tangent2 * alpha2, last])
+
+
+def _reparameterize(controls, points, u):
+    """One Newton-Raphson step bringing each parameter closer to its point"""
+    difference = _bezier(controls, u) - points
+    d1, d2 = _derivatives(controls, u)
+    numerator = (difference * d1).sum(axis=1)
+    denominator = (d1 * d1).sum(axis=1) + (difference * d2).sum(axis=1)
+    step = np.divide(numerator, denominator, out=np.zeros_like(u), where=denominator != 0)
+    return np.clip(u - step, 0.0, 1.0)
+
+
+def _max_error(controls, points, u):
+    distances = np.hypot(*(_bezier(controls, u) - points).T)
+    split = int(np.argmax(distances[1:-1])) + 1
+    return distances[split], split
+
+
+def fit_curve(points, error: float = FIT_ERROR) -> np.ndarray:
+    """
+    Piecewise cubic Bézier through freehand points
+
+    :param points: (n, 2) array of input points
+    :param error: Largest distance allowed between the input and the curve
+    :return: (3 * cubics + 1, 2) float32 array of control points, the end
+        point of a cubic being the start of the next
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    # Repeated points, as given by a still mouse, have no tangent
+    if len(points) > 1:
+        points = points[np.concatenate(([True], np.any(np.diff(points, axis=0) != 0, axis=1)))]
+    if len(points) < 2:
+        return points.astype(np.float32)
+
+    tangent1 = _normalize(points[1] - points[0])
+    tangent2 = _normalize(points[-2] - points[-1])
+    cubics = []
+    # Depth first on the left halves, so cubics come out in order
+    stack = [(0, len(points) - 1, tangent1, tangent2)]
+    while stack:
+        first, last, tangent1, tangent2 = stack.pop()
+        span = points[first:last + 1]
+        if len(span) == 2:
+            third = math.hypot(*(span[1] - span[0])) / 3
+            cubics.append(np.array([span[0], span[0] + tangent1 * third,
+                                    span[1] + tangent2 * third, span[1]]))
+            continue
+
+        u = _chord_parameters(span)
+        controls = _generate(span, u, tangent1, tangent2)
+        worst, split = _max_error(controls, span, u)
+        if worst > error and worst < 4 * error:
+            for _ in range(MAX_ITERATIONS):
+                u = _reparameterize(controls, span, u)
+                controls = _generate(span, u, tangent1, tangent2)
+                worst, split = _max_error(controls, span, u)
+                if worst <= error:
+                    break
+        if worst <= error:
+            cubics.append(controls)
+            continue
+
+        centre = _normalize(span[split - 1] - span[split + 1])
+        stack.append((first + split, last, -centre, tangent2))
+        stack.append((first, first + split, tangent1, centre))
+
+    controls = np.vstack([cubics[0]] + [cubic[1:] for cubic in cubics[1:]])
+    return controls.astype(np.float32)
+
+
+def through_points(points, closed=False) -> np.ndarray:
+    """
+    Cubics passing through every point, as a Catmull-Rom spline
+
+    Used for editable figures, whose vertices stay where the user put them.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return points.astype(np.float32) if len(points) < 2 else \
+            np.array([points[0], points[0], points[1], points[1]], dtype=np.float32)
+    if closed:
+        padded = np.vstack((points[-1:], points, points[:2]))
+    else:
+        # Mirrored end points give natural end tangents
+        padded = np.vstack((2 * points[:1] - points[1:2], points, 2 * points[-1:] - points[-2:-1]))
+    before, start, end, after = padded[:-3], padded[1:-2], padded[2:-1], padded[3:]
+    controls = np.empty((len(start), 3, 2))
+    controls[:, 0] = start
+    controls[:, 1] = start + (end - before) / 6
+    controls[:, 2] = end - (after - start) / 6
+    controls = np.vstack((controls.reshape(-1, 2), end[-1:]))
+    return controls.astype(np.float32)
+
+
+def flatten(controls: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Polyline within tolerance of piecewise cubics, all cubics at once
+
+    Each cubic gets the number of segments bounding its flattening error by
+    its second differences (Wang's formula), so straight runs stay single
+    segments and tight bends get as many as they need.
+    """
+    controls = np.asarray(controls, dtype=np.float64)
+    if len(controls) < 4:
+        return controls
+    p0, p1, p2, p3 = controls[0:-1:3], controls[1::3], controls[2::3], controls[3::3]
+    bend = np.maximum(np.hypot(*(p0 - 2 * p1 + p2).T), np.hypot(*(p1 - 2 * p2 + p3).T))
+    segments = np.ceil(np.sqrt(0.75 * bend / max(tolerance, 1e-9)))
+    segments = np.clip(segments, 1, MAX_SEGMENTS).astype(np.int64)
+
+    cubic = np.repeat(np.arange(len(segments)), segments)
+    starts = np.cumsum(segments) - segments
+    t = ((np.arange(segments.sum()) - starts[cubic]) / segments[cubic])[:, None]
+    s = 1 - t
+    points = (s ** 3 * p0[cubic] + 3 * s ** 2 * t * p1[cubic] +
+              3 * s * t ** 2 * p2[cubic] + t ** 3 * p3[cubic])
+    return np.vstack((points, controls[-1:]))
+
+
+def nearest_on_polyline(points: np.ndarray, x: float, y: float):
+    """Distance from (x, y) to a polyline, and the nearest point (x, y) on it"""
+    if len(points) == 1:
+        return math.hypot(points[0, 0] - x, points[0, 1] - y), (points[0, 0], points[0, 1])
+    a, b = points[:-1], points[1:]
+    direction = b - a
+    length = (direction * direction).sum(axis=1)
+    offset = np.array([x, y]) - a
+    t = np.clip(np.divide((offset * direction).sum(axis=1), length,
+                          out=np.zeros_like(length), where=length > 0), 0.0, 1.0)
+    nearest = a + direction * t[:, None]
+    distances = np.hypot(nearest[:, 0] - x, nearest[:, 1] - y)
+    closest = int(np.argmin(distances))
+    return float(distances[closest]), tuple(nearest[closest].tolist())
+
+
+def polyline_distance(points: np.ndarray, x: float, y: float) -> float:
+    """Distance from (x, y) to the nearest segment of a polyline"""
+    return nearest_on_polyline(points, x, y)[0]
+
+
+class BezierPath:
+    """
+    A stroke stored as Bézier control points
+
+    Flattened polylines are cached per power of two of the zoom, flattened
+    for the most detailed scale of their bucket, and charged to the memory
+    budget as the first thing to let go.
+    """
+
+    def __init__(self, controls: np.ndarray):
+        self.controls = np.asarray(controls, dtype=np.float32).reshape(-1, 2)
+        self._flattened: Dict[int, np.ndarray] = {}
+        self._account = None
+        self._bbox: Optional[tuple] = None
+
+    @classmethod
+    def fit(cls, points, error: float = FIT_ERROR) -> "BezierPath":
+        return cls(fit_curve(points, error))
+
+    @classmethod
+    def from_qpoints(cls, points, error: float = FIT_ERROR) -> "BezierPath":
+        return cls.fit([(p.x(), p.y()) for p in points], error)
+
+    def __len__(self):
+        return len(self.controls)
+
+    @property
+    def bbox(self):
+        """(x0, y0, x1, y1) of the control points, which hold the whole curve"""
+        if self._bbox is None:
+            x0, y0 = self.controls.min(axis=0).tolist()
+            x1, y1 = self.controls.max(axis=0).tolist()
+            self._bbox = (x0, y0, x1, y1)
+        return self._bbox
+
+    def at_scale(self, scale: float) -> np.ndarray:
+        """Flattened points good to FLATNESS pixels at a view scale"""
+        bucket = math.floor(math.log2(scale))
+        cached = self._flattened.get(bucket)
+        if cached is None:
+            cached = flatten(self.controls, FLATNESS / 2 ** (bucket + 1))
+            self._flattened[bucket] = cached
+            if self._account is None:
+                self._account = memory_budget.register("curves", self._evict, LOW)
+            self._account.charge(bucket, array_bytes(cached))
+        return cached
+
+    def _evict(self, bucket: int):
+        self._flattened.pop(bucket, None)
+
+    def to_path(self, scale=1.0) -> QPainterPath:
+        """QPainterPath of the curve, flattened for a view scale"""
+        path = QPainterPath()
+        if len(self.controls):
+            path.addPolygon(QPolygonF([QPointF(x, y) for x, y in self.at_scale(scale).tolist()]))
+        return path
+
+    def distance(self, point: QPointF, scale=1.0) -> float:
+        """Scene distance from a point to the curve, flattened for a view scale"""
+        return polyline_distance(self.at_scale(scale), point.x(), point.y())
+
+    def hit(self, point: QPointF, pixels: float, scale=1.0) -> bool:
+        """Whether a point lies within some pixels of the curve at a view scale"""
+        margin = pixels / scale
+        x0, y0, x1, y1 = self.bbox
+        if not (x0 - margin <= point.x() <= x1 + margin and y0 - margin <= point.y() <= y1 + margin):
+            return False
+        return self.distance(point, scale) <= margin
+
+
+def synthetic_stroke(count: int, seed=0) -> np.ndarray:
+    """Jittered freehand-like input along a meandering river"""
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, count)
+    x = 1000 * t
+    y = 120 * np.sin(6 * t) + 40 * np.sin(23 * t)
+    return np.column_stack((x, y)) + rng.normal(0, 0.4, (count, 2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit Béziers to a synthetic freehand stroke")
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--error", type=float, default=FIT_ERROR)
+    args = parser.parse_args()
+
+    points = synthetic_stroke(args.points)
+    start = time.perf_counter()
+    curve = BezierPath.fit(points, args.error)
+    elapsed = time.perf_counter() - start
+    print(f"{len(points)} input points -> {len(curve)} control points "
+          f"({(len(curve) - 1) // 3} cubics) in {elapsed * 1000:.1f} ms, "
+          f"{points.astype(np.float32).nbytes} -> {curve.controls.nbytes} bytes")
+    for scale in (0.05, 0.25, 1, 4, 16):
+        flat = curve.at_scale(scale)
+        error = max(polyline_distance(flat, x, y) for x, y in points[::max(1, len(points) // 200)])
+        print(f"scale {scale:>5}: {len(flat):5d} flattened points, "
+              f"largest input distance {error:.2f}")
@@ -0,0 +1,285 @@
+"""
+Biome classification from temperature, moisture and elevation rasters
+
+Each cell gets a Climate and a TerrainType from lookup tables indexed by the
+binned inputs, so classifying is a handful of array operations per chunk.
+Contiguous cells of a class are then outlined by marching squares on the
+class mask, tile by tile as for contours, and each outline becomes a Biome
+polygon. Chunks are classified and traced by a process pool.
+
+    python biomes.py world.npy map.json --seed 7
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from contours import march, join_pieces
+from geo_export import simplify
+from map_document import MapDocument, load_map, save_map, map_elements
+from polygon_geometry import Polygon
+from spatial_index import GridIndex
+from terrain import ALTITUDE_SAMPLES, TerrainParams, altitude_stats, fractal_noise, sample_step
+
+Climate = map_elements.Climate
+TerrainType = map_elements.TerrainType
+
+CLIMATES = list(Climate)
+TERRAINS = list(TerrainType)
+NO_BIOME = 255  # Class of sea cells
+CHUNK = 1024
+TILE = 512
+
+# Bin edges of the inputs; the tables below have one entry more than edges
+TEMPERATURE_EDGES = np.array([-5.0, 5.0, 18.0])  # Degrees Celsius
+MOISTURE_EDGES = np.array([0.25, 0.5, 0.75])  # 0 dry to 1 saturated
+ELEVATION_EDGES = np.array([1000.0, 2500.0])  # Metres: flat, hills, mountains
+
+# Climate by (temperature bin, moisture bin)
+CLIMATE_TABLE = np.array([
+    [Climate.POLAR] * 4,
+    [Climate.ARID, Climate.CONTINENTAL, Climate.CONTINENTAL, Climate.CONTINENTAL],
+    [Climate.ARID, Climate.TEMPERATE, Climate.TEMPERATE, Climate.TEMPERATE],
+    [Climate.ARID, Climate.TROPICAL, Climate.TROPICAL, Climate.TROPICAL],
+], dtype=object)
+
+# Terrain of low land by (climate, moisture bin); higher land is hills or mountains
+LOWLAND_TERRAIN = {
+    Climate.POLAR: [TerrainType.TUNDRA] * 4,
+    Climate.ARID: [TerrainType.DESERT] * 4,
+    Climate.CONTINENTAL: [TerrainType.FLATLAND, TerrainType.FLATLAND,
+                          TerrainType.FOREST, TerrainType.SWAMP],
+    Climate.TEMPERATE: [TerrainType.FLATLAND, TerrainType.FLATLAND,
+                        TerrainType.FOREST, TerrainType.SWAMP],
+    Climate.TROPICAL: [TerrainType.FLATLAND, TerrainType.FOREST,
+                       TerrainType.JUNGLE, TerrainType.SWAMP],
+}
+
+
+def _class_tables():
+    """Class of every (temperature, moisture, elevation) bin, class = climate * 8 + terrain"""
+    table = np.zeros((len(TEMPERATURE_EDGES) + 1, len(MOISTURE_EDGES) + 1,
+                      len(ELEVATION_EDGES) + 1), dtype=np.uint8)
+    for t in range(table.shape[0]):
+        for m in range(table.shape[1]):
+            climate = CLIMATE_TABLE[t, m]
+            terrains = [LOWLAND_TERRAIN[climate][m], TerrainType.HILLS, TerrainType.MOUNTAINS]
+            for e, terrain in enumerate(terrains):
+                table[t, m, e] = encode(climate, terrain)
+    return table
+
+
+def encode(climate, terrain) -> int:
+    return CLIMATES.index(climate) * 8 + TERRAINS.index(terrain)
+
+
+def decode(code):
+    return CLIMATES[code // 8], TERRAINS[code % 8]
+
+
+CLASS_TABLE = _class_tables()
+
+
+def classify(temperature, moisture, elevation, sea_level=0.0) -> np.ndarray:
+    """Biome class of every cell, NO_BIOME under the sea"""
+    codes = CLASS_TABLE[np.searchsorted(TEMPERATURE_EDGES, temperature, side="right"),
+                        np.searchsorted(MOISTURE_EDGES, moisture, side="right"),
+                        np.searchsorted(ELEVATION_EDGES, elevation, side="right")]
+    codes[elevation < sea_level] = NO_BIOME
+    return codes
+
+
+@dataclass
+class ClimateParams:
+    """Synthetic climate: warm at the middle row, colder at the edges and with altitude"""
+    seed: int = 0
+    equator_temperature: float = 28.0
+    pole_temperature: float = -20.0
+    lapse_rate: float = 6.5  # Degrees lost per 1000 m
+    moisture_scale: float = 384.0
+
+
+def synthetic_climate(elevation, row0, col0, total_rows, params: ClimateParams):
+    """Temperature and moisture of a chunk, seamless across chunks like the terrain"""
+    rows, cols = elevation.shape
+    latitude = np.abs((np.arange(row0, row0 + rows) + 0.5) / total_rows * 2 - 1)
+    temperature = (params.equator_temperature +
+                   (params.pole_temperature - params.equator_temperature) * latitude)[:, None]
+    temperature = temperature - params.lapse_rate * np.maximum(elevation, 0) / 1000
+    noise = TerrainParams(seed=params.seed + 1, scale=params.moisture_scale, octaves=5,
+                          erosion_iterations=0)
+    moisture = fractal_noise(col0, row0, cols, rows, noise)
+    # Value noise gathers around the middle, spread it over [0, 1]
+    moisture = np.clip((moisture - 0.5) * 2.2 + 0.5, 0.0, 1.0)
+    return temperature, moisture
+
+
+def _classify_into(heights_path, codes_path, params_dict, sea_level, row0, col0, rows, cols):
+    heights = np.load(heights_path, mmap_mode="r")
+    codes = np.load(codes_path, mmap_mode="r+")
+    elevation = np.asarray(heights[row0:row0 + rows, col0:col0 + cols], dtype=np.float32)
+    temperature, moisture = synthetic_climate(elevation, row0, col0, heights.shape[0],
+                                              ClimateParams(**params_dict))
+    codes[row0:row0 + rows, col0:col0 + cols] = classify(temperature, moisture, elevation,
+                                                         sea_level)
+    codes.flush()
+
+
+def classify_heightmap(heights_path, codes_path, params: ClimateParams, sea_level=0.0,
+                       chunk=CHUNK, workers=None):
+    """Classify a heightmap under a synthetic climate into a .npy of classes"""
+    shape = np.load(heights_path, mmap_mode="r").shape
+    codes = np.lib.format.open_memmap(codes_path, mode="w+", dtype=np.uint8, shape=shape)
+    del codes
+    jobs = [(row0, col0, min(chunk, shape[0] - row0), min(chunk, shape[1] - col0))
+            for row0 in range(0, shape[0], chunk) for col0 in range(0, shape[1], chunk)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(_classify_into, heights_path, codes_path, asdict(params),
+                               sea_level, *job) for job in jobs]
+        for future in futures:
+            future.result()
+    return np.load(codes_path, mmap_mode="r")
+
+
+def _bordered_block(codes, row0, col0, rows, cols):
+    """
+    Block of the classes surrounded by a ring of NO_BIOME
+
+    Coordinates are those of the bordered map, one more than the map's, so
+    regions touching the map border are closed too.
+    """
+    top, left = max(0, row0 - 1), max(0, col0 - 1)
+    bottom = min(codes.shape[0], row0 + rows - 1)
+    right = min(codes.shape[1], col0 + cols - 1)
+    block = np.asarray(codes[top:bottom, left:right])
+    return np.pad(block, ((top - (row0 - 1), row0 + rows - 1 - bottom),
+                          (left - (col0 - 1), col0 + cols - 1 - right)),
+                  constant_values=NO_BIOME)
+
+
+def outline_tile(codes_path, row0, col0, rows, cols):
+    """Outlines of every class in a tile of the bordered map, joined within the tile"""
+    codes = np.load(codes_path, mmap_mode="r")
+    block = _bordered_block(codes, row0, col0, rows + 1, cols + 1)
+    stride = codes.shape[1] + 3
+    result = {}
+    for code in np.unique(block):
+        if code == NO_BIOME:
+            continue
+        mask = block == code
+        # March only over the cells around this class
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        top, left = max(0, rows[0] - 1), max(0, cols[0] - 1)
+        bottom, right = rows[-1] + 2, cols[-1] + 2
+        keys, points = march(mask[top:bottom, left:right].astype(np.float32), 0.5,
+                             row0 + top, col0 + left, stride)
+        if len(keys):
+            result[int(code)] = join_pieces([(a, b, p) for (a, b), p in
+                                             zip(keys.tolist(), points)])
+    return result
+
+
+def _is_hole(ring, rings, index):
+    """Whether a ring lies inside an odd number of the other outlines of its class"""
+    x, y = ring.vertices[0]
+    depth = sum(1 for key in index.query((x, y, x, y))
+                if rings[key] is not ring and rings[key].contains([(x, y)])[0])
+    return depth % 2 == 1
+
+
+def vectorize(codes_path, cell_size=1.0, tolerance=1.0, min_cells=16, tile=TILE, workers=None):
+    """
+    Outer outlines of the contiguous regions of each class
+
+    Holes are dropped, figures have none: an enclave is a region of its own
+    lying over the outline around it.
+
+    :param tolerance: Simplification, in cells
+    :param min_cells: Smallest region kept, in cells
+    :return: List of (class, Polygon in scene coordinates)
+    """
+    shape = np.load(codes_path, mmap_mode="r").shape
+    # Tiles over the bordered map, which is shape + 2
+    jobs = [(row0, col0, min(tile, shape[0] + 1 - row0), min(tile, shape[1] + 1 - col0))
+            for row0 in range(0, shape[0] + 1, tile) for col0 in range(0, shape[1] + 1, tile)]
+    pieces = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(outline_tile, codes_path, *job) for job in jobs]
+        for future in futures:
+            for code, tile_pieces in future.result().items():
+                pieces.setdefault(code, []).extend(tile_pieces)
+
+    regions = []
+    for code, class_pieces in sorted(pieces.items()):
+        rings = []
+        for start, end, points in join_pieces(class_pieces):
+            points = simplify(points, tolerance)
+            # Bordered map cells are one off, samples are at cell centres
+            points = (points - 0.5) * cell_size
+            if len(points) >= 4:
+                polygon = Polygon(points)
+                if polygon.area >= min_cells * cell_size ** 2:
+                    rings.append(polygon)
+        index = GridIndex(cell_size * 64)
+        index.update((i, ring.bbox) for i, ring in enumerate(rings))
+        regions.extend((code, ring) for ring in rings if not _is_hole(ring, rings, index))
+    return regions
+
+
+def make_biomes(regions, heights=None, cell_size=1.0, altitude_samples=ALTITUDE_SAMPLES):
+    """
+    Biome elements for vectorized regions, with altitudes when heights are given
+
+    :param altitude_samples: About how many cells are sampled for each altitude
+    """
+    biomes = []
+    counts = {}
+    for code, polygon in regions:
+        climate, terrain = decode(code)
+        counts[code] = counts.get(code, 0) + 1
+        name = f"{climate.value.title()} {terrain.value} {counts[code]}"
+        coordinates = [map_elements.Coordinates(float(x), float(y)) for x, y in polygon.vertices]
+        biome = map_elements.Biome(name, coordinates, climate, terrain)
+        if heights is not None:
+            step = sample_step(polygon, cell_size, altitude_samples)
+            biome.altitude = altitude_stats(heights, polygon, cell_size, step)
+        biomes.append(biome)
+    return biomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a heightmap into biomes")
+    parser.add_argument("heightmap", help="Heightmap (.npy, metres)")
+    parser.add_argument("output", help="Map document receiving the biomes, created if missing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sea-level", type=float, default=0.0)
+    parser.add_argument("--cell-size", type=float, default=1.0, help="Scene units per cell")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="Simplification, in cells")
+    parser.add_argument("--min-cells", type=int, default=64, help="Smallest biome, in cells")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    codes_path = os.path.splitext(args.output)[0] + ".biomes.npy"
+    classify_heightmap(args.heightmap, codes_path, ClimateParams(seed=args.seed),
+                       args.sea_level, workers=args.workers)
+    print(f"Classified in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    regions = vectorize(codes_path, args.cell_size, args.tolerance, args.min_cells,
+                        workers=args.workers)
+    heights = np.load(args.heightmap, mmap_mode="r")
+    biomes = make_biomes(regions, heights, args.cell_size)
+    print(f"{len(biomes)} biomes in {time.perf_counter() - start:.2f}s")
+
+    document = load_map(args.output) if os.path.exists(args.output) else MapDocument()
+    document.elements.extend(biomes)
+    save_map(document, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import math
+import random
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsScene, QGraphicsView,
+                             QGraphicsItem)
+from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtGui import QPainter, QPen, QBrush, QColor, QFont, QFontMetricsF
+
+from map_document import element_anchor, map_elements
+from text_cache import text_cache
+
+CLUSTER_RADIUS = 48  # Pixels covered by a cluster; bounds the markers per frame
+MIN_ZOOM = -10
+MAX_ZOOM = 3  # Above this zoom every city is shown on its own
+
+
+@dataclass
+class ClusterLevel:
+    """Clusters of one zoom level, as parallel arrays"""
+    x: np.ndarray           # Centroids weighted by population, scene coordinates
+    y: np.ndarray
+    count: np.ndarray       # Cities in each cluster
+    population: np.ndarray  # Summed population
+    weight: np.ndarray
+    parent: Optional[np.ndarray] = None  # Cluster of the next coarser level
+
+    def __len__(self):
+        return len(self.x)
+
+
+@dataclass
+class Marker:
+    """A cluster or a single city, as drawn"""
+    x: float
+    y: float
+    count: int
+    population: int
+    city: object = None
+
+
+class ClusterIndex:
+    """
+    Hierarchy of city clusters, one level per zoom
+
+    The finest level holds the cities. Each coarser level groups the clusters
+    of the level below on a grid whose cells measure CLUSTER_RADIUS pixels at
+    that level's zoom, so a cluster has exactly one parent and a viewport holds
+    a bounded number of markers at any zoom. Grouping is done with array
+    operations and the whole hierarchy is built once.
+    """
+
+    def __init__(self, cities, radius=CLUSTER_RADIUS, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.cities = list(cities)
+        self.radius = radius
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+
+        anchors = np.array([element_anchor(c) for c in self.cities],
+                           dtype=np.float64).reshape(-1, 2)
+        population = np.array([c.population for c in self.cities], dtype=np.float64)
+        # Empty towns still pull their cluster a little
+        weight = population + 1
+        self.levels: Dict[int, ClusterLevel] = {
+            max_zoom + 1: ClusterLevel(anchors[:, 0], anchors[:, 1],
+                                       np.ones(len(self.cities), dtype=np.int64),
+                                       population, weight)
+        }
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            self.levels[zoom] = self._group(self.levels[zoom + 1], radius / 2.0 ** zoom)
+
+    @staticmethod
+    def _group(finer: ClusterLevel, cell: float) -> ClusterLevel:
+        if not len(finer):
+            finer.parent = np.zeros(0, dtype=np.int64)
+            return finer
+        cx = np.floor(finer.x / cell).astype(np.int64)
+        cy = np.floor(finer.y / cell).astype(np.int64)
+        _, parent = np.unique(np.column_stack((cx, cy)), axis=0, return_inverse=True)
+        parent = parent.ravel()
+        finer.parent = parent
+        weight = np.bincount(parent, finer.weight)
+        return ClusterLevel(np.bincount(parent, finer.x * finer.weight) / weight,
+                            np.bincount(parent, finer.y * finer.weight) / weight,
+                            np.bincount(parent, finer.count).astype(np.int64),
+                            np.bincount(parent, finer.population),
+                            weight)
+
+    def markers(self, scale: float, rect) -> List[Marker]:
+        """
+        Markers to draw at a scale within a scene rectangle (x0, y0, x1, y1)
+
+        Clusters move out from their parent's position as the zoom grows past
+        their level, so clusters split smoothly instead of popping.
+        """
+        # Level z is shown from zoom z on, where its cells measure at least the
+        # radius on screen; its clusters leave their parent in the first half
+        zoom = math.log2(scale)
+        shown = min(self.max_zoom + 1, max(self.min_zoom, math.floor(zoom)))
+        t = min(1.0, max(0.0, 2 * (zoom - shown)))
+        level = self.levels[shown]
+        coarser = self.levels.get(shown - 1)
+        # Markers reach outside the rectangle by their size, and children start
+        # from their parent, up to a cell diagonal of the coarser level away
+        margin = self.radius / scale
+        reach = margin + 2 * math.sqrt(2) * self.radius / 2.0 ** shown
+        grown = (rect[0] - reach, rect[1] - reach, rect[2] + reach, rect[3] + reach)
+
+        # A vectorized mask is cheaper than a spatial index here, levels have
+        # no build cost and a frame never touches more than the visible clusters
+        ids = np.flatnonzero((level.x >= grown[0]) & (level.x <= grown[2]) &
+                             (level.y >= grown[1]) & (level.y <= grown[3]))
+        x, y = level.x[ids], level.y[ids]
+        if coarser is not None and t < 1.0:
+            parents = level.parent[ids]
+            # Ease out, the split is fast at first then settles
+            ease = 1 - (1 - t) ** 2
+            x = coarser.x[parents] + (x - coarser.x[parents]) * ease
+            y = coarser.y[parents] + (y - coarser.y[parents]) * ease
+        inside = ((x >= rect[0] - margin) & (x <= rect[2] + margin) &
+                  (y >= rect[1] - margin) & (y <= rect[3] + margin))
+        cities = shown == self.max_zoom + 1
+        return [Marker(float(mx), float(my), int(count), int(population),
+                       self.cities[i] if cities else None)
+                for i, mx, my, count, population in zip(
+                    ids[inside].tolist(), x[inside].tolist(), y[inside].tolist(),
+                    level.count[ids[inside]].tolist(), level.population[ids[inside]].tolist())]
+
+
+def format_population(population: int) -> str:
+    if population >= 1e6:
+        return f"{population / 1e6:.1f}M"
+    if population >= 1e3:
+        return f"{population / 1e3:.0f}k"
+    return str(population)
+
+
+def paint_markers(painter: QPainter, index: ClusterIndex, scale: float, rect, font: QFont,
+                  show_population=False):
+    """Draw the markers of a scene rectangle in pixels, with the painter's transform"""
+    transform = painter.transform()
+    metrics = QFontMetricsF(font)
+    painter.save()
+    painter.resetTransform()
+    painter.setPen(QPen(QColor(90, 40, 20), 1))
+    for marker in index.markers(scale, rect):
+        centre = transform.map(QPointF(marker.x, marker.y))
+        if marker.count == 1:
+            painter.setBrush(QBrush(QColor(200, 60, 30)))
+            painter.drawEllipse(centre, 3, 3)
+            continue
+        radius = 7 + 3 * math.log10(marker.count)
+        painter.setBrush(QBrush(QColor(240, 140, 60, 200)))
+        painter.drawEllipse(centre, radius, radius)
+        text = format_population(marker.population) if show_population else str(marker.count)
+        text_cache.draw_text(painter, centre - QPointF(metrics.horizontalAdvance(text) / 2,
+                                                       metrics.height() / 2), text, font)
+    painter.restore()
+
+
+class ClusterLayerItem(QGraphicsItem):
+    """Single scene item drawing the cities of a map as clusters"""
+
+    def __init__(self, cities, font: QFont = None):
+        super().__init__()
+        self.index = ClusterIndex(cities)
+        self.font = font or QFont("Sans", 8)
+        self.show_population = False
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self._bounds = QRectF()
+        finest = self.index.levels[self.index.max_zoom + 1]
+        if len(finest):
+            self._bounds = QRectF(finest.x.min(), finest.y.min(),
+                                  finest.x.max() - finest.x.min(), finest.y.max() - finest.y.min())
+
+        self.view_scale = 1.0
+
+    def set_view_scale(self, scale: float):
+        """Markers keep their pixel size, so the bounds depend on the view's zoom"""
+        self.prepareGeometryChange()
+        self.view_scale = scale
+
+    def boundingRect(self):
+        margin = self.index.radius / self.view_scale
+        return self._bounds.adjusted(-margin, -margin, margin, margin)
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect
+        rect = (exposed.left(), exposed.top(), exposed.right(), exposed.bottom())
+        paint_markers(painter, self.index, painter.worldTransform().m11(), rect, self.font,
+                      self.show_population)
+
+
+class ClusterView(QGraphicsView):
+    def __init__(self, scene):
+        super().__init__(scene)
+        self.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.FullViewportUpdate)
+
+        self.cluster_layer = None
+
+    def wheelEvent(self, event):
+        zoom_factor = 1.15 if event.angleDelta().y() > 0 else 1 / 1.15
+        self.scale(zoom_factor, zoom_factor)
+        if self.cluster_layer is not None:
+            self.cluster_layer.set_view_scale(self.transform().m11())
+
+    def keyPressEvent(self, event):
+        # P switches the markers between city counts and summed population
+        if event.key() == Qt.Key.Key_P and self.cluster_layer is not None:
+            self.cluster_layer.show_population = not self.cluster_layer.show_population
+            self.viewport().update()
+            return
+        super().keyPressEvent(event)
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("City Clusters")
+        self.setGeometry(100, 100, 1000, 800)
+
+        random.seed(1)
+        # Cities gather around a few hundred regional centres
+        centres = [(random.uniform(0, 40000), random.uniform(0, 30000)) for _ in range(300)]
+        cities = []
+        for i in range(100000):
+            cx, cy = random.choice(centres)
+            coordinates = [map_elements.Coordinates(random.gauss(cx, 800), random.gauss(cy, 800))]
+            cities.append(map_elements.City(f"City {i}", coordinates,
+                                            population=int(random.paretovariate(1.2) * 1000)))
+
+        scene = QGraphicsScene()
+        layer = ClusterLayerItem(cities)
+        scene.addItem(layer)
+        view = ClusterView(scene)
+        view.cluster_layer = layer
+        view.scale(0.02, 0.02)
+        layer.set_view_scale(0.02)
+        self.setCentralWidget(view)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
@@ -1,9 +1,18 @@
+"""
+Figures edited through their control points
+
+Opened as the app's first tab: numpy and bezier are only imported once a
+figure is drawn, the viewport and instrumentation when run on its own.
+"""
+import math
 import sys
+
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsScene, QGraphicsView, 
                             QVBoxLayout, QWidget, QPushButton, QGraphicsLineItem, 
-                            QHBoxLayout, QGraphicsPathItem, QGraphicsEllipseItem)
+                            QHBoxLayout, QGraphicsPathItem, QGraphicsEllipseItem, QStyle)
 from PyQt6.QtCore import Qt, QPointF, QRectF
-from PyQt6.QtGui import QPen, QColor, QPainter, QPainterPath
+from PyQt6.QtGui import QPen, QColor, QPainter, QPainterPath, QPainterPathStroker, QPolygonF
+
 
 class ControlPoint(QGraphicsEllipseItem):
     def __init__(self, pos, parent=None):
@@ -23,13 +32,50 @@ class ControlPoint(QGraphicsEllipseItem):
         if isinstance(self.parentItem(), FigureGraphicsItem):
             self.parentItem().update_path()
 
+def polygon_array(polygon: QPolygonF) -> "np.ndarray":
+    """The points of a QPolygonF as an (n, 2) array, without copying, valid while it lives"""
+    import numpy as np
+    data = polygon.data()
+    data.setsize(len(polygon) * 16)
+    return np.frombuffer(data, dtype=np.float64).reshape(-1, 2)
+
+
+def segments_bbox(segments: "np.ndarray"):
+    """(min_x, min_y, max_x, max_y) of segments, or cubics whose control points hold them"""
+    points = segments.reshape(-1, 2)
+    x0, y0 = points.min(axis=0).tolist()
+    x1, y1 = points.max(axis=0).tolist()
+    return (x0, y0, x1, y1)
+
+
 class FigureGraphicsItem(QGraphicsPathItem):
+    """
+    Figure edited through its control points
+
+    The item keeps its path, bounding box and shape itself rather than going
+    through setPath(), after which Qt repaints the whole figure and the scene
+    reindexes it. update_path() compares the new segments with the previous
+    ones: only the area of those that changed is repainted, and returned for
+    the scene to update what depends on the outline. The geometry only
+    changes when the bounding box does.
+    """
+
     def __init__(self):
+        import numpy as np
         super().__init__()
         self.points = []
         self.control_points = []
         self.temp_point = None
         self.is_closed = False
+        self.smooth = False  # Curves through the points instead of straight segments
+        self._path = QPainterPath()
+        self._shape = None
+        self._rect = QRectF()
+        # Segments as drawn, (n, 2, 2) lines or (n, 4, 2) cubics, and their bounding box
+        self._segments = np.empty((0, 2, 2))
+        self._bbox = None
+        # Curves flattened for hit-testing, by zoom bucket, until the points change
+        self._flattened = {}
         self.setPen(QPen(Qt.GlobalColor.black, 2))
         self.setAcceptHoverEvents(True)
         self.setFlags(self.GraphicsItemFlag.ItemIsSelectable)
@@ -51,24 +97,143 @@ class FigureGraphicsItem(QGraphicsPathItem):
         self.temp_point = point
         self.update_path()
 
-    def update_path(self):
+    def update_path(self) -> QRectF:
+        """
+        Rebuild the path after points moved, were added or the figure closed
+
+        :return: The scene area repainted, empty when nothing changed
+        """
+        import numpy as np
+        from bezier import through_points
         # Update points based on control points positions
         for i, cp in enumerate(self.control_points):
             self.points[i] = cp.pos()
+        self._flattened.clear()
 
         path = QPainterPath()
-        if len(self.points) > 0:
-            path.moveTo(self.points[0])
-            for point in self.points[1:]:
-                path.lineTo(point)
-            
+        if self.smooth and len(self.points) > 2:
+            points = list(self.points)
+            if self.temp_point and not self.is_closed:
+                points.append(self.temp_point)
+            controls = through_points([(p.x(), p.y()) for p in points], self.is_closed)
+            starts = np.arange(0, len(controls) - 1, 3)
+            segments = controls[starts[:, None] + np.arange(4)].astype(np.float64)
+            controls = controls.tolist()
+            path.moveTo(QPointF(*controls[0]))
+            for i in range(1, len(controls), 3):
+                path.cubicTo(QPointF(*controls[i]), QPointF(*controls[i + 1]),
+                             QPointF(*controls[i + 2]))
+        elif len(self.points) > 0:
+            drawn = list(self.points)
             if self.temp_point and not self.is_closed:
-                path.lineTo(self.temp_point)
+                drawn.append(self.temp_point)
 
             if self.is_closed:
-                path.lineTo(self.points[0])
-
-        self.setPath(path)
+                drawn.append(self.points[0])
+
+            # One call instead of a lineTo() per point
+            polygon = QPolygonF(drawn)
+            path.addPolygon(polygon)
+            xy = polygon_array(polygon)
+            # A lone point is a segment of no length
+            segments = np.stack((xy[:-1], xy[1:]), axis=1) if len(xy) > 1 else np.stack((xy, xy), axis=1)
+        else:
+            segments = np.empty((0, 2, 2))
+
+        self._path = path
+        self._shape = None
+        return self._apply_segments(segments)
+
+    def _apply_segments(self, segments: "np.ndarray") -> QRectF:
+        """Repaint what changed since the previous segments, updating the bounding box"""
+        import numpy as np
+        old, self._segments = self._segments, segments
+        # Segments left alone at both ends, a moved point changes the few in between
+        prefix = suffix = 0
+        if old.shape[1:] == segments.shape[1:]:
+            count = min(len(old), len(segments))
+            same = np.all(old[:count] == segments[:count], axis=(1, 2))
+            prefix = count if same.all() else int(np.argmin(same))
+            count -= prefix
+            same = np.all(old[len(old) - count:] == segments[len(segments) - count:],
+                          axis=(1, 2))[::-1]
+            suffix = count if same.all() else int(np.argmin(same))
+        removed = old[prefix:len(old) - suffix]
+        added = segments[prefix:len(segments) - suffix]
+        if not len(removed) and not len(added):
+            return QRectF()
+
+        removed_bbox = segments_bbox(removed) if len(removed) else None
+        added_bbox = segments_bbox(added) if len(added) else None
+        bbox = self._bbox
+        if not len(segments):
+            bbox = None
+        elif bbox is None or (removed_bbox and not self._inside(removed_bbox, bbox)):
+            # What was removed may have held the bounds, measure again
+            bbox = segments_bbox(segments)
+        elif added_bbox:
+            bbox = self._union(bbox, added_bbox)
+
+        rect = self._padded(self._union(removed_bbox, added_bbox))
+        if bbox != self._bbox:
+            # The scene repaints both bounds and moves the item in its index
+            self.prepareGeometryChange()
+            self._bbox = bbox
+            self._rect = self._padded(bbox)
+        else:
+            self.update(rect)
+        return self.mapRectToScene(rect)
+
+    @staticmethod
+    def _union(a, b):
+        if a is None or b is None:
+            return a or b
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+    @staticmethod
+    def _inside(inner, outer) -> bool:
+        """Whether inner lies strictly within outer, off its edges"""
+        return (outer[0] < inner[0] and outer[1] < inner[1] and
+                inner[2] < outer[2] and inner[3] < outer[3])
+
+    def _padded(self, bbox) -> QRectF:
+        if bbox is None:
+            return QRectF()
+        # Caps and joins reach up to a pen width away from the points, plus antialiasing
+        padding = self.pen().widthF() + 1
+        x0, y0, x1, y1 = bbox
+        return QRectF(x0, y0, x1 - x0, y1 - y0).adjusted(-padding, -padding, padding, padding)
+
+    def boundingRect(self):
+        return self._rect
+
+    def path(self):
+        return self._path
+
+    def setPen(self, pen):
+        self.prepareGeometryChange()
+        super().setPen(pen)
+        # Painted with this copy, pen() makes a new one on every call
+        self._pen = QPen(pen)
+        self._shape = None
+        self._rect = self._padded(self._bbox)
+
+    def shape(self):
+        # Built for hit tests only, and kept until the path changes
+        if self._shape is None:
+            stroker = QPainterPathStroker(self._pen)
+            self._shape = stroker.createStroke(self._path)
+            self._shape.addPath(self._path)
+        return self._shape
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self._pen)
+        painter.setBrush(self.brush())
+        painter.drawPath(self._path)
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.setPen(QPen(Qt.GlobalColor.black, 0, Qt.PenStyle.DashLine))
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            painter.drawRect(self.boundingRect())
 
     def try_close_figure(self, point, threshold=10.0):
         if len(self.points) > 2:
@@ -80,7 +245,15 @@ class FigureGraphicsItem(QGraphicsPathItem):
                 return True
         return False
 
-    def find_closest_segment(self, point):
+    def find_closest_segment(self, point, scale=1.0):
+        """
+        Index where a point clicked near the outline would be inserted, or -1
+
+        :param scale: Zoom of the view clicked in, the outline must be within
+                      10 pixels of the point
+        """
+        if self.smooth and len(self.points) > 2:
+            return self.find_closest_curve(point, scale)
         min_distance = float('inf')
         insert_index = -1
         
@@ -108,13 +281,52 @@ class FigureGraphicsItem(QGraphicsPathItem):
                 insert_index = i + 1
                 self.projection_point = projection
         
-        return insert_index if min_distance < 10 else -1
+        return insert_index if min_distance < 10 / scale else -1
+
+    def find_closest_curve(self, point, scale=1.0):
+        """Same as find_closest_segment, against the flattened cubic between each point pair"""
+        from bezier import nearest_on_polyline
+        min_distance = float('inf')
+        insert_index = -1
+        for i, flat in enumerate(self._flattened_curves(scale)):
+            distance, nearest = nearest_on_polyline(flat, point.x(), point.y())
+            if distance < min_distance:
+                min_distance = distance
+                insert_index = i + 1
+                self.projection_point = QPointF(*nearest)
+
+        return insert_index if min_distance < 10 / scale else -1
+
+    def _flattened_curves(self, scale):
+        """
+        Cubic between each point pair, flattened for the zoom
+
+        Like bezier.BezierPath, good to FLATNESS pixels for the most detailed
+        scale of the power of two bucket, and kept per bucket.
+        """
+        from bezier import FLATNESS, flatten, through_points
+        bucket = math.floor(math.log2(scale))
+        curves = self._flattened.get(bucket)
+        if curves is None:
+            controls = through_points([(p.x(), p.y()) for p in self.points], self.is_closed)
+            tolerance = FLATNESS / 2 ** (bucket + 1)
+            curves = self._flattened[bucket] = [flatten(controls[i:i + 4], tolerance)
+                                                for i in range(0, len(controls) - 1, 3)]
+        return curves
+
+
+def view_scale(event) -> float:
+    """Zoom of the view a scene mouse event comes from, 1 without one"""
+    widget = event.widget()
+    view = widget.parentWidget() if widget is not None else None
+    return view.transform().m11() if isinstance(view, QGraphicsView) else 1.0
 
 class DrawingScene(QGraphicsScene):
     def __init__(self):
         super().__init__()
         self.current_figure = None
         self.mode = "draw"  # Modes: "draw", "edit", "remove"
+        self.smooth = False
         self.selected_item = None
         self.dragging_point = None
 
@@ -124,6 +336,7 @@ class DrawingScene(QGraphicsScene):
         if self.mode == "draw":
             if not self.current_figure:
                 self.current_figure = FigureGraphicsItem()
+                self.current_figure.smooth = self.smooth
                 self.addItem(self.current_figure)
                 self.current_figure.add_point(pos)
             else:
@@ -137,7 +350,7 @@ class DrawingScene(QGraphicsScene):
             for item in items:
                 if isinstance(item, FigureGraphicsItem):
                     # Find the closest line segment and insert a new point
-                    insert_index = item.find_closest_segment(pos)
+                    insert_index = item.find_closest_segment(pos, view_scale(event))
                     if insert_index != -1:
                         new_point = item.projection_point
                         control_point = item.insert_point(insert_index, new_point)
@@ -165,7 +378,8 @@ class ZoomableView(QGraphicsView):
     def __init__(self, scene):
         super().__init__(scene)
         self.setRenderHint(QPainter.RenderHint.Antialiasing)
-        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.FullViewportUpdate)
+        # Edited figures repaint only the segments that moved, not the whole viewport
+        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.MinimalViewportUpdate)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
         self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
@@ -261,11 +475,14 @@ class MainWindow(QMainWindow):
         draw_button = QPushButton("Draw Mode")
         remove_button = QPushButton("Remove Mode")
         edit_button = QPushButton("Edit mode")
+        smooth_button = QPushButton("Smooth")
+        smooth_button.setCheckable(True)
 
         # Add mode buttons to layout
         mode_layout.addWidget(draw_button)
         mode_layout.addWidget(remove_button)
         mode_layout.addWidget(edit_button)
+        mode_layout.addWidget(smooth_button)
 
         # Connect zoom buttons
         zoom_in_button.clicked.connect(self.zoom_in)
@@ -276,6 +493,7 @@ class MainWindow(QMainWindow):
         draw_button.clicked.connect(lambda: self.set_mode("draw"))
         remove_button.clicked.connect(lambda: self.set_mode("remove"))
         edit_button.clicked.connect(lambda: self.set_mode("edit"))
+        smooth_button.toggled.connect(self.set_smooth)
 
         # Initialize scene
         self.scene.setSceneRect(0, 0, 780, 520)
@@ -294,9 +512,21 @@ class MainWindow(QMainWindow):
     def set_mode(self, mode):
         self.scene.mode = mode
 
+    def set_smooth(self, smooth):
+        self.scene.smooth = smooth
+        for item in self.scene.items():
+            if isinstance(item, FigureGraphicsItem):
+                item.smooth = smooth
+                item.update_path()
+
 if __name__ == "__main__":
+    from gl_viewport import viewport_from_env
+    from instrumentation import install_from_env
+
     app = QApplication(sys.argv)
     window = MainWindow()
+    viewport_from_env(window.view)
+    install_from_env(window.view, (FigureGraphicsItem,))
     window.show()
     sys.exit(app.exec())
 
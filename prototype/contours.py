@@ -0,0 +1,421 @@
+"""
+Contour lines and hillshading from heightmaps
+
+Contours are traced by marching squares, vectorized over the cells of one
+tile at a time; tiles are processed in parallel and their open lines are
+stitched afterwards through the grid edges they end on, which are the same
+on both sides of a tile border. Lines become map document strokes, at a
+level of detail chosen by zoom, and hillshading becomes image tiles in the
+tile exporter's z/x/y layout or a raster for the document.
+
+    python contours.py world.npy map.json --interval 250 --hillshade tiles
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+from geo_export import simplify
+from map_document import MapDocument, Raster, Stroke, save_map
+from memory_budget import NORMAL, array_bytes, memory_budget
+
+TILE = 512  # Cells per side of a contoured tile
+INDEX_EVERY = 5  # Every fifth level is an index contour, drawn thicker
+
+# Segments of each marching squares case, as pairs of cell edges:
+# 0 top, 1 right, 2 bottom, 3 left. Corner bits: top-left 8, top-right 4,
+# bottom-right 2, bottom-left 1. Saddles (5 and 10) depend on the centre.
+_CASES = {
+    1: [(3, 2)], 2: [(2, 1)], 3: [(3, 1)], 4: [(0, 1)], 6: [(0, 2)], 7: [(3, 0)],
+    8: [(3, 0)], 9: [(0, 2)], 11: [(0, 1)], 12: [(3, 1)], 13: [(2, 1)], 14: [(3, 2)],
+}
+_SADDLES = {
+    # case: (segments with a low centre, segments with a high centre)
+    5: ([(0, 1), (3, 2)], [(3, 0), (2, 1)]),
+    10: ([(3, 0), (2, 1)], [(0, 1), (3, 2)]),
+}
+
+
+def _segment_table():
+    """(centre high, slot, case, end) -> edge, -1 where the slot is empty"""
+    table = np.full((2, 2, 16, 2), -1, dtype=np.int8)
+    for case, segments in _CASES.items():
+        for high in (0, 1):
+            table[high, 0, case] = segments[0]
+    for case, by_centre in _SADDLES.items():
+        for high, segments in enumerate(by_centre):
+            for slot, segment in enumerate(segments):
+                table[high, slot, case] = segment
+    return table
+
+
+SEGMENT_TABLE = _segment_table()
+
+
+@dataclass
+class Contour:
+    """A contour line in scene coordinates"""
+    level: float
+    points: np.ndarray
+    closed: bool = False
+
+
+def _edge_points(edge, rows, cols, tl, tr, br, bl, level):
+    """Where a level crosses the given edge of each cell, in grid coordinates"""
+    x = cols.astype(np.float64)
+    y = rows.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        top = (level - tl) / (tr - tl)
+        right = (level - tr) / (br - tr)
+        bottom = (level - bl) / (br - bl)
+        left = (level - tl) / (bl - tl)
+    px = np.select([edge == 0, edge == 1, edge == 2], [x + top, x + 1, x + bottom], x)
+    py = np.select([edge == 0, edge == 1, edge == 2], [y, y + right, y + 1], y + left)
+    return np.column_stack((px, py))
+
+
+def _edge_keys(edge, rows, cols, stride):
+    """Global identifiers of cell edges: horizontal edges even, vertical ones odd"""
+    node_row = rows + (edge == 2)
+    node_col = cols + (edge == 1)
+    return (node_row.astype(np.int64) * stride + node_col) * 2 + ((edge == 1) | (edge == 3))
+
+
+def cell_bounds(block):
+    """Lowest and highest corner of every cell of a block"""
+    tl, tr, br, bl = block[:-1, :-1], block[:-1, 1:], block[1:, 1:], block[1:, :-1]
+    return (np.minimum(np.minimum(tl, tr), np.minimum(br, bl)),
+            np.maximum(np.maximum(tl, tr), np.maximum(br, bl)))
+
+
+def march(block, level, row0, col0, stride, bounds=None):
+    """
+    Marching squares over a block of heights for one level
+
+    :param row0: Row of the block's first sample in the whole heightmap
+    :param stride: Heightmap width plus one, for edge identifiers
+    :param bounds: cell_bounds(block), when tracing several levels
+    :return: Segment end keys (n, 2) and points (n, 2, 2) in grid coordinates
+    """
+    tl, tr, br, bl = block[:-1, :-1], block[:-1, 1:], block[1:, 1:], block[1:, :-1]
+    low, high = bounds or cell_bounds(block)
+    rows, cols = np.nonzero((low < level) & (high >= level))
+    tl, tr, br, bl = tl[rows, cols], tr[rows, cols], br[rows, cols], bl[rows, cols]
+    case = ((tl >= level) * 8 + (tr >= level) * 4 +
+            (br >= level) * 2 + (bl >= level)).astype(np.int8)
+    centre_high = ((tl + tr + br + bl) / 4 >= level).astype(np.int8)
+    rows = rows + row0
+    cols = cols + col0
+
+    keys, points = [], []
+    for slot in (0, 1):
+        edges = SEGMENT_TABLE[centre_high, slot, case]
+        present = edges[:, 0] >= 0
+        if not present.any():
+            continue
+        args = [a[present] for a in (rows, cols, tl, tr, br, bl)]
+        ends = [edges[present, end] for end in (0, 1)]
+        keys.append(np.column_stack([_edge_keys(e, args[0], args[1], stride) for e in ends]))
+        points.append(np.stack([_edge_points(e, *args, level) for e in ends], axis=1))
+    if not keys:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, 2, 2))
+    return np.vstack(keys), np.vstack(points)
+
+
+def join_pieces(pieces):
+    """
+    Join pieces of lines sharing end keys into the longest possible lines
+
+    :param pieces: List of (start key, end key, points)
+    :return: List of (start key, end key, points); start == end for closed lines
+    """
+    ends = {}
+    for i, (start, end, _) in enumerate(pieces):
+        ends.setdefault(start, []).append(i)
+        ends.setdefault(end, []).append(i)
+    used = [False] * len(pieces)
+
+    def extend(key, stop):
+        chain = []
+        while key != stop:
+            following = next((j for j in ends[key] if not used[j]), None)
+            if following is None:
+                break
+            used[following] = True
+            start, end, points = pieces[following]
+            if start == key:
+                chain.append(points[1:])
+                key = end
+            else:
+                chain.append(points[::-1][1:])
+                key = start
+        return key, chain
+
+    joined = []
+    for i, (start, end, points) in enumerate(pieces):
+        if used[i]:
+            continue
+        used[i] = True
+        end, forward = extend(end, start)
+        if end == start:
+            joined.append((start, end, np.vstack([points] + forward)))
+            continue
+        start, backward = extend(start, end)
+        parts = [p[::-1] for p in reversed(backward)] + [points] + forward
+        joined.append((start, end, np.vstack(parts)))
+    return joined
+
+
+def contour_tile(path, levels, row0, col0, height, width):
+    """
+    Contours of one tile of a .npy heightmap, joined within the tile
+
+    The tile reads one more row and column than it owns, so neighbouring
+    tiles trace the cells between them once and meet on the same edges.
+    """
+    heights = np.load(path, mmap_mode="r")
+    block = np.asarray(heights[row0:row0 + height + 1, col0:col0 + width + 1], dtype=np.float64)
+    stride = heights.shape[1] + 1
+    bounds = cell_bounds(block)
+    lowest, highest = bounds[0].min(), bounds[1].max()
+    result = {}
+    for level in levels:
+        if not lowest < level <= highest:
+            continue
+        keys, points = march(block, level, row0, col0, stride, bounds)
+        if len(keys):
+            pieces = [(a, b, p) for (a, b), p in zip(keys.tolist(), points)]
+            result[level] = join_pieces(pieces)
+    return result
+
+
+def trace_contours(path, levels, cell_size=1.0, tile=TILE, workers=None):
+    """
+    Contour lines of a heightmap for every level, tiles traced in parallel
+
+    :param path: Heightmap .npy file, as written by terrain.generate_heightmap
+    :return: List of Contour, in scene coordinates
+    """
+    shape = np.load(path, mmap_mode="r").shape
+    jobs = [(row0, col0, min(tile, shape[0] - 1 - row0), min(tile, shape[1] - 1 - col0))
+            for row0 in range(0, shape[0] - 1, tile) for col0 in range(0, shape[1] - 1, tile)]
+    levels = [float(level) for level in levels]
+    pieces = {level: [] for level in levels}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(contour_tile, path, levels, *job) for job in jobs]
+        for future in futures:
+            for level, tile_pieces in future.result().items():
+                pieces[level].extend(tile_pieces)
+
+    contours = []
+    for level in levels:
+        # Closed lines are done, open ones may go on in a neighbouring tile
+        for start, end, points in join_pieces(pieces[level]):
+            # Samples are at cell centres
+            scene = (points + 0.5) * cell_size
+            contours.append(Contour(level, scene, start == end))
+    return contours
+
+
+def contour_levels(heights, interval, base=0.0):
+    """Levels every interval metres over the range of a heightmap"""
+    low = math.ceil((float(np.min(heights)) - base) / interval)
+    high = math.floor((float(np.max(heights)) - base) / interval)
+    return [base + i * interval for i in range(low, high + 1)]
+
+
+class ContourSet:
+    """
+    Contours at a level of detail for each zoom
+
+    Below min_minor_scale only index contours are kept. Lines are simplified
+    to half a pixel at the zoom asked for, and the result is cached per zoom
+    bucket, so each bucket is computed once.
+    """
+
+    def __init__(self, contours, interval, min_minor_scale=0.5, tolerance_pixels=0.5):
+        self.contours = contours
+        self.interval = interval
+        self.min_minor_scale = min_minor_scale
+        self.tolerance_pixels = tolerance_pixels
+        self.buckets = {}
+        self.account = memory_budget.register("contours", self._evict, NORMAL)
+
+    def is_index(self, contour) -> bool:
+        return round(contour.level / self.interval) % INDEX_EVERY == 0
+
+    def at_scale(self, scale: float):
+        bucket = math.floor(math.log2(scale))
+        cached = self.buckets.get(bucket)
+        if cached is None:
+            # Simplify for the most detailed scale of the bucket
+            tolerance = self.tolerance_pixels / 2 ** (bucket + 1)
+            cached = []
+            for contour in self.contours:
+                if 2 ** bucket < self.min_minor_scale and not self.is_index(contour):
+                    continue
+                points = simplify(contour.points, tolerance)
+                if len(points) >= 2:
+                    cached.append(Contour(contour.level, points, contour.closed))
+            self.buckets[bucket] = cached
+            self.account.charge(bucket, sum(array_bytes(c.points) for c in cached))
+        else:
+            self.account.touch(bucket)
+        return cached
+
+    def _evict(self, bucket: int):
+        self.buckets.pop(bucket, None)
+
+    def strokes(self, scale=1.0, color="#8b5a2b", width=0.5, index_width=1.2):
+        """Contours at a zoom as map document strokes"""
+        strokes = []
+        for contour in self.at_scale(scale):
+            points = contour.points
+            if contour.closed:
+                points = np.vstack((points, points[:1]))
+            strokes.append(Stroke([tuple(p) for p in points.tolist()], color,
+                                  index_width if self.is_index(contour) else width))
+        return strokes
+
+
+def hillshade(block, cell_metres, azimuth=315.0, altitude=45.0, z_factor=1.0):
+    """
+    Shading of a block of heights, lit from azimuth degrees clockwise from north
+
+    The block's outer rows and columns are only used for gradients: the result
+    is two cells smaller on each axis, so blocks read with a halo of one join.
+    """
+    dz_dy, dz_dx = np.gradient(block.astype(np.float32) * z_factor, cell_metres)
+    dz_dy, dz_dx = dz_dy[1:-1, 1:-1], dz_dx[1:-1, 1:-1]
+    zenith = math.radians(90.0 - altitude)
+    # Rows grow southwards, so the light direction has its y flipped
+    light = math.radians(360.0 - azimuth + 90.0)
+    slope = np.arctan(np.hypot(dz_dx, dz_dy))
+    aspect = np.arctan2(dz_dy, -dz_dx)
+    shade = (math.cos(zenith) * np.cos(slope) +
+             math.sin(zenith) * np.sin(slope) * np.cos(light - aspect))
+    return (np.clip(shade, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+def _padded_block(heights, row0, col0, rows, cols):
+    """Heights of a window with a one-cell halo, edges repeated at the map border"""
+    top, left = max(0, row0 - 1), max(0, col0 - 1)
+    bottom = min(heights.shape[0], row0 + rows + 1)
+    right = min(heights.shape[1], col0 + cols + 1)
+    block = np.asarray(heights[top:bottom, left:right])
+    return np.pad(block, ((int(row0 == 0), row0 + rows + 1 - bottom),
+                          (int(col0 == 0), col0 + cols + 1 - right)), mode="edge")
+
+
+def _gray_image(shade):
+    from PyQt6.QtGui import QImage
+    shade = np.ascontiguousarray(shade)
+    height, width = shade.shape
+    return QImage(shade.data, width, height, width, QImage.Format.Format_Grayscale8).copy()
+
+
+def _hillshade_tiles(path, tiles, output_dir, zoom, cell_size, tile_size, cell_metres):
+    heights = np.load(path, mmap_mode="r")
+    # Cells covered by a tile, sampled down to its pixels when zoomed out
+    span = tile_size / 2 ** zoom / cell_size
+    written = 0
+    for x, y in tiles:
+        row0, col0 = int(y * span), int(x * span)
+        rows = min(heights.shape[0], int((y + 1) * span)) - row0
+        cols = min(heights.shape[1], int((x + 1) * span)) - col0
+        if rows <= 0 or cols <= 0:
+            continue
+        shade = hillshade(_padded_block(heights, row0, col0, rows, cols), cell_metres)
+        pixels = np.minimum((np.arange(tile_size) * span / tile_size).astype(int), rows - 1)
+        columns = np.minimum((np.arange(tile_size) * span / tile_size).astype(int), cols - 1)
+        directory = os.path.join(output_dir, str(zoom), str(x))
+        os.makedirs(directory, exist_ok=True)
+        if _gray_image(shade[pixels][:, columns]).save(os.path.join(directory, f"{y}.png")):
+            written += 1
+    return written
+
+
+def write_hillshade_tiles(path, output_dir, zoom, cell_size=1.0, tile_size=256,
+                          cell_metres=100.0, workers=None):
+    """
+    Hillshade tiles of a heightmap at one zoom, in tile_export's z/x/y layout
+
+    :return: Number of tiles written
+    """
+    shape = np.load(path, mmap_mode="r").shape
+    span = tile_size / 2 ** zoom / cell_size
+    tiles = [(x, y) for y in range(math.ceil(shape[0] / span))
+             for x in range(math.ceil(shape[1] / span))]
+    batches = [tiles[i:i + 64] for i in range(0, len(tiles), 64)]
+    # Qt does not survive fork(), every worker starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as pool:
+        futures = [pool.submit(_hillshade_tiles, path, batch, output_dir, zoom, cell_size,
+                               tile_size, cell_metres) for batch in batches]
+        return sum(future.result() for future in futures)
+
+
+def write_hillshade_raster(path, image_path, cell_metres=100.0, block_rows=1024):
+    """Whole-map hillshade, one pixel per cell, to use as a document's raster"""
+    from PyQt6.QtGui import QImage, QPainter
+    heights = np.load(path, mmap_mode="r")
+    image = QImage(heights.shape[1], heights.shape[0], QImage.Format.Format_Grayscale8)
+    painter = QPainter(image)
+    for row0 in range(0, heights.shape[0], block_rows):
+        rows = min(block_rows, heights.shape[0] - row0)
+        block = _padded_block(heights, row0, 0, rows, heights.shape[1])
+        painter.drawImage(0, row0, _gray_image(hillshade(block, cell_metres)))
+    painter.end()
+    return image.save(image_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contours and hillshading of a heightmap")
+    parser.add_argument("heightmap", help="Heightmap (.npy, metres)")
+    parser.add_argument("output", help="Map document receiving the contours (JSON)")
+    parser.add_argument("--interval", type=float, default=250.0, help="Metres between levels")
+    parser.add_argument("--cell-size", type=float, default=1.0, help="Scene units per cell")
+    parser.add_argument("--cell-metres", type=float, default=100.0, help="Ground size of a cell")
+    parser.add_argument("--scale", type=float, default=1.0, help="Zoom the strokes are made for")
+    parser.add_argument("--raster", help="Also write a hillshade image as the map's raster")
+    parser.add_argument("--hillshade", help="Also write hillshade tiles to this directory")
+    parser.add_argument("--zoom", type=int, default=0, help="Zoom of the hillshade tiles")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.raster and args.cell_size != 1.0:
+        # Rasters are drawn one pixel per scene unit
+        parser.error("--raster needs a cell size of 1")
+
+    heights = np.load(args.heightmap, mmap_mode="r")
+    start = time.perf_counter()
+    levels = contour_levels(heights, args.interval)
+    contours = trace_contours(args.heightmap, levels, args.cell_size, workers=args.workers)
+    print(f"{len(contours)} contours on {len(levels)} levels "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    document = MapDocument(strokes=ContourSet(contours, args.interval).strokes(args.scale))
+    if args.raster:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt6.QtGui import QGuiApplication
+        app = QGuiApplication.instance() or QGuiApplication([])
+        write_hillshade_raster(args.heightmap, args.raster, args.cell_metres)
+        document.raster = Raster(os.path.relpath(args.raster, os.path.dirname(
+            os.path.abspath(args.output))))
+    save_map(document, args.output)
+
+    if args.hillshade:
+        start = time.perf_counter()
+        written = write_hillshade_tiles(args.heightmap, args.hillshade, args.zoom,
+                                        args.cell_size, cell_metres=args.cell_metres,
+                                        workers=args.workers)
+        print(f"{written} hillshade tiles in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
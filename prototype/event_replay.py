@@ -0,0 +1,200 @@
+"""
+Recording and replay of the input events a drawing view consumes
+
+Mouse and wheel events are stored in scene coordinates, so a session replays
+onto the same map positions whatever the window size. Replays can run at full
+speed or with the recorded timing, and under the profiler:
+
+    python event_replay.py record scene session.jsonl
+    python event_replay.py replay scene session.jsonl --profile trace.json
+"""
+import argparse
+import json
+import sys
+import time
+
+from PyQt6.QtWidgets import QApplication, QGraphicsView
+from PyQt6.QtCore import Qt, QObject, QEvent, QPoint, QPointF
+from PyQt6.QtGui import QMouseEvent, QWheelEvent, QTransform
+
+RECORDED_EVENTS = {
+    QEvent.Type.MouseButtonPress: "press",
+    QEvent.Type.MouseMove: "move",
+    QEvent.Type.MouseButtonRelease: "release",
+    QEvent.Type.Wheel: "wheel",
+}
+EVENT_TYPES = {name: event_type for event_type, name in RECORDED_EVENTS.items()}
+
+
+def send_mouse(view, event_type, pos, button=Qt.MouseButton.LeftButton,
+               modifiers=Qt.KeyboardModifier.NoModifier, buttons=None):
+    """Deliver a mouse event to a view as if it came from the window system"""
+    if buttons is None:
+        buttons = button if event_type != QEvent.Type.MouseButtonRelease else Qt.MouseButton.NoButton
+    local = QPointF(pos)
+    event = QMouseEvent(event_type, local, view.viewport().mapToGlobal(local),
+                        button, buttons, modifiers)
+    QApplication.sendEvent(view.viewport(), event)
+
+
+def send_wheel(view, pos, delta, modifiers=Qt.KeyboardModifier.NoModifier):
+    local = QPointF(pos)
+    event = QWheelEvent(local, view.viewport().mapToGlobal(local), QPoint(), QPoint(0, delta),
+                        Qt.MouseButton.NoButton, modifiers, Qt.ScrollPhase.NoScrollPhase, False)
+    QApplication.sendEvent(view.viewport(), event)
+
+
+def view_state(view):
+    """Transform and scene centre of a view, to start a replay from the same place"""
+    t = view.transform()
+    centre = view.mapToScene(view.viewport().rect().center())
+    return {"transform": [t.m11(), t.m12(), t.m21(), t.m22()],
+            "centre": [centre.x(), centre.y()]}
+
+
+def restore_view_state(view, state):
+    m11, m12, m21, m22 = state["transform"]
+    view.setTransform(QTransform(m11, m12, m21, m22, 0, 0))
+    view.centerOn(QPointF(*state["centre"]))
+
+
+class EventRecorder(QObject):
+    """
+    Event filter storing the mouse and wheel events reaching a view
+
+    When the view's scene has a mode (draw, edit, remove), it is stored with
+    each event since the buttons changing it are outside the view.
+    """
+
+    def __init__(self, view: QGraphicsView):
+        super().__init__(view)
+        self.view = view
+        self.start = time.perf_counter()
+        self.header = {"view": view_state(view)}
+        self.events = []
+        view.viewport().installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        name = RECORDED_EVENTS.get(event.type())
+        if name is None:
+            return False
+        pos = self.view.mapToScene(event.position().toPoint())
+        record = {
+            "t": time.perf_counter() - self.start,
+            "type": name,
+            "scene": [pos.x(), pos.y()],
+            "modifiers": event.modifiers().value,
+        }
+        if name == "wheel":
+            record["delta"] = event.angleDelta().y()
+        else:
+            record["button"] = event.button().value
+            record["buttons"] = event.buttons().value
+        mode = getattr(QGraphicsView.scene(self.view), "mode", None)
+        if mode is not None:
+            record["mode"] = mode
+        self.events.append(record)
+        return False
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(json.dumps(self.header) + "\n")
+            for record in self.events:
+                f.write(json.dumps(record) + "\n")
+
+
+def load_session(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def replay(view: QGraphicsView, header, events, original_timing=False, speed=1.0,
+           repaint=True):
+    """
+    Feed a recorded session back to a view
+
+    :param original_timing: Wait between events as the user did, scaled by speed
+    :param repaint: Paint after each event, as the window system would have
+    :return: Seconds taken by the replay
+    """
+    app = QApplication.instance()
+    restore_view_state(view, header["view"])
+    app.processEvents()
+    scene = QGraphicsView.scene(view)
+
+    start = time.perf_counter()
+    for record in events:
+        if original_timing:
+            wait = record["t"] / speed - (time.perf_counter() - start)
+            while wait > 0:
+                app.processEvents()
+                time.sleep(min(wait, 0.005))
+                wait = record["t"] / speed - (time.perf_counter() - start)
+        if "mode" in record:
+            scene.mode = record["mode"]
+
+        pos = view.mapFromScene(QPointF(*record["scene"]))
+        modifiers = Qt.KeyboardModifier(record["modifiers"])
+        if record["type"] == "wheel":
+            send_wheel(view, pos, record["delta"], modifiers)
+        else:
+            send_mouse(view, EVENT_TYPES[record["type"]], pos,
+                       Qt.MouseButton(record["button"]), modifiers,
+                       Qt.MouseButton(record["buttons"]))
+        if repaint:
+            view.viewport().repaint()
+    return time.perf_counter() - start
+
+
+def make_target(name):
+    """Prototype window for a target, and the view to record or replay on"""
+    if name == "canvas":
+        from prototype_loader import load_prototype
+        module = load_prototype("vector-zooming-efficient-memory")
+        window = module.DrawingWindow()
+        return window, window.canvas, ()
+    if name == "view":
+        import keep_same_width
+        window = keep_same_width.MainWindow()
+        return window, window.drawing_view, (keep_same_width.VectorLine,)
+    import complex_editable
+    window = complex_editable.MainWindow()
+    return window, window.view, (complex_editable.FigureGraphicsItem,)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record or replay drawing sessions")
+    parser.add_argument("action", choices=("record", "replay"))
+    parser.add_argument("target", choices=("canvas", "view", "scene"))
+    parser.add_argument("session", help="Session file (JSON lines)")
+    parser.add_argument("--original-timing", action="store_true")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--profile", help="Profile the replay and write a trace here")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    window, view, classes = make_target(args.target)
+    window.resize(1000, 800)
+    window.show()
+    app.processEvents()
+
+    if args.action == "record":
+        recorder = EventRecorder(view)
+        app.exec()
+        recorder.save(args.session)
+        print(f"{len(recorder.events)} events recorded")
+        return
+
+    if args.profile:
+        import instrumentation
+        instrumentation.install(view, classes, overlay=False)
+    header, events = load_session(args.session)
+    elapsed = replay(view, header, events, args.original_timing, args.speed)
+    print(f"{len(events)} events replayed in {elapsed:.3f}s")
+    if args.profile:
+        instrumentation.profiler.dump(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import sys
+from PyQt6.QtWidgets import QApplication, QPushButton
+from PyQt6.QtGui import QColor, QBrush
+
+import complex_editable
+from complex_editable import FigureGraphicsItem, DrawingScene
+from polygon_geometry import Polygon, RegionIndex
+
+
+class FilledFigureGraphicsItem(FigureGraphicsItem):
+    """Figure that is filled once closed and answers region queries"""
+
+    def __init__(self, fill=QColor(120, 180, 120, 120)):
+        super().__init__()
+        self.fill = fill
+        self._polygon = None
+
+    def update_path(self):
+        dirty = super().update_path()
+        if dirty.isEmpty():
+            # The outline didn't move, the cached geometry still holds
+            return dirty
+        self._polygon = None
+        if self.is_closed:
+            self.setBrush(QBrush(self.fill))
+            scene = self.scene()
+            if isinstance(scene, RegionScene):
+                scene.outline_changed(self)
+        return dirty
+
+    @property
+    def polygon(self):
+        """Polygon of a closed figure, rebuilt only after an edit"""
+        if not self.is_closed:
+            return None
+        if self._polygon is None:
+            self._polygon = Polygon([(p.x(), p.y()) for p in self.points])
+        return self._polygon
+
+    @property
+    def area(self):
+        return self.polygon.area if self.is_closed else 0.0
+
+
+class RegionScene(DrawingScene):
+    """DrawingScene whose closed figures are filled regions"""
+
+    def __init__(self):
+        super().__init__()
+        self.regions = RegionIndex()
+
+    def mousePressEvent(self, event):
+        pos = event.scenePos()
+        if self.mode == "draw" and not self.current_figure:
+            self.current_figure = FilledFigureGraphicsItem()
+            self.addItem(self.current_figure)
+            self.current_figure.add_point(pos)
+            return
+
+        figure = self.current_figure
+        if self.mode == "query":
+            key = self.regions.region_at(pos.x(), pos.y())
+            if key is not None:
+                print(f"Region {key}: area {self.regions.polygons[key].area:.1f}")
+            return
+
+        super().mousePressEvent(event)
+
+        # Register the figure the click just closed
+        if figure is not None and figure.is_closed:
+            self.regions.add(id(figure), figure.polygon)
+            for key in self.regions.overlapping(figure.polygon):
+                if key != id(figure):
+                    print(f"Region {id(figure)} overlaps region {key}")
+
+    def outline_changed(self, figure):
+        """Keep the region index in step with an edited outline"""
+        if id(figure) in self.regions.polygons:
+            self.regions.add(id(figure), figure.polygon)
+
+    def removeItem(self, item):
+        if isinstance(item, FilledFigureGraphicsItem):
+            self.regions.remove(id(item))
+        super().removeItem(item)
+
+
+class MainWindow(complex_editable.MainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Filled Regions")
+        self.scene = RegionScene()
+        self.scene.setSceneRect(0, 0, 780, 520)
+        self.view.setScene(self.scene)
+
+        query_button = QPushButton("Query Mode")
+        query_button.clicked.connect(lambda: self.set_mode("query"))
+        self.centralWidget().layout().addWidget(query_button)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
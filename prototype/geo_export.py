@@ -0,0 +1,443 @@
+"""
+Streaming export of a map's vector layers to SVG and GeoJSON
+
+The writers are generators of text chunks: a shape is clipped, simplified
+and formatted only when the file is ready to receive it, so the output never
+has to exist in memory. export_map reads the map the same way, through a
+StreamedMap, so neither does the input. Layers can also be serialized in parallel, each by
+its own process into a part file, the parts being joined in layer order.
+
+    python geo_export.py map.json map.svg --region 0 0 2000 1000 --resolution 0.5
+"""
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+from map_document import StreamedMap, element_anchor, element_to_dict, map_elements
+from projection import PROJECTIONS
+from spatial_index import bbox_intersects
+
+LAYERS = ("figures", "strokes", "elements")
+
+
+def clip_polyline(points: np.ndarray, rect) -> list:
+    """
+    Pieces of a polyline inside a rectangle (min_x, min_y, max_x, max_y)
+
+    Liang-Barsky on every segment at once; consecutive segments that stay
+    inside are joined back into a single piece.
+    """
+    if len(points) < 2:
+        return []
+    start, end = points[:-1], points[1:]
+    delta = end - start
+    t0 = np.zeros(len(start))
+    t1 = np.ones(len(start))
+    visible = np.ones(len(start), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p, q in ((-delta[:, 0], start[:, 0] - rect[0]), (delta[:, 0], rect[2] - start[:, 0]),
+                     (-delta[:, 1], start[:, 1] - rect[1]), (delta[:, 1], rect[3] - start[:, 1])):
+            parallel = p == 0
+            visible &= ~(parallel & (q < 0))
+            t = q / p
+            t0 = np.where(~parallel & (p < 0), np.maximum(t0, t), t0)
+            t1 = np.where(~parallel & (p > 0), np.minimum(t1, t), t1)
+    visible &= t0 <= t1
+
+    pieces = []
+    current = None
+    for i in np.flatnonzero(visible):
+        a = start[i] + t0[i] * delta[i]
+        b = start[i] + t1[i] * delta[i]
+        if current is not None and t0[i] == 0 and previous == i - 1 and t1[previous] == 1:
+            current.append(b)
+        else:
+            if current is not None:
+                pieces.append(np.array(current))
+            current = [a, b]
+        previous = i
+    if current is not None:
+        pieces.append(np.array(current))
+    return pieces
+
+
+def clip_polygon(points: np.ndarray, rect) -> np.ndarray:
+    """Sutherland-Hodgman clipping of a closed ring, each rectangle side at once"""
+    # (axis, bound, keep the side above the bound)
+    for axis, bound, above in ((0, rect[0], True), (0, rect[2], False),
+                               (1, rect[1], True), (1, rect[3], False)):
+        if not len(points):
+            break
+        previous = np.roll(points, 1, axis=0)
+        inside = points[:, axis] >= bound if above else points[:, axis] <= bound
+        previous_inside = np.roll(inside, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (bound - previous[:, axis]) / (points[:, axis] - previous[:, axis])
+            crossing = previous + t[:, None] * (points - previous)
+        # Each vertex contributes the crossing of its incoming edge, then itself
+        candidates = np.stack((crossing, points), axis=1).reshape(-1, 2)
+        keep = np.stack((inside != previous_inside, inside), axis=1).reshape(-1)
+        points = candidates[keep]
+    return points
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker simplification, keeping points further than tolerance"""
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        inner = points[first + 1:last]
+        direction = b - a
+        length = math.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distances = np.abs(direction[0] * (inner[:, 1] - a[1]) -
+                               direction[1] * (inner[:, 0] - a[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return points[keep]
+
+
+class ShapeFilter:
+    """
+    Clipping and simplification shared by the writers
+
+    :param region: Scene rectangle (x, y, width, height), or None for everything
+    :param resolution: Scene units per output pixel; details smaller are simplified away
+    """
+
+    def __init__(self, region=None, resolution=0.0):
+        self.rect = None
+        if region is not None:
+            x, y, width, height = region
+            self.rect = (x, y, x + width, y + height)
+        self.resolution = resolution
+        # Enough decimals for the resolution, no more
+        self.decimals = max(0, math.ceil(-math.log10(resolution)) + 1) if resolution > 0 else 6
+
+    def visible(self, bbox) -> bool:
+        return self.rect is None or bbox_intersects(bbox, self.rect)
+
+    def polyline(self, points) -> list:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        pieces = clip_polyline(points, self.rect) if self.rect else [points]
+        return [p for p in (simplify(piece, self.resolution) for piece in pieces) if len(p) >= 2]
+
+    def ring(self, points) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) > 1 and np.array_equal(points[0], points[-1]):
+            points = points[:-1]
+        if self.rect:
+            points = clip_polygon(points, self.rect)
+        if len(points) >= 3:
+            # Simplify as a closed line, so the seam can go too
+            points = simplify(np.vstack((points, points[:1])), self.resolution)[:-1]
+        return points if len(points) >= 3 else None
+
+    def figure(self, figure) -> list:
+        """Rings of a closed figure, or pieces of an open one"""
+        if figure.is_closed:
+            ring = self.ring(figure.points)
+            return [] if ring is None else [ring]
+        return self.polyline(figure.points)
+
+
+def _number(value, decimals):
+    text = f"{value:.{decimals}f}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def _svg_points(points, decimals):
+    return " ".join(f"{_number(x, decimals)},{_number(y, decimals)}" for x, y in points)
+
+
+def svg_layer(document, layer, shapes: ShapeFilter):
+    """SVG elements of one layer, one chunk per shape"""
+    d = shapes.decimals
+    if layer == "figures":
+        for figure in document.figures:
+            if not shapes.visible(figure.bbox()):
+                continue
+            style = (f'stroke={quoteattr(figure.color)} stroke-width="{figure.width}" '
+                     f'fill={quoteattr(figure.fill or "none")}')
+            tag = "polygon" if figure.is_closed else "polyline"
+            for part in shapes.figure(figure):
+                yield f'<{tag} points="{_svg_points(part, d)}" {style}/>\n'
+    elif layer == "strokes":
+        for stroke in document.strokes:
+            if not shapes.visible(stroke.bbox()):
+                continue
+            for part in shapes.polyline(stroke.points):
+                yield (f'<polyline points="{_svg_points(part, d)}" fill="none" '
+                       f'stroke={quoteattr(stroke.color)} stroke-width="{stroke.width}" '
+                       f'stroke-linecap="round" stroke-linejoin="round"/>\n')
+    elif layer == "elements":
+        for element in document.elements:
+            if isinstance(element, map_elements.Biome):
+                ring = shapes.ring([(c.x, c.y) for c in element.coordinates]) \
+                    if len(element.coordinates) >= 3 else None
+                if ring is not None:
+                    yield (f'<polygon points="{_svg_points(ring, d)}" fill="none" '
+                           f'stroke="#808080"><title>{escape(element.name)}</title></polygon>\n')
+                continue
+            x, y = element_anchor(element)
+            if not shapes.visible((x, y, x, y)):
+                continue
+            x, y = _number(x, d), _number(y, d)
+            yield (f'<circle cx="{x}" cy="{y}" r="2"/>'
+                   f'<text x="{x}" y="{y}" dx="4" dy="-4">{escape(element.name)}</text>\n')
+
+
+def svg_chunks(document, layers=LAYERS, shapes=None):
+    """A whole SVG file, as a generator of text chunks"""
+    shapes = shapes or ShapeFilter()
+    yield from svg_header(document, shapes)
+    for layer in layers:
+        yield f'<g id="{layer}">\n'
+        yield from svg_layer(document, layer, shapes)
+        yield "</g>\n"
+    yield "</svg>\n"
+
+
+def svg_header(document, shapes: ShapeFilter):
+    if shapes.rect:
+        x0, y0, x1, y1 = shapes.rect
+    else:
+        # One shape at a time, the document may be streamed
+        x0 = y0 = math.inf
+        x1 = y1 = -math.inf
+        boxes = itertools.chain(
+            (shape.bbox() for shapes in (document.strokes, document.figures) for shape in shapes),
+            ((c.x, c.y, c.x, c.y) for e in document.elements for c in e.coordinates))
+        for bx0, by0, bx1, by1 in boxes:
+            x0, y0, x1, y1 = min(x0, bx0), min(y0, by0), max(x1, bx1), max(y1, by1)
+        if x0 > x1:
+            x0 = y0 = x1 = y1 = 0
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x0} {y0} {x1 - x0} {y1 - y0}" '
+           'font-family="sans-serif" font-size="9">\n')
+
+
+class GeoJSONFormatter:
+    """Scene points to GeoJSON positions, back through the map's projection if any"""
+
+    def __init__(self, projection=None, decimals=6):
+        self.projection = projection
+        self.decimals = decimals
+
+    def positions(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.projection is not None:
+            points = self.projection.to_geographic(points[:, 0], points[:, 1])
+        d = self.decimals
+        return "[" + ",".join(f"[{_number(x, d)},{_number(y, d)}]" for x, y in points) + "]"
+
+    def ring(self, points):
+        points = np.asarray(points)
+        return self.positions(np.vstack((points, points[:1])))
+
+
+def _feature(geometry_type, coordinates, properties):
+    return (f'{{"type":"Feature","geometry":{{"type":"{geometry_type}",'
+            f'"coordinates":{coordinates}}},"properties":{json.dumps(properties)}}}')
+
+
+def geojson_layer(document, layer, shapes: ShapeFilter, formatter: GeoJSONFormatter):
+    """GeoJSON features of one layer, one chunk per feature"""
+    if layer == "figures":
+        for figure in document.figures:
+            if not shapes.visible(figure.bbox()):
+                continue
+            properties = {"layer": layer, "stroke": figure.color,
+                          "stroke-width": figure.width}
+            parts = shapes.figure(figure)
+            if not parts:
+                continue
+            if figure.is_closed:
+                if figure.fill:
+                    properties["fill"] = figure.fill
+                yield _feature("MultiPolygon",
+                               "[" + ",".join(f"[{formatter.ring(p)}]" for p in parts) + "]",
+                               properties)
+            else:
+                yield _feature("MultiLineString",
+                               "[" + ",".join(formatter.positions(p) for p in parts) + "]",
+                               properties)
+    elif layer == "strokes":
+        for stroke in document.strokes:
+            if not shapes.visible(stroke.bbox()):
+                continue
+            parts = shapes.polyline(stroke.points)
+            if parts:
+                yield _feature("MultiLineString",
+                               "[" + ",".join(formatter.positions(p) for p in parts) + "]",
+                               {"layer": layer, "stroke": stroke.color,
+                                "stroke-width": stroke.width})
+    elif layer == "elements":
+        for element in document.elements:
+            properties = element_to_dict(element)
+            del properties["coordinates"]
+            properties["layer"] = layer
+            if isinstance(element, map_elements.Biome):
+                ring = shapes.ring([(c.x, c.y) for c in element.coordinates]) \
+                    if len(element.coordinates) >= 3 else None
+                if ring is not None:
+                    yield _feature("Polygon", f"[{formatter.ring(ring)}]", properties)
+                continue
+            x, y = element_anchor(element)
+            if shapes.visible((x, y, x, y)):
+                yield _feature("Point", formatter.positions([(x, y)])[1:-1], properties)
+
+
+def geojson_chunks(document, layers=LAYERS, shapes=None, formatter=None):
+    """A whole FeatureCollection, as a generator of text chunks"""
+    shapes = shapes or ShapeFilter()
+    formatter = formatter or GeoJSONFormatter()
+    yield '{"type":"FeatureCollection","features":[\n'
+    first = True
+    for layer in layers:
+        for feature in geojson_layer(document, layer, shapes, formatter):
+            yield feature if first else ",\n" + feature
+            first = False
+    yield "\n]}\n"
+
+
+def write_chunks(chunks, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+# Per-process state, set up once by the pool initializer
+_document = None
+
+
+def _init_worker(map_path):
+    global _document
+    _document = StreamedMap(map_path)
+
+
+def _make_filters(region, resolution, projection_name, scene_scale):
+    shapes = ShapeFilter(region, resolution)
+    projection = PROJECTIONS[projection_name](scene_scale=scene_scale) \
+        if projection_name else None
+    # Geographic output needs its own precision, about a centimetre
+    formatter = GeoJSONFormatter(projection, 7 if projection else shapes.decimals)
+    return shapes, formatter
+
+
+def _write_layer(layer, path, output_format, region, resolution, projection_name, scene_scale):
+    """Serialize one layer into a part file, returns whether it has content"""
+    shapes, formatter = _make_filters(region, resolution, projection_name, scene_scale)
+    written = False
+    with open(path, "w", encoding="utf-8") as f:
+        if output_format == "svg":
+            chunks = svg_layer(_document, layer, shapes)
+        else:
+            chunks = (feature if i == 0 else ",\n" + feature for i, feature in
+                      enumerate(geojson_layer(_document, layer, shapes, formatter)))
+        for chunk in chunks:
+            f.write(chunk)
+            written = True
+    return written
+
+
+def export_map(map_path, output, output_format=None, layers=LAYERS, region=None,
+               resolution=0.0, projection_name=None, scene_scale=1e-3, workers=1):
+    """
+    Export the vector layers of a map document
+
+    :param output_format: "svg" or "geojson", guessed from the output name by default
+    :param projection_name: Projection the scene is in, to write longitudes and
+                            latitudes to GeoJSON instead of scene coordinates
+    :param workers: Processes serializing layers in parallel
+    """
+    if output_format is None:
+        output_format = "svg" if output.lower().endswith(".svg") else "geojson"
+    if workers <= 1:
+        _init_worker(map_path)
+        shapes, formatter = _make_filters(region, resolution, projection_name, scene_scale)
+        if output_format == "svg":
+            write_chunks(svg_chunks(_document, layers, shapes), output)
+        else:
+            write_chunks(geojson_chunks(_document, layers, shapes, formatter), output)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        parts = [os.path.join(directory, f"{layer}.part") for layer in layers]
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(layers)), mp_context=context,
+                                 initializer=_init_worker, initargs=(map_path,)) as pool:
+            has_content = list(pool.map(
+                _write_layer, layers, parts, [output_format] * len(layers),
+                [region] * len(layers), [resolution] * len(layers),
+                [projection_name] * len(layers), [scene_scale] * len(layers)))
+
+        with open(output, "w", encoding="utf-8") as f:
+            if output_format == "svg":
+                # The header needs the document's extent only without a region
+                document = StreamedMap(map_path) if region is None else None
+                f.writelines(svg_header(document, ShapeFilter(region, resolution)))
+            else:
+                f.write('{"type":"FeatureCollection","features":[\n')
+            first = True
+            for layer, part, content in zip(layers, parts, has_content):
+                if output_format == "svg":
+                    f.write(f'<g id="{layer}">\n')
+                elif content and not first:
+                    f.write(",\n")
+                first = first and not content
+                with open(part, encoding="utf-8") as layer_file:
+                    shutil.copyfileobj(layer_file, f)
+                if output_format == "svg":
+                    f.write("</g>\n")
+            f.write("</svg>\n" if output_format == "svg" else "\n]}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a map's vector layers")
+    parser.add_argument("map", help="Map document (JSON)")
+    parser.add_argument("output", help="Output file, .svg or .geojson")
+    parser.add_argument("--format", choices=("svg", "geojson"), default=None)
+    parser.add_argument("--layers", nargs="+", choices=LAYERS, default=list(LAYERS))
+    parser.add_argument("--region", nargs=4, type=float, default=None,
+                        metavar=("X", "Y", "WIDTH", "HEIGHT"),
+                        help="Scene rectangle to clip to")
+    parser.add_argument("--resolution", type=float, default=0.0,
+                        help="Scene units per pixel of the target, for simplification")
+    parser.add_argument("--projection", choices=list(PROJECTIONS), default=None,
+                        help="Projection of the map, to write geographic GeoJSON")
+    parser.add_argument("--scene-scale", type=float, default=1e-3)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    export_map(args.map, args.output, args.format, args.layers, args.region, args.resolution,
+               args.projection, args.scene_scale, args.workers)
+    print(f"{args.output} written in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
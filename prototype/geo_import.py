@@ -0,0 +1,398 @@
+"""
+Streaming import of GeoJSON and CSV data into a map document
+
+Neither format is loaded whole: GeoJSON features are decoded one at a time
+from a sliding buffer, and CSV rows are read in chunks, whatever their
+delimiter, GeoNames dumps without a header included. Features are projected
+a batch at a time and handed to a sink, which owns where they end up; the
+DocumentSink below fills a MapDocument and its spatial indexes. Everything is
+placed in scene coordinates, elements included, like the rest of a document.
+
+    python geo_import.py places.csv coastlines.geojson --output map.json
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from map_document import MapDocument, Stroke, Figure, map_elements, save_map
+from polygon_geometry import RegionIndex, biome_polygon
+from projection import PROJECTIONS, Equirectangular, project_many
+from spatial_index import GridIndex, points_bbox
+
+CHUNK_SIZE = 1 << 20  # Characters read from a GeoJSON file at a time
+BATCH_SIZE = 2048  # Features projected together
+
+# Property names tried, in order, for each attribute
+NAME_KEYS = ("name", "NAME", "asciiname", "title")
+POPULATION_KEYS = ("population", "pop", "POP_MAX", "pop_max")
+CAPITAL_KEYS = ("is_capital", "capital")
+ELEVATION_KEYS = ("elevation", "ele", "altitude", "max_height", "dem")
+LATITUDE_KEYS = ("latitude", "lat", "y")
+LONGITUDE_KEYS = ("longitude", "lon", "lng", "x")
+KIND_KEYS = ("kind", "featureclass", "feature_class", "feature class", "fclass")
+# GeoNames feature classes: P for populated places, T for mountains and hills
+MOUNTAIN_KINDS = {"mountain", "peak", "volcano", "summit", "t"}
+CITY_KINDS = {"city", "town", "village", "p"}
+CSV_DELIMITERS = ",;\t|"
+SNIFF_SIZE = 1 << 16  # Characters of a delimited file looked at to find its delimiter
+# Columns of GeoNames dumps (allCountries.txt, cities500.txt...), which have no header
+GEONAMES_COLUMNS = ("geonameid", "name", "asciiname", "alternatenames", "latitude", "longitude",
+                    "feature class", "feature code", "country code", "cc2", "admin1 code",
+                    "admin2 code", "admin3 code", "admin4 code", "population", "elevation",
+                    "dem", "timezone", "modification date")
+GEOMETRY_TYPES = ("Point", "MultiPoint", "LineString", "MultiLineString",
+                  "Polygon", "MultiPolygon")
+
+
+class GeoImportError(ValueError):
+    pass
+
+
+def _first(properties, keys, default=None):
+    for key in keys:
+        value = properties.get(key)
+        if value not in (None, ""):
+            return value
+    return default
+
+
+def _truthy(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y", "primary", "admin-0 capital")
+    return bool(value)
+
+
+def iter_geojson_features(f, chunk_size=CHUNK_SIZE):
+    """
+    Features of a GeoJSON FeatureCollection, decoded one by one
+
+    Only the feature being decoded is held in memory, with at most one chunk
+    of text after it. Features are decoded in place from a read offset, the
+    text before it is only dropped when the next chunk is read. A lone
+    Feature or geometry is yielded as is.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    eof = not buffer
+
+    def fill(consumed):
+        """Drop the text before consumed and append a chunk, False at the end of the file"""
+        nonlocal buffer, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[consumed:] + chunk
+        return not eof
+
+    # Find the start of the features array
+    start = buffer.find('"features"')
+    while start < 0 and not eof:
+        # Keep the tail, the key may be split across chunks
+        fill(max(0, len(buffer) - 16))
+        start = buffer.find('"features"')
+    if start < 0:
+        f.seek(0)
+        data = json.load(f)
+        if data.get("type") == "Feature":
+            yield data
+        elif data.get("type") in GEOMETRY_TYPES:
+            yield {"type": "Feature", "geometry": data, "properties": {}}
+        return
+    pos = start + len('"features"')
+    while True:
+        pos = _skip(buffer, pos, " \t\r\n:")
+        if pos < len(buffer) or eof:
+            break
+        fill(pos)
+        pos = 0
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise GeoImportError("'features' is not an array")
+    pos += 1
+
+    while True:
+        pos = _skip(buffer, pos, " \t\r\n,")
+        if pos >= len(buffer):
+            if not fill(pos):
+                raise GeoImportError("Unexpected end of file in the features array")
+            pos = 0
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            feature, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The feature goes on in the next chunk
+            if not fill(pos):
+                raise
+            pos = 0
+            continue
+        yield feature
+        pos = end
+
+
+def _skip(text, pos, characters):
+    while pos < len(text) and text[pos] in characters:
+        pos += 1
+    return pos
+
+
+def iter_csv_rows(f, chunk_rows=10000, delimiter=None):
+    """
+    Rows of a delimited text file as dicts, in lists of at most chunk_rows
+
+    The delimiter is sniffed from the start of the file unless given. A file
+    whose first row names no latitude column is read with the GeoNames
+    layout if it has as many columns, it is an error otherwise.
+    """
+    if delimiter is None:
+        sample = f.read(SNIFF_SIZE)
+        f.seek(0)
+        try:
+            delimiter = csv.Sniffer().sniff(sample, CSV_DELIMITERS).delimiter
+        except csv.Error:
+            delimiter = "\t" if "\t" in sample.partition("\n")[0] else ","
+    # GeoNames quotes nothing, and its names can hold a lone quote
+    quoting = csv.QUOTE_NONE if delimiter == "\t" else csv.QUOTE_MINIMAL
+    reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
+    first = next(reader, None)
+    if first is None:
+        return
+    names = [name.strip().lower() for name in first]
+    if any(key in names for key in LATITUDE_KEYS):
+        header = first
+    elif len(first) == len(GEONAMES_COLUMNS):
+        header = GEONAMES_COLUMNS
+        reader = itertools.chain([first], reader)
+    else:
+        raise GeoImportError(f"No latitude column in the first row: {first[:8]}")
+
+    chunk = []
+    for row in reader:
+        chunk.append(dict(zip(header, row)))
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def row_to_feature(row):
+    """A CSV row with latitude and longitude columns, as a Point feature"""
+    lowered = {key.strip().lower(): value for key, value in row.items() if key}
+    try:
+        lat = float(_first(lowered, LATITUDE_KEYS))
+        lon = float(_first(lowered, LONGITUDE_KEYS))
+    except (TypeError, ValueError):
+        return None
+    return {"type": "Feature", "properties": lowered,
+            "geometry": {"type": "Point", "coordinates": [lon, lat]}}
+
+
+def feature_parts(feature):
+    """
+    Kind and lon/lat arrays of a feature's geometry
+
+    :return: List of (kind, array) with kind "point", "line" or "ring";
+             polygon holes are dropped, figures have no holes.
+    """
+    geometry = feature.get("geometry") or {}
+    kind = geometry.get("type")
+    coordinates = geometry.get("coordinates")
+    if not coordinates:
+        return []
+    if kind == "Point":
+        return [("point", np.array([coordinates[:2]], dtype=np.float64))]
+    if kind == "MultiPoint":
+        return [("point", np.array([p[:2]], dtype=np.float64)) for p in coordinates]
+    if kind == "LineString":
+        return [("line", np.array([p[:2] for p in coordinates], dtype=np.float64))]
+    if kind == "MultiLineString":
+        return [("line", np.array([p[:2] for p in line], dtype=np.float64))
+                for line in coordinates if line]
+    if kind == "Polygon":
+        return [("ring", np.array([p[:2] for p in coordinates[0]], dtype=np.float64))]
+    if kind == "MultiPolygon":
+        return [("ring", np.array([p[:2] for p in polygon[0]], dtype=np.float64))
+                for polygon in coordinates if polygon]
+    return []
+
+
+def make_element(properties, kind, points):
+    """City, Mountain or Biome for a feature part, or None if it is plain geometry"""
+    name = str(_first(properties, NAME_KEYS, "Unnamed"))
+    coordinates = [map_elements.Coordinates(float(x), float(y)) for x, y in points]
+    feature_kind = str(_first(properties, KIND_KEYS, "")).strip().lower()
+    if kind == "point":
+        elevation = _first(properties, ELEVATION_KEYS)
+        population = _first(properties, POPULATION_KEYS)
+        # Gazetteers give towns an elevation too, it only makes a mountain of an unknown place
+        if feature_kind in MOUNTAIN_KINDS or (elevation is not None and population is None
+                                              and feature_kind not in CITY_KINDS):
+            return map_elements.Mountain(name, coordinates,
+                                         map_elements.Altitude(max_height=float(elevation or 0)))
+        return map_elements.City(name, coordinates,
+                                 population=max(0, int(float(population or 0))),
+                                 is_capital=_truthy(_first(properties, CAPITAL_KEYS, False)))
+    if kind == "ring" and (feature_kind == "biome" or "climate" in properties
+                           or "terrain" in properties):
+        return map_elements.Biome(
+            name, coordinates,
+            climate=map_elements.Climate(properties.get("climate", "temperate")),
+            terrain=map_elements.TerrainType(properties.get("terrain", "flatland")))
+    return None
+
+
+class DocumentSink:
+    """
+    Receives imported features into a MapDocument, indexing them as they come
+
+    Other sinks only need the same four methods, a sink writing shards to
+    disk for instance.
+    """
+
+    def __init__(self, document=None, cell_size=256.0):
+        self.document = document or MapDocument()
+        self.stroke_index = GridIndex(cell_size)
+        self.figure_index = GridIndex(cell_size)
+        self.element_index = GridIndex(cell_size)
+        self.regions = RegionIndex(cell_size)
+
+    def add_element(self, element):
+        key = len(self.document.elements)
+        self.document.elements.append(element)
+        points = [(c.x, c.y) for c in element.coordinates]
+        self.element_index.insert(key, points_bbox(points))
+        if isinstance(element, map_elements.Biome) and len(points) >= 3:
+            self.regions.add(key, biome_polygon(element))
+
+    def add_stroke(self, stroke):
+        self.stroke_index.insert(len(self.document.strokes), stroke.bbox())
+        self.document.strokes.append(stroke)
+
+    def add_figure(self, figure):
+        self.figure_index.insert(len(self.document.figures), figure.bbox())
+        self.document.figures.append(figure)
+
+    def close(self):
+        pass
+
+
+class Importer:
+    """
+    Projects features in batches and sends them to a sink
+
+    :param projection: Projection placing geographic data in the scene
+    :param color: Colour of imported strokes and figures
+    """
+
+    def __init__(self, sink, projection=None, batch_size=BATCH_SIZE,
+                 color="#000000", width=1.0):
+        self.sink = sink
+        self.projection = projection or Equirectangular()
+        self.batch_size = batch_size
+        self.color = color
+        self.width = width
+        self.batch = []
+        self.counts = {"elements": 0, "strokes": 0, "figures": 0, "skipped": 0}
+
+    def add(self, feature):
+        parts = feature_parts(feature) if feature else []
+        if not parts:
+            self.counts["skipped"] += 1
+            return
+        self.batch.append((feature.get("properties") or {}, parts))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Project the pending features with one vectorized call and emit them"""
+        if not self.batch:
+            return
+        arrays = [array for _, parts in self.batch for _, array in parts]
+        projected = iter(project_many(self.projection, arrays))
+        for properties, parts in self.batch:
+            for kind, _ in parts:
+                points = [tuple(p) for p in next(projected).tolist()]
+                self.emit(properties, kind, points)
+        self.batch = []
+
+    def emit(self, properties, kind, points):
+        try:
+            element = make_element(properties, kind, points)
+            width = float(properties.get("stroke-width", self.width))
+        except (TypeError, ValueError):
+            # A malformed value skips its feature, not the rest of the import
+            self.counts["skipped"] += 1
+            return
+        if element is not None:
+            self.sink.add_element(element)
+            self.counts["elements"] += 1
+        elif kind == "line" and len(points) >= 2:
+            self.sink.add_stroke(Stroke(points, properties.get("stroke", self.color), width))
+            self.counts["strokes"] += 1
+        elif kind == "ring" and len(points) >= 3:
+            self.sink.add_figure(Figure(points, True, properties.get("stroke", self.color),
+                                        width, properties.get("fill")))
+            self.counts["figures"] += 1
+        else:
+            self.counts["skipped"] += 1
+
+    def import_geojson(self, path):
+        with open(path, encoding="utf-8") as f:
+            for feature in iter_geojson_features(f):
+                self.add(feature)
+        self.flush()
+
+    def import_csv(self, path):
+        delimiter = "\t" if os.path.splitext(path)[1].lower() == ".tsv" else None
+        with open(path, encoding="utf-8", newline="") as f:
+            for chunk in iter_csv_rows(f, delimiter=delimiter):
+                for row in chunk:
+                    self.add(row_to_feature(row))
+        self.flush()
+
+    def import_file(self, path):
+        if os.path.splitext(path)[1].lower() in (".csv", ".tsv", ".txt"):
+            self.import_csv(path)
+        else:
+            self.import_geojson(path)
+        return self.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import GeoJSON and CSV data into a map")
+    parser.add_argument("inputs", nargs="+", help="GeoJSON or CSV files")
+    parser.add_argument("--output", required=True,
+                        help="Map document to write (JSON), or shard directory with --shard-size")
+    parser.add_argument("--projection", choices=list(PROJECTIONS), default="equirectangular")
+    parser.add_argument("--scene-scale", type=float, default=1e-3,
+                        help="Scene units per metre")
+    parser.add_argument("--shard-size", type=float, default=None,
+                        help="Write a sharded map with cells of this size, see shard_storage")
+    parser.add_argument("--workers", type=int, default=1, help="Processes writing shards")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.shard_size:
+        from shard_storage import ShardedMap, ShardSink
+        sink = ShardSink(ShardedMap(args.output, args.shard_size), args.workers)
+    else:
+        sink = DocumentSink()
+    importer = Importer(sink, PROJECTIONS[args.projection](scene_scale=args.scene_scale))
+    for path in args.inputs:
+        importer.import_file(path)
+    sink.close()
+    if not args.shard_size:
+        save_map(sink.document, args.output)
+    counts = importer.counts
+    print(f"{counts['elements']} elements, {counts['strokes']} strokes, "
+          f"{counts['figures']} figures ({counts['skipped']} skipped) "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
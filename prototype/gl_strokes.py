@@ -0,0 +1,196 @@
+"""
+Stroke batches drawn from OpenGL vertex buffers, see gl_viewport
+
+Imported by a StrokeBatchItem the first time it is painted into an OpenGL
+viewport: views painting in software never load it.
+"""
+import itertools
+import math
+import sys
+from typing import Dict, Optional
+
+import numpy as np
+
+from PyQt6.QtGui import QOpenGLContext, QPaintEngine, QMatrix4x4, QColor
+from PyQt6.QtOpenGL import (QOpenGLBuffer, QOpenGLShader, QOpenGLShaderProgram,
+                            QOpenGLVersionFunctionsFactory, QOpenGLVersionProfile)
+
+GL_FLOAT = 0x1406
+GL_LINES = 0x0001
+VERTEX_BYTES = 8  # Two float32
+
+VERTEX_SHADER = """
+attribute highp vec2 position;
+uniform highp mat4 matrix;
+void main() {
+    gl_Position = matrix * vec4(position, 0.0, 1.0);
+}
+"""
+FRAGMENT_SHADER = """
+uniform lowp vec4 color;
+void main() {
+    gl_FragColor = color;
+}
+"""
+
+
+def painter_matrix(painter) -> QMatrix4x4:
+    """Scene to normalized device coordinates, for the painter's current transform"""
+    transform = painter.combinedTransform()
+    device = painter.device()
+    sx, sy = 2.0 / device.width(), -2.0 / device.height()
+    return QMatrix4x4(sx * transform.m11(), sx * transform.m21(), 0.0, sx * transform.dx() - 1.0,
+                      sy * transform.m12(), sy * transform.m22(), 0.0, sy * transform.dy() + 1.0,
+                      0.0, 0.0, 1.0, 0.0,
+                      0.0, 0.0, 0.0, 1.0)
+
+
+def stroke_vertices(batch, keys, scale: float) -> np.ndarray:
+    """Both ends of every segment of some strokes, as GL_LINES wants them"""
+    segments = []
+    for key in keys:
+        polygon = batch.polygon_at(key, scale)
+        points = np.array([(p.x(), p.y()) for p in polygon], dtype=np.float32)
+        if len(points) >= 2:
+            segments.append(np.stack((points[:-1], points[1:]), axis=1).reshape(-1, 2))
+    return np.vstack(segments) if segments else np.empty((0, 2), dtype=np.float32)
+
+
+class GLGroup:
+    """
+    Segments of the strokes sharing a pen, in a vertex buffer
+
+    The buffer has room to spare: new strokes are written after the others,
+    and only a full buffer is allocated again, twice as large.
+    """
+
+    def __init__(self, color: QColor, width: float, cosmetic: bool):
+        self.count = 0
+        self.capacity = 0
+        self.color = color
+        self.width = width
+        self.cosmetic = cosmetic
+        self.buffer = QOpenGLBuffer(QOpenGLBuffer.Type.VertexBuffer)
+        self.buffer.create()
+
+    def upload(self, vertices: np.ndarray):
+        """Replace the content of the buffer"""
+        self.capacity = max(64, 2 * len(vertices))
+        self.buffer.bind()
+        self.buffer.allocate(self.capacity * VERTEX_BYTES)
+        self.count = 0
+        self.buffer.release()
+        self.append(vertices)
+
+    def append(self, vertices: np.ndarray) -> bool:
+        """Write vertices after the others, False when they don't fit"""
+        if self.count + len(vertices) > self.capacity:
+            return False
+        data = np.ascontiguousarray(vertices, dtype=np.float32)
+        self.buffer.bind()
+        self.buffer.write(self.count * VERTEX_BYTES, data.tobytes(), data.nbytes)
+        self.buffer.release()
+        self.count += len(vertices)
+        return True
+
+    def destroy(self):
+        self.buffer.destroy()
+
+
+class GLStrokeRenderer:
+    """
+    Draws a StrokeBatchItem from vertex buffers
+
+    Buffers are built the first time the batch is painted. Strokes added
+    since are appended to their group's buffer; everything is only built
+    again when strokes were removed, or when curves need flattening for
+    another zoom. The GPU clips what is off screen, so no culling is done here.
+    """
+
+    def __init__(self):
+        self.program: Optional[QOpenGLShaderProgram] = None
+        self.functions = None
+        self.groups: Dict[tuple, GLGroup] = {}
+        # State of the batch the buffers hold: its removals, zoom bucket and stroke count
+        self.removals = None
+        self.bucket = None
+        self.count = 0
+        self.failed = False
+
+    def _setup(self):
+        profile = QOpenGLVersionProfile()
+        profile.setVersion(2, 0)
+        self.functions = QOpenGLVersionFunctionsFactory.get(profile, QOpenGLContext.currentContext())
+        if self.functions is None:
+            raise RuntimeError("OpenGL 2.0 functions are not available")
+        self.program = QOpenGLShaderProgram()
+        if not (self.program.addShaderFromSourceCode(QOpenGLShader.ShaderTypeBit.Vertex, VERTEX_SHADER)
+                and self.program.addShaderFromSourceCode(QOpenGLShader.ShaderTypeBit.Fragment,
+                                                         FRAGMENT_SHADER)):
+            raise RuntimeError(self.program.log())
+        self.program.bindAttributeLocation("position", 0)
+        if not self.program.link():
+            raise RuntimeError(self.program.log())
+
+    def _group(self, pen) -> GLGroup:
+        group = self.groups.get(pen)
+        if group is None:
+            rgba, width, cosmetic = pen
+            group = self.groups[pen] = GLGroup(QColor.fromRgba(rgba), width, cosmetic)
+        return group
+
+    def _build(self, batch, scale: float):
+        for group in self.groups.values():
+            group.destroy()
+        self.groups = {}
+        for pen, pen_group in batch.groups.items():
+            self._group(pen).upload(stroke_vertices(batch, pen_group.index.bboxes, scale))
+
+    def _append(self, batch, scale: float, count: int):
+        """Upload the strokes added after the first count ones"""
+        # The newest strokes are the last ones, read from the end
+        added = list(itertools.islice(reversed(batch.strokes), len(batch.strokes) - count))
+        by_pen = {}
+        for key in reversed(added):
+            by_pen.setdefault(batch.strokes[key].pen, []).append(key)
+        for pen, keys in by_pen.items():
+            group = self._group(pen)
+            if not group.append(stroke_vertices(batch, keys, scale)):
+                # Full: this group only is uploaded again, with room for as many
+                group.upload(stroke_vertices(batch, batch.groups[pen].index.bboxes, scale))
+
+    def paint(self, painter, batch) -> bool:
+        """Draw the batch, False when the painter is not an OpenGL one"""
+        if self.failed or painter.paintEngine().type() != QPaintEngine.Type.OpenGL2:
+            return False
+        scale = painter.worldTransform().m11()
+        bucket = math.floor(math.log2(scale)) if batch.has_curves else None
+        painter.beginNativePainting()
+        try:
+            if self.program is None:
+                self._setup()
+            if self.removals != batch.removals or self.bucket != bucket:
+                self._build(batch, scale)
+            elif self.count != len(batch.strokes):
+                self._append(batch, scale, self.count)
+            self.removals, self.bucket, self.count = batch.removals, bucket, len(batch.strokes)
+            self.program.bind()
+            self.program.setUniformValue("matrix", painter_matrix(painter))
+            self.program.enableAttributeArray(0)
+            for group in self.groups.values():
+                group.buffer.bind()
+                self.program.setAttributeBuffer(0, GL_FLOAT, 0, 2)
+                self.program.setUniformValue("color", group.color)
+                self.functions.glLineWidth(group.width if group.cosmetic else group.width * scale)
+                self.functions.glDrawArrays(GL_LINES, 0, group.count)
+                group.buffer.release()
+            self.program.disableAttributeArray(0)
+            self.program.release()
+        except RuntimeError as error:
+            # Painted through QPainter from now on
+            print(f"OpenGL stroke rendering disabled: {error}", file=sys.stderr)
+            self.failed = True
+            return False
+        finally:
+            painter.endNativePainting()
+        return True
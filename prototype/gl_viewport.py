@@ -0,0 +1,78 @@
+"""
+OpenGL viewport for the map views, opted into with MAP_VIEWPORT
+
+    MAP_VIEWPORT=gl python keep_same_width.py
+    MAP_VIEWPORT=gl-software python complex_editable.py
+
+With "gl" the view paints into a multisampled QOpenGLWidget: Qt's OpenGL
+paint engine keeps pixmaps, such as raster tiles, as textures, and stroke
+batches upload their polylines once into vertex buffers that are redrawn by
+the GPU on every frame. "gl-software" asks Mesa for llvmpipe, for machines
+without a GPU. When no context can be created the view keeps its raster
+viewport and nothing else changes.
+
+Every view imports this module, so OpenGL itself is only imported once a
+view asks for it; the stroke renderer lives in gl_strokes, loaded by the
+first batch painted into an OpenGL viewport.
+"""
+import os
+import sys
+from typing import Optional
+
+from PyQt6.QtWidgets import QGraphicsView
+from PyQt6.QtGui import QOpenGLContext, QOffscreenSurface, QSurfaceFormat
+
+SAMPLES = 4  # Multisampling, the OpenGL counterpart of the Antialiasing render hint
+
+_available: Optional[bool] = None
+
+
+def request_software_gl():
+    """Have Mesa render with llvmpipe, before any context is created"""
+    os.environ.setdefault("LIBGL_ALWAYS_SOFTWARE", "1")
+
+
+def gl_available() -> bool:
+    """Whether an OpenGL context can be created, checked once"""
+    global _available
+    if _available is None:
+        context = QOpenGLContext()
+        surface = QOffscreenSurface()
+        surface.create()
+        _available = context.create() and context.makeCurrent(surface)
+        if _available:
+            context.doneCurrent()
+    return _available
+
+
+def enable_gl_viewport(view: QGraphicsView, samples=SAMPLES) -> bool:
+    """
+    Paint a view through OpenGL
+
+    :return: False, the view being left as it was, when OpenGL is not available
+    """
+    if not gl_available():
+        return False
+    from PyQt6.QtOpenGLWidgets import QOpenGLWidget
+    surface_format = QSurfaceFormat()
+    surface_format.setSamples(samples)
+    viewport = QOpenGLWidget()
+    viewport.setFormat(surface_format)
+    view.setViewport(viewport)
+    # Partial updates of a GL surface cost as much as full ones
+    view.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.FullViewportUpdate)
+    # Stroke batches, made before or after this, pick a renderer on their first GL paint
+    return True
+
+
+def viewport_from_env(view: QGraphicsView) -> bool:
+    """enable_gl_viewport() when MAP_VIEWPORT asks for it, to call before install_from_env"""
+    mode = os.environ.get("MAP_VIEWPORT", "software")
+    if mode not in ("gl", "gl-software"):
+        return False
+    if mode == "gl-software":
+        request_software_gl()
+    if enable_gl_viewport(view):
+        return True
+    print("OpenGL is not available, painting in software", file=sys.stderr)
+    return False
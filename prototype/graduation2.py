@@ -1,8 +1,35 @@
 import sys
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                            QHBoxLayout, QLabel, QGraphicsView, QGraphicsScene)
+                            QHBoxLayout, QGraphicsView, QGraphicsScene, QGraphicsPixmapItem)
 from PyQt6.QtCore import Qt, QRectF
-from PyQt6.QtGui import QPixmap, QPainter, QColor, QPen
+from PyQt6.QtGui import QPixmap, QPainter, QColor, QPen, QFontMetricsF
+
+from gl_viewport import viewport_from_env
+from instrumentation import install_from_env
+from layers import LayerStack
+from text_cache import text_cache
+
+class ScaleLabel(QWidget):
+    """Label whose text is drawn from the text cache instead of a QLabel layout"""
+    def __init__(self):
+        super().__init__()
+        self.text = ""
+        # Fixed size: a new text never triggers a layout pass
+        metrics = QFontMetricsF(self.font())
+        self.setFixedSize(int(metrics.horizontalAdvance("1 cm = 00000.0 km")) + 4,
+                          int(metrics.height()) + 4)
+
+    def setText(self, text):
+        if text != self.text:
+            self.text = text
+            self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        dpr = self.devicePixelRatioF()
+        static_text = text_cache.static_text(self.text, self.font(), dpr)
+        painter.drawStaticText(2, (self.height() - int(static_text.size().height())) // 2,
+                               static_text)
 
 class ScaleWidget(QWidget):
     def __init__(self):
@@ -14,7 +41,7 @@ class ScaleWidget(QWidget):
         self.scale_bar = QWidget()
         self.scale_bar.setFixedHeight(30)  # Increased height for better visibility
         self.scale_bar.setFixedWidth(500)  # Increased width to accommodate 5cm
-        self.scale_label = QLabel()
+        self.scale_label = ScaleLabel()
         
         self.layout.addWidget(self.scale_bar)
         self.layout.addWidget(self.scale_label)
@@ -51,10 +78,12 @@ class MapView(QGraphicsView):
         super().__init__()
         self.scale_widget = scale_widget
         self.setScene(QGraphicsScene())
+        # Subclasses draw over the map in layers of their own
+        self.layers = LayerStack(self.scene())
         
         # Load and set initial map
         self.map_pixmap = QPixmap("map.png")  # User needs to provide their map image
-        self.scene().addPixmap(self.map_pixmap)
+        self.layers.add_layer("Map", cache="item").add_item(QGraphicsPixmapItem(self.map_pixmap))
         
         # Set view properties
         self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
@@ -84,6 +113,7 @@ class MapView(QGraphicsView):
             
         self.scale(zoom_factor, zoom_factor)
         self.current_scale *= zoom_factor
+        self.layers.set_view_scale(self.transform().m11())
         
         # Get the new position
         new_pos = self.mapToScene(event.position().toPoint())
@@ -126,6 +156,8 @@ class MainWindow(QMainWindow):
         
         # Create map view
         map_view = MapView(scale_widget)
+        viewport_from_env(map_view)
+        install_from_env(map_view)
         
         # Add widgets to layout
         layout.addWidget(map_view)
@@ -0,0 +1,258 @@
+"""
+Opt-in timing of the rendering hot paths
+
+Nothing is measured until install() is called, which prototypes do when the
+MAP_PROFILE environment variable is set:
+
+    MAP_PROFILE=trace.json python keep_same_width.py
+
+The handlers are wrapped at class level, a live overlay shows FPS and a
+per-stage breakdown, and the trace is written on exit in the Chrome trace
+event format, which chrome://tracing, Perfetto and speedscope all open.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from PyQt6.QtWidgets import QApplication, QWidget, QGraphicsScene, QGraphicsView
+from PyQt6.QtCore import Qt, QTimer, QObject, QEvent
+from PyQt6.QtGui import QPainter, QColor, QFont
+
+from memory_budget import memory_budget
+
+# Methods timed wherever they are found, and the stage they are reported as
+HOT_METHODS = {
+    "wheelEvent": "wheelEvent",
+    "mousePressEvent": "mousePressEvent",
+    "render_lines": "render_lines",
+    "redraw_lines": "redraw_lines",
+    "update_path": "update_path",
+    "to_path": "path_build",
+    "render_tile": "tile_render",
+}
+
+# Scene methods whose calls are counted as items added or removed
+ADDING_METHODS = ("addItem", "addLine", "addPath", "addPixmap", "addEllipse",
+                  "addRect", "addPolygon", "addText", "addSimpleText")
+
+FRAME_HISTORY = 120  # Frames kept for the overlay's averages
+
+
+class Profiler:
+    """Collects timed spans and per-frame counters"""
+
+    def __init__(self, max_events=500000):
+        self.enabled = False
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter_ns()
+        self.frames = deque(maxlen=FRAME_HISTORY)
+        self.extra_rows = []  # Callables adding lines to the overlay
+        self._current = self._new_frame()
+
+    def _new_frame(self):
+        return {"start": time.perf_counter_ns(), "stages": {}, "added": 0, "removed": 0}
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            # Spans nest in the trace by their times, per thread
+            self.events.append((name, start, duration, threading.get_ident()))
+            stages = self._current["stages"]
+            stages[name] = stages.get(name, 0) + duration
+
+    def count(self, added=0, removed=0):
+        if self.enabled:
+            self._current["added"] += added
+            self._current["removed"] += removed
+
+    def end_frame(self):
+        """Close the current frame, called after each viewport paint"""
+        if not self.enabled:
+            return
+        frame = self._current
+        frame["end"] = time.perf_counter_ns()
+        self.frames.append(frame)
+        self._current = self._new_frame()
+
+    def fps(self):
+        if len(self.frames) < 2:
+            return 0.0
+        elapsed = (self.frames[-1]["end"] - self.frames[0]["end"]) / 1e9
+        return (len(self.frames) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def stage_averages(self):
+        """Mean milliseconds per frame spent in each stage, nested stages included"""
+        totals = {}
+        for frame in self.frames:
+            for name, duration in frame["stages"].items():
+                totals[name] = totals.get(name, 0) + duration
+        count = max(1, len(self.frames))
+        return {name: total / count / 1e6 for name, total in totals.items()}
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        return {
+            "displayTimeUnit": "ms",
+            "traceEvents": [
+                {"name": name, "cat": "map", "ph": "X", "pid": pid, "tid": tid,
+                 "ts": (start - self.origin) / 1000, "dur": duration / 1000}
+                for name, start, duration, tid in self.events
+            ],
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+profiler = Profiler()
+
+
+def _timed(function, stage):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        with profiler.span(stage):
+            return function(*args, **kwargs)
+    timed.profiled = True
+    return timed
+
+
+def instrument_class(cls, methods=HOT_METHODS):
+    """Wrap the hot methods a class defines or inherits"""
+    for name, stage in methods.items():
+        function = getattr(cls, name, None)
+        if function is None or getattr(function, "profiled", False):
+            continue
+        setattr(cls, name, _timed(function, stage))
+
+
+class FrameTimer(QObject):
+    """
+    Times the painting of a viewport, which also marks the end of a frame
+
+    paintEvent can't be wrapped like the other handlers: PyQt remembers that a
+    class does not reimplement it, so the painting is done from this filter.
+    """
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+
+    def eventFilter(self, obj, event):
+        if event.type() != QEvent.Type.Paint:
+            return False
+        with profiler.span("qt_paint"):
+            self.view.viewportEvent(event)
+        profiler.end_frame()
+        return True
+
+
+def _instrument_scene_counts():
+    if getattr(QGraphicsScene.clear, "profiled", False):
+        return
+    for name in ADDING_METHODS:
+        function = getattr(QGraphicsScene, name)
+
+        def adding(self, *args, _add=function, **kwargs):
+            profiler.count(added=1)
+            return _add(self, *args, **kwargs)
+        adding.profiled = True
+        setattr(QGraphicsScene, name, adding)
+
+    remove_item = QGraphicsScene.removeItem
+
+    def removing(self, item):
+        profiler.count(removed=1)
+        return remove_item(self, item)
+    removing.profiled = True
+    QGraphicsScene.removeItem = removing
+
+    clear = QGraphicsScene.clear
+
+    def clearing(self):
+        profiler.count(removed=len(self.items()))
+        with profiler.span("scene_clear"):
+            return clear(self)
+    clearing.profiled = True
+    QGraphicsScene.clear = clearing
+
+
+class ProfilerOverlay(QWidget):
+    """FPS and per-stage breakdown drawn over the top-left corner of a view"""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.setFont(QFont("Monospace", 8))
+        self.resize(260, 200)
+        self.move(4, 4)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update)
+        self.timer.start(250)
+
+    def paintEvent(self, event):
+        frames = profiler.frames
+        lines = [f"FPS {profiler.fps():6.1f}   frames {len(frames)}"]
+        if frames:
+            added = sum(f["added"] for f in frames) / len(frames)
+            removed = sum(f["removed"] for f in frames) / len(frames)
+            lines.append(f"items/frame +{added:.0f} -{removed:.0f}")
+        for name, ms in sorted(profiler.stage_averages().items(), key=lambda s: -s[1]):
+            lines.append(f"{name:<18}{ms:8.2f} ms")
+        for row in profiler.extra_rows:
+            lines.extend(row())
+
+        height = self.fontMetrics().height()
+        if height * len(lines) + 6 > self.height():
+            # Grown once for the rows added since, the next repaint shows them all
+            self.resize(self.width(), height * len(lines) + 6)
+        painter = QPainter(self)
+        painter.fillRect(0, 0, self.width(), height * len(lines) + 6, QColor(0, 0, 0, 160))
+        painter.setPen(Qt.GlobalColor.white)
+        for i, line in enumerate(lines):
+            painter.drawText(4, height * (i + 1), line)
+
+
+def install(view, classes=(), trace_path=None, overlay=True):
+    """
+    Start profiling a view
+
+    :param view: QGraphicsView to time; its class and its scene's class are instrumented
+    :param classes: Other classes to instrument, FigureGraphicsItem for instance
+    :param trace_path: Where to write the trace when the application quits
+    """
+    profiler.enabled = True
+    # Some views shadow scene() with a scene attribute
+    scene = QGraphicsView.scene(view)
+    for cls in (type(view), type(scene), *classes):
+        # Qt's own classes are left alone, only the prototypes' handlers are timed
+        if not cls.__module__.startswith("PyQt6"):
+            instrument_class(cls)
+    _instrument_scene_counts()
+    if memory_budget.rows not in profiler.extra_rows:
+        profiler.extra_rows.append(memory_budget.rows)
+    view.frame_timer = FrameTimer(view)
+    view.viewport().installEventFilter(view.frame_timer)
+    if overlay:
+        view.profiler_overlay = ProfilerOverlay(view)
+        view.profiler_overlay.show()
+    if trace_path:
+        QApplication.instance().aboutToQuit.connect(lambda: profiler.dump(trace_path))
+
+
+def install_from_env(view, classes=()):
+    """install() when MAP_PROFILE is set, its value being the trace file"""
+    trace_path = os.environ.get("MAP_PROFILE")
+    if trace_path:
+        install(view, classes, trace_path if trace_path != "1" else None)
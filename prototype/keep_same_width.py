@@ -1,21 +1,51 @@
 import sys
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsView, QGraphicsScene, 
                              QVBoxLayout, QWidget, QGraphicsPathItem)
-from PyQt6.QtGui import QPen, QColor, QPainterPath, QPainter
+from PyQt6.QtGui import QPen, QColor, QPainterPath, QPainter, QPolygonF
 from PyQt6.QtCore import Qt, QPointF
 
+from bezier import BezierPath, FIT_ERROR
+from gl_viewport import viewport_from_env
+from instrumentation import install_from_env
+from layers import LayerStack
+from stroke_batch import StrokeBatchItem, rect_bbox
+
 class VectorLine:
-    def __init__(self, points, width=20, color=Qt.GlobalColor.black):
+    def __init__(self, points, width=20, color=Qt.GlobalColor.black, curve=None):
         """
         Create a vector line with consistent properties
         
         :param points: List of QPointF points defining the line
         :param width: Line width in pixels
         :param color: Line color
+        :param curve: BezierPath replacing the points once the line is fitted
         """
         self.points = points
         self.width = width
         self.color = color
+        self.curve = curve
+        self._bbox = None
+
+    @property
+    def bbox(self):
+        """(min_x, min_y, max_x, max_y) of the points or the curve, the width being in pixels"""
+        if self._bbox is None:
+            if self.curve is not None:
+                self._bbox = self.curve.bbox
+            elif self.points:
+                self._bbox = rect_bbox(QPolygonF(self.points).boundingRect())
+        return self._bbox
+
+    def fit(self, error=FIT_ERROR):
+        """
+        Replace the points by cubic Béziers
+
+        :param error: Largest distance in scene units between the points and the curve
+        """
+        if len(self.points) > 2:
+            self.curve = BezierPath.from_qpoints(self.points, error)
+            self.points = []
+            self._bbox = None
     
     def to_path(self, scale=1.0):
         """
@@ -24,6 +54,10 @@ class VectorLine:
         :param scale: Current zoom scale to maintain consistent line width
         :return: QPainterPath representing the line
         """
+        if self.curve is not None:
+            # Flattened for the zoom, smooth close up and light far away
+            return self.curve.to_path(scale)
+
         path = QPainterPath()
         if not self.points:
             return path
@@ -47,6 +81,13 @@ class DrawingView(QGraphicsView):
         # Scene setup
         self.scene = QGraphicsScene(self)
         self.setScene(self.scene)
+
+        # Finished lines, all painted by one batch, and the line being drawn over them
+        self.layers = LayerStack(self.scene)
+        self.line_batch = StrokeBatchItem()
+        self.layers.add_layer("Lines").add_item(self.line_batch, key="batch")
+        self.layers.add_layer("Current line")
+        self.batched_lines = 0
         
         # Drawing properties
         self.drawing = False
@@ -77,24 +118,18 @@ class DrawingView(QGraphicsView):
             # Add point to current line
             self.current_line_points.append(scene_pos)
             
-            # Clear previous preview
-            self.scene.clear()
-            
-            # Redraw all existing vector lines
-            current_zoom = self.transform().m11()
-            for vector_line in self.vector_lines:
-                path_item = QGraphicsPathItem(vector_line.to_path(current_zoom))
-                pen = QPen(vector_line.color, vector_line.width / current_zoom)
-                path_item.setPen(pen)
-                self.scene.addItem(path_item)
+            # Clear previous preview, finished lines stay as they are
+            current = self.layers["Current line"]
+            current.clear()
             
             # Draw current line in progress
+            current_zoom = self.transform().m11()
             if len(self.current_line_points) > 1:
                 current_line = VectorLine(self.current_line_points)
                 path_item = QGraphicsPathItem(current_line.to_path(current_zoom))
                 pen = QPen(Qt.GlobalColor.black, self.line_width / current_zoom)
                 path_item.setPen(pen)
-                self.scene.addItem(path_item)
+                current.add_item(path_item)
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton and self.drawing:
@@ -103,8 +138,12 @@ class DrawingView(QGraphicsView):
             # Only add line if it has more than one point
             if len(self.current_line_points) > 1:
                 vector_line = VectorLine(self.current_line_points)
+                # The fit may stray by a pixel and a half from the hand on screen
+                vector_line.fit(FIT_ERROR / self.transform().m11())
                 self.vector_lines.append(vector_line)
+                self.redraw_lines()
             
+            self.layers["Current line"].clear()
             self.current_line_points = []
 
     def wheelEvent(self, event):
@@ -119,22 +158,30 @@ class DrawingView(QGraphicsView):
             # Zoom out
             self.scale(zoom_out_factor, zoom_out_factor)
         
-        # Redraw lines to maintain consistent width
+        # Batch new lines and pass the zoom on
         self.redraw_lines()
 
+    def add_line_item(self, key, vector_line):
+        # Cosmetic pens keep the width in pixels, so a zoom rebuilds nothing
+        if vector_line.curve is not None:
+            self.line_batch.add_curve(vector_line.curve, vector_line.color, vector_line.width,
+                                      cosmetic=True, key=key)
+        else:
+            self.line_batch.add_stroke(vector_line.points, vector_line.color, vector_line.width,
+                                       cosmetic=True, key=key, bbox=vector_line.bbox)
+
     def redraw_lines(self):
-        # Clear the scene
-        self.scene.clear()
-        
-        # Get current zoom level
-        current_zoom = self.transform().m11()
-        
-        # Redraw all vector lines
-        for vector_line in self.vector_lines:
-            path_item = QGraphicsPathItem(vector_line.to_path(current_zoom))
-            pen = QPen(vector_line.color, vector_line.width / current_zoom)
-            path_item.setPen(pen)
-            self.scene.addItem(path_item)
+        # Hand the new lines to the batch, which culls and draws them on paint
+        if len(self.vector_lines) < self.batched_lines:
+            self.line_batch.clear()
+            self.batched_lines = 0
+        for key in range(self.batched_lines, len(self.vector_lines)):
+            self.add_line_item(key, self.vector_lines[key])
+        self.batched_lines = len(self.vector_lines)
+
+        # The batch bounds grow with cosmetic pens when zooming out
+        self.layers.set_view_scale(self.transform().m11())
+        self.layers["Lines"].reindex("batch")
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -156,6 +203,8 @@ class MainWindow(QMainWindow):
 def main():
     app = QApplication(sys.argv)
     window = MainWindow()
+    viewport_from_env(window.drawing_view)
+    install_from_env(window.drawing_view, (VectorLine,))
     window.show()
     sys.exit(app.exec())
 
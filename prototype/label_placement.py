@@ -0,0 +1,249 @@
+import math
+import random
+import sys
+from dataclasses import dataclass
+from typing import Dict, List
+
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsScene, QGraphicsView,
+                             QGraphicsItem)
+from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtGui import QPainter, QPen, QFont, QFontMetricsF
+
+from map_document import element_anchor, map_elements
+from memory_budget import NORMAL, index_bytes, memory_budget
+from spatial_index import GridIndex
+from text_cache import text_cache
+
+# Scores are comparable across element kinds: a capital beats any city, and
+# a mountain of 1000m weighs like a city of 100 000 inhabitants
+CAPITAL_BONUS = 1e12
+METRES_TO_POPULATION = 100
+BIOME_SCORE = 1e3
+
+LABEL_GAP = 5  # Pixels between the anchor and its label
+LABEL_BYTES = 200  # A PlacedLabel and its offset, for the memory budget
+
+# Where a label may sit around its anchor, in order of preference
+POSITIONS = ("right", "left", "above", "below")
+
+
+def label_priority(element) -> float:
+    """Importance of a label, the most important ones are placed first"""
+    if isinstance(element, map_elements.City):
+        return element.population + (CAPITAL_BONUS if element.is_capital else 0)
+    if isinstance(element, map_elements.Mountain):
+        return element.altitude.max_height * METRES_TO_POPULATION
+    return BIOME_SCORE
+
+
+def zoom_bucket(scale: float) -> int:
+    """
+    Zoom levels sharing a placement
+
+    Labels are placed at the lowest scale of each bucket. Zooming in inside a
+    bucket only spreads anchors apart while labels keep their pixel size, so
+    placed labels never start to overlap.
+    """
+    return math.floor(math.log2(scale))
+
+
+@dataclass
+class PlacedLabel:
+    element: object
+    anchor: tuple       # Scene coordinates
+    offset: QPointF     # Top-left corner of the text relative to the anchor, in pixels
+    width: float
+    height: float
+
+
+class LabelPlacer:
+    """
+    Chooses which element names to show at each zoom bucket
+
+    Elements are sorted by priority once. For each bucket a greedy pass keeps
+    a label only if its rectangle, in pixels at that bucket's scale, collides
+    with no label kept before it. Collision tests only look at nearby labels
+    through a grid. Results are cached, and a frame only queries the labels
+    placed in the visible rectangle.
+    """
+
+    def __init__(self, elements, font: QFont = None):
+        self.font = font or QFont("Sans", 9)
+        metrics = QFontMetricsF(self.font)
+        self.height = metrics.height()
+
+        self.elements = sorted(elements, key=label_priority, reverse=True)
+        self.anchors = [element_anchor(e) for e in self.elements]
+        self.widths = [metrics.horizontalAdvance(e.name) for e in self.elements]
+        self._margin = max(self.widths, default=0) + 2 * LABEL_GAP
+        self.buckets: Dict[int, GridIndex] = {}
+        self.labels: Dict[int, List[PlacedLabel]] = {}
+        self.account = memory_budget.register("labels", self._evict, NORMAL)
+
+    def margin(self) -> float:
+        """Farthest a label can reach from its anchor, in pixels"""
+        return self._margin
+
+    def invalidate(self):
+        """Forget every placement, after elements were edited"""
+        self.buckets.clear()
+        self.labels.clear()
+        self.account.clear()
+
+    def _evict(self, bucket: int):
+        self.buckets.pop(bucket, None)
+        self.labels.pop(bucket, None)
+
+    def candidate_offsets(self, width):
+        height = self.height
+        return {
+            "right": QPointF(LABEL_GAP, -height / 2),
+            "left": QPointF(-LABEL_GAP - width, -height / 2),
+            "above": QPointF(-width / 2, -LABEL_GAP - height),
+            "below": QPointF(-width / 2, LABEL_GAP),
+        }
+
+    def place(self, bucket: int) -> GridIndex:
+        """Placed labels of a zoom bucket, indexed by their scene rectangle"""
+        if bucket in self.buckets:
+            self.account.touch(bucket)
+            return self.buckets[bucket]
+
+        scale = 2.0 ** bucket
+        occupied = GridIndex(cell_size=4 * self.height)
+        placed = []
+        for element, (x, y), width in zip(self.elements, self.anchors, self.widths):
+            px, py = x * scale, y * scale
+            offsets = self.candidate_offsets(width)
+            for position in POSITIONS:
+                offset = offsets[position]
+                rect = (px + offset.x(), py + offset.y(),
+                        px + offset.x() + width, py + offset.y() + self.height)
+                if not occupied.query(rect):
+                    occupied.insert(len(placed), rect)
+                    placed.append(PlacedLabel(element, (x, y), offset, width, self.height))
+                    break
+
+        # Index the kept labels in scene units, for viewport queries
+        index = GridIndex(cell_size=4 * self.height / scale)
+        for key, label in enumerate(placed):
+            x, y = label.anchor
+            left = x + label.offset.x() / scale
+            top = y + label.offset.y() / scale
+            index.insert(key, (min(x, left), min(y, top),
+                               max(x, left + label.width / scale),
+                               max(y, top + label.height / scale)))
+        self.buckets[bucket] = index
+        self.labels[bucket] = placed
+        self.account.charge(bucket, index_bytes(index) + LABEL_BYTES * len(placed))
+        return index
+
+    def visible_labels(self, scale: float, rect) -> List[PlacedLabel]:
+        """Labels to draw at a scale, within a scene rectangle (x0, y0, x1, y1)"""
+        bucket = zoom_bucket(scale)
+        index = self.place(bucket)
+        placed = self.labels[bucket]
+        return [placed[key] for key in sorted(index.query(rect))]
+
+
+def paint_labels(painter: QPainter, placer: LabelPlacer, scale: float, rect):
+    """Draw the labels of a scene rectangle, in pixels, with the painter's transform"""
+    transform = painter.transform()
+    painter.save()
+    painter.resetTransform()
+    painter.setFont(placer.font)
+    painter.setPen(QPen(Qt.GlobalColor.black))
+    painter.setBrush(Qt.GlobalColor.black)
+    for label in placer.visible_labels(scale, rect):
+        anchor = transform.map(QPointF(*label.anchor))
+        painter.drawEllipse(anchor, 2, 2)
+        # Names are shaped and rasterized once, then blitted on every frame
+        text_cache.draw_text(painter, anchor + label.offset, label.element.name, placer.font)
+    painter.restore()
+
+
+class LabelLayerItem(QGraphicsItem):
+    """Single scene item drawing the decluttered labels of a set of elements"""
+
+    def __init__(self, elements, font: QFont = None):
+        super().__init__()
+        self.placer = LabelPlacer(elements, font)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self._bounds = QRectF()
+        if self.placer.anchors:
+            xs = [a[0] for a in self.placer.anchors]
+            ys = [a[1] for a in self.placer.anchors]
+            self._bounds = QRectF(min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+
+        self.view_scale = 1.0
+
+    def set_view_scale(self, scale: float):
+        """Labels keep their pixel size, so the bounds depend on the view's zoom"""
+        self.prepareGeometryChange()
+        self.view_scale = scale
+
+    def boundingRect(self):
+        # Labels reach outside the anchors by a few pixels, whatever the zoom
+        margin = self.placer.margin() / self.view_scale
+        return self._bounds.adjusted(-margin, -margin, margin, margin)
+
+    def paint(self, painter, option, widget=None):
+        scale = painter.worldTransform().m11()
+        exposed = option.exposedRect
+        # The exposed rect misses labels whose anchor is just outside it
+        margin = self.placer.margin() / scale
+        rect = (exposed.left() - margin, exposed.top() - margin,
+                exposed.right() + margin, exposed.bottom() + margin)
+        paint_labels(painter, self.placer, scale, rect)
+
+
+class LabelView(QGraphicsView):
+    def __init__(self, scene):
+        super().__init__(scene)
+        self.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+
+        self.label_layer = None
+
+    def wheelEvent(self, event):
+        zoom_factor = 1.25 if event.angleDelta().y() > 0 else 1 / 1.25
+        self.scale(zoom_factor, zoom_factor)
+        if self.label_layer is not None:
+            self.label_layer.set_view_scale(self.transform().m11())
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Map Labels")
+        self.setGeometry(100, 100, 1000, 800)
+
+        random.seed(1)
+        elements = []
+        for i in range(20000):
+            coordinates = [map_elements.Coordinates(random.uniform(0, 4000),
+                                                    random.uniform(0, 3000))]
+            if i % 10 == 0:
+                altitude = map_elements.Altitude(max_height=random.uniform(500, 8800))
+                elements.append(map_elements.Mountain(f"Mount {i}", coordinates, altitude))
+            else:
+                elements.append(map_elements.City(f"City {i}", coordinates,
+                                                  population=random.randint(100, 5000000),
+                                                  is_capital=i % 997 == 0))
+
+        scene = QGraphicsScene()
+        labels = LabelLayerItem(elements)
+        scene.addItem(labels)
+        view = LabelView(scene)
+        view.label_layer = labels
+        view.scale(0.25, 0.25)
+        labels.set_view_scale(0.25)
+        self.setCentralWidget(view)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
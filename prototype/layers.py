@@ -0,0 +1,379 @@
+"""
+Layer stack shared by the drawing and map views
+
+A layer is one parent item in the scene holding every item of that layer,
+so its z-order, visibility and opacity apply to all of them at once and a
+hidden layer, or one outside its zoom range, is skipped by Qt as a whole
+without visiting its items. Each layer keeps its own spatial index and can
+be cleared without touching the rest of the scene.
+"""
+import math
+import random
+import sys
+from typing import Dict, Hashable, List
+
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsScene, QGraphicsView,
+                             QGraphicsItem, QGraphicsPathItem, QGraphicsPixmapItem,
+                             QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QCheckBox,
+                             QSlider, QComboBox)
+from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtGui import QPainter, QPen, QColor, QBrush, QImage, QPixmap, QPainterPath
+
+from label_placement import LabelLayerItem
+from map_document import map_elements
+from spatial_index import BBox, GridIndex
+
+# How a layer's items are cached by Qt, see QGraphicsItem.CacheMode
+CACHE_POLICIES = {
+    "none": QGraphicsItem.CacheMode.NoCache,
+    # Redrawn on zoom, kept while panning: for items costly to paint
+    "device": QGraphicsItem.CacheMode.DeviceCoordinateCache,
+    # Kept across zooms, at the price of blurry scaling: for static rasters
+    "item": QGraphicsItem.CacheMode.ItemCoordinateCache,
+}
+
+
+def rect_to_bbox(rect: QRectF) -> BBox:
+    return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+
+class LayerRoot(QGraphicsItem):
+    """Parent of a layer's items, drawing nothing itself"""
+
+    def __init__(self):
+        super().__init__()
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemHasNoContents)
+
+    def boundingRect(self):
+        return QRectF()
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+
+class Layer:
+    """
+    Items of one kind drawn together, such as rivers, borders or labels
+
+    :param name: Name shown to the user, unique in its stack
+    :param z: Layers with a higher z are drawn over the others
+    :param visible: Whether the user shows the layer
+    :param min_scale: Below this view scale the layer is hidden
+    :param max_scale: Above this view scale the layer is hidden
+    :param opacity: Opacity of the whole layer, from 0 to 1
+    :param cache: Key of CACHE_POLICIES applied to every item of the layer
+    :param cell_size: Cell size of the layer's spatial index, in scene units
+    """
+
+    def __init__(self, name: str, z: float = 0.0, visible=True, min_scale=0.0,
+                 max_scale=math.inf, opacity=1.0, cache="none", cell_size=256.0):
+        self.name = name
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.cache = cache
+        self.index = GridIndex(cell_size)
+        self.items: Dict[Hashable, QGraphicsItem] = {}
+        # Items keeping a constant pixel size, such as labels, told the view scale
+        self.scaled: Dict[Hashable, QGraphicsItem] = {}
+        self.view_scale = 1.0
+        self._next_key = 0
+        self._visible = visible
+        self._in_range = True
+
+        self.root = LayerRoot()
+        self.root.setZValue(z)
+        self.root.setOpacity(opacity)
+        self.root.setVisible(visible)
+
+    @property
+    def z(self) -> float:
+        return self.root.zValue()
+
+    @z.setter
+    def z(self, z: float):
+        self.root.setZValue(z)
+
+    @property
+    def opacity(self) -> float:
+        return self.root.opacity()
+
+    @opacity.setter
+    def opacity(self, opacity: float):
+        self.root.setOpacity(opacity)
+
+    @property
+    def visible(self) -> bool:
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible: bool):
+        shown = self.shown
+        self._visible = visible
+        self.root.setVisible(visible and self._in_range)
+        if self.shown and not shown:
+            # Zoomed while hidden
+            self._scale_items()
+
+    @property
+    def shown(self) -> bool:
+        """Whether the layer is actually drawn, taking its zoom range into account"""
+        return self.root.isVisible()
+
+    def in_range(self, scale: float) -> bool:
+        return self.min_scale <= scale <= self.max_scale
+
+    def set_view_scale(self, scale: float):
+        """Hide the layer outside its zoom range, and pass the scale on to items needing it"""
+        self.view_scale = scale
+        in_range = self.in_range(scale)
+        if in_range != self._in_range:
+            self._in_range = in_range
+            self.root.setVisible(self._visible and in_range)
+        if self.shown:
+            self._scale_items()
+
+    def _scale_items(self):
+        for item in self.scaled.values():
+            item.set_view_scale(self.view_scale)
+
+    def set_cache_policy(self, cache: str):
+        self.cache = cache
+        for item in self.items.values():
+            item.setCacheMode(CACHE_POLICIES[cache])
+
+    def add_item(self, item: QGraphicsItem, key: Hashable = None) -> Hashable:
+        """
+        Put an item in the layer
+
+        :param key: Key of the item in the layer's index, a new one by default
+        :return: The key
+        """
+        if key is None:
+            key = self._next_key
+            self._next_key += 1
+        item.setParentItem(self.root)
+        item.setCacheMode(CACHE_POLICIES[self.cache])
+        self.items[key] = item
+        if hasattr(item, "set_view_scale"):
+            self.scaled[key] = item
+        self.index.insert(key, rect_to_bbox(item.sceneBoundingRect()))
+        return key
+
+    def remove_item(self, key: Hashable):
+        item = self.items.pop(key, None)
+        if item is None:
+            return
+        self.scaled.pop(key, None)
+        self.index.remove(key)
+        scene = item.scene()
+        if scene is not None:
+            scene.removeItem(item)
+
+    def reindex(self, key: Hashable):
+        """Update the index after an item of the layer moved or changed shape"""
+        bbox = rect_to_bbox(self.items[key].sceneBoundingRect())
+        # Large items span many cells, skip them when their bounds are the same
+        if self.index.bboxes.get(key) != bbox:
+            self.index.insert(key, bbox)
+
+    def query(self, rect: BBox) -> List[QGraphicsItem]:
+        """Items of the layer whose bounds intersect a scene rectangle (x0, y0, x1, y1)"""
+        return [self.items[key] for key in self.index.query(rect)]
+
+    def clear(self):
+        """Remove every item of the layer, the rest of the scene is left alone"""
+        scene = self.root.scene()
+        # Dropping the root takes its items along in one go
+        old_root, self.root = self.root, LayerRoot()
+        self.root.setZValue(old_root.zValue())
+        self.root.setOpacity(old_root.opacity())
+        self.root.setVisible(old_root.isVisible())
+        if scene is not None:
+            scene.removeItem(old_root)
+            scene.addItem(self.root)
+        self.items.clear()
+        self.scaled.clear()
+        self.index = GridIndex(self.index.cell_size)
+
+
+class LayerStack:
+    """
+    Ordered layers of a scene, the last one on top
+
+    :param scene: Scene the layers are drawn in
+    """
+
+    def __init__(self, scene: QGraphicsScene):
+        self.scene = scene
+        self.layers: List[Layer] = []
+        self.view_scale = 1.0
+
+    def __getitem__(self, name: str) -> Layer:
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        raise KeyError(name)
+
+    def __contains__(self, name: str):
+        return any(layer.name == name for layer in self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def add_layer(self, name: str, **options) -> Layer:
+        """New layer on top of the others, see Layer for the options"""
+        if name in self:
+            raise ValueError(f"A layer named {name!r} already exists")
+        layer = Layer(name, **options)
+        self.layers.append(layer)
+        self.scene.addItem(layer.root)
+        self._restack()
+        layer.set_view_scale(self.view_scale)
+        return layer
+
+    def remove_layer(self, name: str):
+        layer = self[name]
+        layer.clear()
+        self.scene.removeItem(layer.root)
+        self.layers.remove(layer)
+        self._restack()
+
+    def move_layer(self, name: str, position: int):
+        """Put a layer at a position of the stack, 0 being the bottom"""
+        layer = self[name]
+        self.layers.remove(layer)
+        self.layers.insert(position, layer)
+        self._restack()
+
+    def _restack(self):
+        for z, layer in enumerate(self.layers):
+            layer.z = z
+
+    def set_view_scale(self, scale: float):
+        self.view_scale = scale
+        for layer in self.layers:
+            layer.set_view_scale(scale)
+
+    def query(self, rect: BBox) -> List[QGraphicsItem]:
+        """Items of the shown layers within a scene rectangle, top layer first"""
+        found = []
+        for layer in reversed(self.layers):
+            if layer.shown:
+                found.extend(layer.query(rect))
+        return found
+
+
+class LayeredView(QGraphicsView):
+    """View zooming with the wheel and keeping its layer stack informed of the scale"""
+
+    def __init__(self, scene: QGraphicsScene, stack: LayerStack):
+        super().__init__(scene)
+        self.stack = stack
+        self.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        stack.set_view_scale(self.transform().m11())
+
+    def wheelEvent(self, event):
+        zoom_factor = 1.25 if event.angleDelta().y() > 0 else 1 / 1.25
+        self.scale(zoom_factor, zoom_factor)
+        self.stack.set_view_scale(self.transform().m11())
+
+
+class LayerPanel(QWidget):
+    """Visibility, opacity and cache policy of each layer, top layer first"""
+
+    def __init__(self, stack: LayerStack):
+        super().__init__()
+        layout = QVBoxLayout(self)
+        for layer in reversed(stack.layers):
+            row = QHBoxLayout()
+            visible = QCheckBox(layer.name)
+            visible.setChecked(layer.visible)
+            visible.toggled.connect(lambda checked, layer=layer: setattr(layer, "visible", checked))
+            opacity = QSlider(Qt.Orientation.Horizontal)
+            opacity.setRange(0, 100)
+            opacity.setValue(round(layer.opacity * 100))
+            opacity.valueChanged.connect(
+                lambda value, layer=layer: setattr(layer, "opacity", value / 100))
+            cache = QComboBox()
+            cache.addItems(CACHE_POLICIES)
+            cache.setCurrentText(layer.cache)
+            cache.currentTextChanged.connect(layer.set_cache_policy)
+            row.addWidget(visible)
+            row.addWidget(opacity)
+            row.addWidget(cache)
+            layout.addLayout(row)
+        layout.addStretch()
+
+
+def random_walk(rng, start, steps, step):
+    path = QPainterPath(QPointF(*start))
+    x, y = start
+    angle = rng.uniform(0, 2 * math.pi)
+    for _ in range(steps):
+        angle += rng.gauss(0, 0.3)
+        x, y = x + step * math.cos(angle), y + step * math.sin(angle)
+        path.lineTo(x, y)
+    return path
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Map Layers")
+        self.setGeometry(100, 100, 1200, 800)
+        rng = random.Random(1)
+
+        scene = QGraphicsScene()
+        self.stack = LayerStack(scene)
+        base = self.stack.add_layer("Base", cache="item")
+        rivers = self.stack.add_layer("Rivers", cache="device")
+        borders = self.stack.add_layer("Borders")
+        labels = self.stack.add_layer("Labels", min_scale=0.1)
+        self.stack.add_layer("Edit overlay")
+
+        image = QImage(400, 300, QImage.Format.Format_RGB32)
+        for y in range(300):
+            for x in range(400):
+                shade = 150 + int(60 * math.sin(x / 40) * math.cos(y / 30))
+                image.setPixelColor(x, y, QColor(shade - 40, shade, shade - 60))
+        raster = QGraphicsPixmapItem(QPixmap.fromImage(image))
+        raster.setScale(10)
+        base.add_item(raster)
+
+        river_pen = QPen(QColor(40, 90, 200), 3)
+        for _ in range(300):
+            item = QGraphicsPathItem(random_walk(rng, (rng.uniform(0, 4000), rng.uniform(0, 3000)),
+                                                 60, 10))
+            item.setPen(river_pen)
+            rivers.add_item(item)
+
+        border_pen = QPen(QColor(120, 40, 40), 2, Qt.PenStyle.DashLine)
+        for _ in range(40):
+            x, y = rng.uniform(0, 3600), rng.uniform(0, 2600)
+            item = QGraphicsPathItem(random_walk(rng, (x, y), 80, 15))
+            item.setPen(border_pen)
+            item.setBrush(QBrush(QColor(200, 120, 120, 40)))
+            borders.add_item(item)
+
+        elements = [map_elements.City(f"City {i}", [map_elements.Coordinates(
+                        rng.uniform(0, 4000), rng.uniform(0, 3000))],
+                        population=rng.randint(100, 5000000)) for i in range(5000)]
+        labels.add_item(LabelLayerItem(elements))
+
+        self.view = LayeredView(scene, self.stack)
+        self.view.scale(0.25, 0.25)
+        self.stack.set_view_scale(0.25)
+        self.setCentralWidget(self.view)
+
+        dock = QDockWidget("Layers", self)
+        dock.setWidget(LayerPanel(self.stack))
+        self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, dock)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
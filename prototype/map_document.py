@@ -0,0 +1,245 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from prototype_loader import load_prototype
+from spatial_index import BBox, points_bbox
+
+map_elements = load_prototype("map-elements")
+
+Point = Tuple[float, float]
+
+CHUNK_SIZE = 1 << 20  # Characters read at a time when streaming a map file
+WHITESPACE = " \t\r\n"
+
+
+@dataclass
+class Stroke:
+    """A polyline drawn on the map, in scene coordinates"""
+    points: List[Point]
+    color: str = "#000000"
+    width: float = 2.0
+
+    def bbox(self) -> BBox:
+        return points_bbox(self.points, self.width)
+
+
+@dataclass
+class Figure:
+    """A figure as built by FigureGraphicsItem, closed or not"""
+    points: List[Point]
+    is_closed: bool = False
+    color: str = "#000000"
+    width: float = 2.0
+    fill: Optional[str] = None
+
+    def bbox(self) -> BBox:
+        return points_bbox(self.points, self.width)
+
+
+@dataclass
+class Raster:
+    """Base image of the map, placed at (x, y) in the scene"""
+    path: str
+    x: float = 0.0
+    y: float = 0.0
+
+
+@dataclass
+class MapDocument:
+    """Everything a map is made of, independent of any widget"""
+    raster: Optional[Raster] = None
+    strokes: List[Stroke] = field(default_factory=list)
+    figures: List[Figure] = field(default_factory=list)
+    elements: list = field(default_factory=list)
+
+
+def element_anchor(element) -> Point:
+    """Point where the element is shown: its position, or the centre of its outline"""
+    coordinates = element.coordinates
+    x = sum(c.x for c in coordinates) / len(coordinates)
+    y = sum(c.y for c in coordinates) / len(coordinates)
+    return (x, y)
+
+
+def element_to_dict(element) -> dict:
+    data = {
+        "name": element.name,
+        "coordinates": [[c.x, c.y] for c in element.coordinates],
+    }
+    if isinstance(element, map_elements.City):
+        data.update(kind="city", population=element.population,
+                    is_capital=element.is_capital)
+    elif isinstance(element, map_elements.Mountain):
+        data.update(kind="mountain", altitude=vars(element.altitude).copy())
+    elif isinstance(element, map_elements.Biome):
+        data.update(kind="biome", climate=element.climate.value,
+                    terrain=element.terrain.value,
+                    altitude=vars(element.altitude).copy())
+    else:
+        raise ValueError(f"Unknown map element: {type(element).__name__}")
+    return data
+
+
+def element_from_dict(data: dict):
+    coordinates = [map_elements.Coordinates(x, y) for x, y in data["coordinates"]]
+    kind = data["kind"]
+    if kind == "city":
+        return map_elements.City(data["name"], coordinates,
+                                 population=data.get("population", 0),
+                                 is_capital=data.get("is_capital", False))
+    if kind == "mountain":
+        return map_elements.Mountain(data["name"], coordinates,
+                                     map_elements.Altitude(**data.get("altitude", {})))
+    if kind == "biome":
+        biome = map_elements.Biome(data["name"], coordinates,
+                                   climate=map_elements.Climate(data.get("climate", "temperate")),
+                                   terrain=map_elements.TerrainType(data.get("terrain", "flatland")))
+        biome.altitude = map_elements.Altitude(**data.get("altitude", {}))
+        return biome
+    raise ValueError(f"Unknown map element kind: {kind}")
+
+
+def document_to_dict(document: MapDocument) -> dict:
+    return {
+        "raster": vars(document.raster).copy() if document.raster else None,
+        "strokes": [{"points": [list(p) for p in s.points], "color": s.color,
+                     "width": s.width} for s in document.strokes],
+        "figures": [{"points": [list(p) for p in f.points], "closed": f.is_closed,
+                     "color": f.color, "width": f.width, "fill": f.fill}
+                    for f in document.figures],
+        "elements": [element_to_dict(e) for e in document.elements],
+    }
+
+
+def stroke_from_dict(data: dict) -> Stroke:
+    return Stroke([tuple(p) for p in data["points"]], data.get("color", "#000000"),
+                  data.get("width", 2.0))
+
+
+def figure_from_dict(data: dict) -> Figure:
+    return Figure([tuple(p) for p in data["points"]], data.get("closed", False),
+                  data.get("color", "#000000"), data.get("width", 2.0), data.get("fill"))
+
+
+def document_from_dict(data: dict) -> MapDocument:
+    raster = data.get("raster")
+    return MapDocument(
+        raster=Raster(**raster) if raster else None,
+        strokes=[stroke_from_dict(s) for s in data.get("strokes", [])],
+        figures=[figure_from_dict(f) for f in data.get("figures", [])],
+        elements=[element_from_dict(e) for e in data.get("elements", [])],
+    )
+
+
+def load_map(path: str) -> MapDocument:
+    with open(path, encoding="utf-8") as f:
+        document = document_from_dict(json.load(f))
+    # The raster path is relative to the map file
+    if document.raster and not os.path.isabs(document.raster.path):
+        document.raster.path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                            document.raster.path)
+    return document
+
+
+def save_map(document: MapDocument, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document_to_dict(document), f)
+
+
+class _JSONStream:
+    """Values decoded one at a time from a sliding window over a text file"""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        """Drop the text already read and append a chunk, False at the end of the file"""
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self, skipped=WHITESPACE) -> str:
+        """Next character after the skipped ones, "" at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skipped:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def decode(self):
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                # The value goes on in the next chunk
+                if not self.fill():
+                    raise
+
+
+def iter_map_array(path: str, key: str, chunk_size=CHUNK_SIZE):
+    """
+    Items of a top level array of a map file, decoded one by one
+
+    The arrays before it are skipped an item at a time too, so memory only
+    depends on the size of the largest item.
+    """
+    with open(path, encoding="utf-8") as f:
+        stream = _JSONStream(f, chunk_size)
+        if stream.peek() != "{":
+            raise ValueError(f"{path} is not a map document")
+        stream.pos += 1
+        while stream.peek(WHITESPACE + ",") not in ("}", ""):
+            name = stream.decode()
+            if stream.peek(WHITESPACE + ":") != "[":
+                stream.decode()
+                continue
+            stream.pos += 1
+            while True:
+                character = stream.peek(WHITESPACE + ",")
+                if character == "]":
+                    break
+                if not character:
+                    raise ValueError(f"Unexpected end of {path} in '{name}'")
+                item = stream.decode()
+                if name == key:
+                    yield item
+            stream.pos += 1
+            if name == key:
+                return
+
+
+class StreamedMap:
+    """
+    Layers of a map file, read again on every pass
+
+    Drop-in for a MapDocument wherever layers are only iterated, by the
+    exporters for instance: each access to strokes, figures or elements
+    streams them from the file, one shape in memory at a time. The raster
+    is not read.
+    """
+
+    raster = None
+
+    def __init__(self, path: str, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    @property
+    def strokes(self):
+        return (stroke_from_dict(s) for s in iter_map_array(self.path, "strokes", self.chunk_size))
+
+    @property
+    def figures(self):
+        return (figure_from_dict(f) for f in iter_map_array(self.path, "figures", self.chunk_size))
+
+    @property
+    def elements(self):
+        return (element_from_dict(e) for e in iter_map_array(self.path, "elements", self.chunk_size))
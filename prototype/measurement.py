@@ -0,0 +1,299 @@
+"""
+Ground distances for the scale bar and the measurement tool
+
+Scene points are turned back into longitude and latitude through the map's
+projection, then measured on the sphere (haversine) or on the WGS84 ellipsoid
+(Vincenty). Both take whole arrays, so a polyline is measured in one call.
+
+The view draws its geographic geometry, a graticule here, through the shared
+projection cache. Switching projection projects it on the cache's worker
+thread and only swaps the paths in on the GUI thread once it is done.
+"""
+import sys
+
+import numpy as np
+
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QComboBox,
+                             QGraphicsPathItem, QGraphicsSimpleTextItem, QGraphicsItem)
+from PyQt6.QtCore import Qt, QPointF, pyqtSignal
+from PyQt6.QtGui import QPen, QColor, QPainterPath, QPolygonF
+
+from graduation2 import MapView, ScaleWidget
+from gl_viewport import viewport_from_env
+from instrumentation import install_from_env
+from projection import EARTH_RADIUS, PROJECTIONS, Equirectangular, projection_cache
+
+# WGS84 ellipsoid, for Vincenty's formulae
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+CM_PIXELS = 100  # Same convention as ScaleWidget: 1 cm of scale bar is 100 pixels
+GRATICULE_STEP = 15  # Degrees between graticule lines
+
+
+def haversine(lon1, lat1, lon2, lat2, radius=EARTH_RADIUS):
+    """Great-circle distances in metres between arrays of points in degrees"""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=np.float64))
+                              for a in (lon1, lat1, lon2, lat2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def vincenty(lon1, lat1, lon2, lat2, iterations=200, tolerance=1e-12):
+    """
+    Ellipsoidal distances in metres, Vincenty's inverse formula on arrays
+
+    Nearly antipodal pairs, where the iteration does not converge, fall back to
+    the haversine distance.
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=np.float64))
+                              for a in (lon1, lat1, lon2, lat2))
+    lon1, lat1, lon2, lat2 = np.broadcast_arrays(lon1, lat1, lon2, lat2)
+    shape = lon1.shape
+    lon1, lat1, lon2, lat2 = (a.ravel() for a in (lon1, lat1, lon2, lat2))
+    f = WGS84_F
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    sin_sigma, cos_sigma, sigma = (np.zeros(L.shape) for _ in range(3))
+    cos2_alpha, cos_2sigma_m = np.zeros(L.shape), np.zeros(L.shape)
+    # Iterate only on the pairs that haven't converged yet
+    active = np.arange(L.size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(iterations):
+            if not len(active):
+                break
+            lam_a = lam[active]
+            u1s, u1c = sinU1[active], cosU1[active]
+            u2s, u2c = sinU2[active], cosU2[active]
+            sin_lam, cos_lam = np.sin(lam_a), np.cos(lam_a)
+            s_sigma = np.sqrt((u2c * sin_lam) ** 2 + (u1c * u2s - u1s * u2c * cos_lam) ** 2)
+            c_sigma = u1s * u2s + u1c * u2c * cos_lam
+            sig = np.arctan2(s_sigma, c_sigma)
+            sin_alpha = np.where(s_sigma == 0, 0.0, u1c * u2c * sin_lam / s_sigma)
+            c2_alpha = 1 - sin_alpha ** 2
+            c_2sigma_m = np.where(c2_alpha == 0, 0.0, c_sigma - 2 * u1s * u2s / c2_alpha)
+            C = f / 16 * c2_alpha * (4 + f * (4 - 3 * c2_alpha))
+            new_lam = L[active] + (1 - C) * f * sin_alpha * (
+                sig + C * s_sigma * (c_2sigma_m + C * c_sigma * (-1 + 2 * c_2sigma_m ** 2)))
+            for array, values in ((lam, new_lam), (sin_sigma, s_sigma), (cos_sigma, c_sigma),
+                                  (sigma, sig), (cos2_alpha, c2_alpha),
+                                  (cos_2sigma_m, c_2sigma_m)):
+                array[active] = values
+            active = active[~(np.abs(new_lam - lam_a) < tolerance)]
+        converged = np.ones(L.shape, dtype=bool)
+        converged[active] = False
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = WGS84_B * A * (sigma - delta_sigma)
+
+    fallback = ~converged | ~np.isfinite(distance)
+    if fallback.any():
+        distance = np.where(fallback, haversine(np.degrees(lon1), np.degrees(lat1),
+                                                np.degrees(lon2), np.degrees(lat2)), distance)
+    return distance.reshape(shape)
+
+
+def segment_lengths(lonlat, method=haversine):
+    """Length in metres of each segment of an (n, 2) lon/lat polyline"""
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    if len(lonlat) < 2:
+        return np.zeros(0)
+    return method(lonlat[:-1, 0], lonlat[:-1, 1], lonlat[1:, 0], lonlat[1:, 1])
+
+
+def polyline_length(lonlat, method=haversine) -> float:
+    return float(segment_lengths(lonlat, method).sum())
+
+
+def graticule(step=GRATICULE_STEP, samples_per_degree=1):
+    """Meridians and parallels as (key, (n, 2) lon/lat array), densely sampled to bend"""
+    lines = []
+    latitudes = np.linspace(-80, 80, 160 * samples_per_degree + 1)
+    for lon in range(-180, 181, step):
+        lonlat = np.column_stack((np.full(len(latitudes), lon), latitudes))
+        lines.append((("meridian", lon), lonlat))
+    longitudes = np.linspace(-180, 180, 360 * samples_per_degree + 1)
+    for lat in range(-75, 76, step):
+        lonlat = np.column_stack((longitudes, np.full(len(longitudes), lat)))
+        lines.append((("parallel", lat), lonlat))
+    return lines
+
+
+def format_distance(metres: float) -> str:
+    if metres >= 1000:
+        return f"{metres / 1000:.1f} km"
+    return f"{metres:.1f} m"
+
+
+class GeodesicMapView(MapView):
+    """
+    MapView whose scale comes from the ground distance at the viewport centre
+
+    The map is assumed to be drawn in a projection, with the geographic point
+    origin (lon, lat) at scene position (0, 0). Shift+click draws a measurement
+    polyline, Escape clears it.
+    """
+
+    # Emitted from the projection worker once a projection's geometry is cached
+    projected = pyqtSignal(object)
+
+    def __init__(self, scale_widget, projection=None, origin=(-180.0, 90.0)):
+        self.projection = projection or Equirectangular()
+        self.origin_lonlat = origin
+        self.origin = self.projection.to_scene([origin[0]], [origin[1]])[0]
+        self.measure_points = []
+        self.measure_item = None
+        self.measure_label = None
+        super().__init__(scale_widget)
+        # Panning moves the centre, where the scale is measured
+        self.horizontalScrollBar().valueChanged.connect(self.updateScale)
+        self.verticalScrollBar().valueChanged.connect(self.updateScale)
+
+        # Geographic geometry, drawn in the current projection
+        self.geometries = dict(graticule())
+        self.geometry_items = {}
+        graticule_layer = self.layers.add_layer("Graticule")
+        self.layers.add_layer("Measurement")
+        pen = QPen(QColor(120, 120, 160), 1)
+        pen.setCosmetic(True)
+        for key in self.geometries:
+            item = QGraphicsPathItem()
+            item.setPen(pen)
+            graticule_layer.add_item(item, key)
+            self.geometry_items[key] = item
+        self.pending_projection = None
+        self.projected.connect(self.apply_projection)
+        self.apply_projection(self.projection)
+
+    def set_projection(self, projection):
+        """Draw the map in another projection, projected away from the GUI thread"""
+        self.pending_projection = projection
+        future = projection_cache.prefetch(
+            projection, [(key, lonlat, 0) for key, lonlat in self.geometries.items()])
+        future.add_done_callback(lambda _: self.projected.emit(projection))
+
+    def apply_projection(self, projection):
+        """Swap the projected geometry in, read from the cache"""
+        if self.pending_projection not in (None, projection):
+            # The user switched again meanwhile
+            return
+        self.pending_projection = None
+        measured = self.to_geographic(self.measure_points) if self.measure_points else None
+        self.projection = projection
+        self.origin = projection.to_scene([self.origin_lonlat[0]], [self.origin_lonlat[1]])[0]
+        for key, lonlat in self.geometries.items():
+            # Cached by the prefetch, projected here only if it was evicted meanwhile
+            scene = projection_cache.get(projection, key, lonlat) - self.origin
+            path = QPainterPath()
+            path.addPolygon(QPolygonF([QPointF(x, y) for x, y in scene.tolist()]))
+            self.geometry_items[key].setPath(path)
+            self.layers["Graticule"].reindex(key)
+        if measured is not None:
+            scene = projection.to_scene(measured[:, 0], measured[:, 1]) - self.origin
+            self.measure_points = [QPointF(x, y) for x, y in scene.tolist()]
+            self.update_measure()
+        self.updateScale()
+
+    def to_geographic(self, points):
+        """Scene points to an (n, 2) lon/lat array"""
+        xy = np.array([(p.x(), p.y()) for p in points], dtype=np.float64).reshape(-1, 2)
+        xy += self.origin
+        return self.projection.to_geographic(xy[:, 0], xy[:, 1])
+
+    def updateScale(self):
+        # Ground distance covered by 1 cm of screen around the viewport centre
+        centre = self.viewport().rect().center()
+        left = self.mapToScene(centre.x() - CM_PIXELS // 2, centre.y())
+        right = self.mapToScene(centre.x() + CM_PIXELS // 2, centre.y())
+        lonlat = self.to_geographic([left, right])
+        metres = float(haversine(lonlat[0, 0], lonlat[0, 1], lonlat[1, 0], lonlat[1, 1]))
+        self.scale_widget.scale_label.setText(f"1 cm = {format_distance(metres)}")
+
+    def mousePressEvent(self, event):
+        if (event.button() == Qt.MouseButton.LeftButton and
+                event.modifiers() & Qt.KeyboardModifier.ShiftModifier):
+            self.measure_points.append(self.mapToScene(event.position().toPoint()))
+            self.update_measure()
+            return
+        super().mousePressEvent(event)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key.Key_Escape:
+            self.measure_points = []
+            self.update_measure()
+            return
+        super().keyPressEvent(event)
+
+    def update_measure(self):
+        if self.measure_item is None:
+            self.measure_item = QGraphicsPathItem()
+            pen = QPen(QColor(200, 0, 0), 2)
+            pen.setCosmetic(True)
+            self.measure_item.setPen(pen)
+            self.layers["Measurement"].add_item(self.measure_item, "path")
+            self.measure_label = QGraphicsSimpleTextItem()
+            self.measure_label.setFlag(QGraphicsItem.GraphicsItemFlag.ItemIgnoresTransformations)
+            self.layers["Measurement"].add_item(self.measure_label, "label")
+
+        path = QPainterPath()
+        if self.measure_points:
+            path.moveTo(self.measure_points[0])
+            for point in self.measure_points[1:]:
+                path.lineTo(point)
+        self.measure_item.setPath(path)
+
+        if len(self.measure_points) > 1:
+            length = polyline_length(self.to_geographic(self.measure_points), vincenty)
+            self.measure_label.setText(format_distance(length))
+            self.measure_label.setPos(self.measure_points[-1] + QPointF(5, 5))
+        else:
+            self.measure_label.setText("")
+        self.layers["Measurement"].reindex("path")
+        self.layers["Measurement"].reindex("label")
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Map Viewer with Geodesic Scale")
+        self.setGeometry(100, 100, 1000, 800)
+
+        main_widget = QWidget()
+        self.setCentralWidget(main_widget)
+        layout = QVBoxLayout(main_widget)
+
+        scale_widget = ScaleWidget()
+        self.map_view = GeodesicMapView(scale_widget)
+        viewport_from_env(self.map_view)
+        install_from_env(self.map_view)
+        projections = QComboBox()
+        projections.addItems(list(PROJECTIONS))
+        projections.setCurrentText(self.map_view.projection.name)
+        projections.currentTextChanged.connect(
+            lambda name: self.map_view.set_projection(PROJECTIONS[name]()))
+        layout.addWidget(projections)
+        layout.addWidget(self.map_view)
+        layout.addWidget(scale_widget)
+
+
+def main():
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
+
+
+if __name__ == "__main__":
+    main()
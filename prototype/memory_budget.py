@@ -0,0 +1,316 @@
+"""
+One memory budget shared by the caches of the map
+
+Caches open an account and charge it the size of every entry they keep,
+touching entries when they are used again. When the total goes over the
+budget, entries are evicted lowest priority first and least recently used
+first within a priority: flattened curves go before labels, text and
+projections, which go before loaded shards. Pinned entries, shards with
+unsaved changes for instance, are counted but never evicted. A charge only
+evicts entries of its own priority or lower: when that is not enough, the
+budget is overshot until a later charge or set_limit() catches up.
+
+Caches are rarely thread-safe, so an account is only asked to evict on the
+thread that opened it. Evictions chosen while another thread was charging
+wait in the account until its own thread next uses it; caches guarding their
+entries with a lock can register with any_thread=True instead.
+
+    MAP_MEMORY_BUDGET=256M MAP_PROFILE=1 python keep_same_width.py
+
+Sizes are estimates, good enough to compare subsystems and to keep a long
+session bounded, not a measure of the heap.
+"""
+import inspect
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List
+
+# Eviction order, cheapest to rebuild first
+LOW, NORMAL, HIGH = 0, 1, 2
+
+DEFAULT_BUDGET = 512 * 2 ** 20
+UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+
+
+def parse_size(text: str) -> int:
+    """Bytes in "512M", "1.5G", "65536"..."""
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def budget_from_env() -> int:
+    value = os.environ.get("MAP_MEMORY_BUDGET")
+    return parse_size(value) if value else DEFAULT_BUDGET
+
+
+def array_bytes(array) -> int:
+    return int(array.nbytes) + 112
+
+
+def points_bytes(count: int) -> int:
+    """A QPolygonF, or a list of (x, y) tuples once boxed floats are counted"""
+    return 16 * count + 64
+
+
+def pixmap_bytes(pixmap) -> int:
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+def index_bytes(index) -> int:
+    """A spatial_index.GridIndex: a tuple per box, a set per cell and a slot per key in it"""
+    return (160 * len(index.bboxes) + 220 * len(index.cells)
+            + 40 * sum(len(keys) for keys in index.cells.values()))
+
+
+def text_bytes(text: str) -> int:
+    """Shaped text: layout, glyph indices and positions"""
+    return 320 + 48 * len(text)
+
+
+def format_bytes(size: int) -> str:
+    for unit, factor in (("GB", 2 ** 30), ("MB", 2 ** 20), ("KB", 2 ** 10)):
+        if size >= factor:
+            return f"{size / factor:.1f} {unit}"
+    return f"{size} B"
+
+
+class Account:
+    """
+    Entries of one cache
+
+    :param subsystem: Name usage is reported under, shared by caches of the same kind
+    :param evict: Called with the key of an entry the budget dropped, for the cache to forget it
+    :param any_thread: Whether evict may be called from any thread, rather than the account's own
+    """
+
+    def __init__(self, budget: "MemoryBudget", subsystem: str, evict: Callable, priority: int,
+                 any_thread=False):
+        self.budget = budget
+        self.subsystem = subsystem
+        self.priority = priority
+        self.thread = None if any_thread else threading.get_ident()
+        # Bound methods are held weakly, an account doesn't keep its cache alive
+        if inspect.ismethod(evict):
+            self._evict = weakref.WeakMethod(evict)
+        else:
+            self._evict = lambda: evict
+        self.entries: Dict[Hashable, int] = {}
+        self.pinned = set()
+        self.used = 0
+        # Keys evicted from another thread, forgotten when this account's thread comes back
+        self.deferred: List[Hashable] = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def charge(self, key: Hashable, size: int):
+        """Count an entry, or its new size, evicting others if the budget is exceeded"""
+        self.budget._charge(self, key, size)
+        self.run_deferred()
+
+    def touch(self, key: Hashable):
+        """Mark an entry as just used"""
+        self.budget._touch(self, key)
+        self.run_deferred()
+
+    def release(self, key: Hashable):
+        """Stop counting an entry the cache dropped itself"""
+        self.budget._release(self, key)
+
+    def pin(self, key: Hashable):
+        """Keep an entry from being evicted, it is still counted"""
+        self.budget._pin(self, key, True)
+
+    def unpin(self, key: Hashable):
+        self.budget._pin(self, key, False)
+
+    def clear(self):
+        for key in list(self.entries):
+            self.release(key)
+
+    def owns_thread(self) -> bool:
+        return self.thread is None or self.thread == threading.get_ident()
+
+    def evict(self, key: Hashable):
+        if not self.owns_thread():
+            with self.budget.lock:
+                self.deferred.append(key)
+            return
+        evict = self._evict()
+        if evict is not None:
+            evict(key)
+
+    def run_deferred(self):
+        """Forget the entries evicted while another thread was charging"""
+        if not self.deferred or not self.owns_thread():
+            return
+        with self.budget.lock:
+            # Entries charged again since then are back in use
+            keys = [key for key in self.deferred if key not in self.entries]
+            self.deferred.clear()
+        evict = self._evict()
+        if evict is not None:
+            for key in keys:
+                evict(key)
+
+
+class MemoryBudget:
+    """
+    Byte budget over every registered cache
+
+    :param limit: Bytes the caches may use together
+    """
+
+    def __init__(self, limit=DEFAULT_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.usage: Dict[str, int] = {}
+        self.entries: Dict[str, int] = {}
+        self.evictions: Dict[str, int] = {}
+        # Evictable entries per priority, as (account, key), least recently used first
+        self.lru: Dict[int, OrderedDict] = {priority: OrderedDict() for priority in (LOW, NORMAL, HIGH)}
+        self.lock = threading.RLock()
+
+    def register(self, subsystem: str, evict: Callable, priority=NORMAL,
+                 any_thread=False) -> Account:
+        """
+        Open an account for a cache, owned by the calling thread
+
+        When evict is a bound method, the account is cleared once its
+        object is garbage collected.
+        """
+        account = Account(self, subsystem, evict, priority, any_thread)
+        with self.lock:
+            self.usage.setdefault(subsystem, 0)
+            self.entries.setdefault(subsystem, 0)
+            self.evictions.setdefault(subsystem, 0)
+        if inspect.ismethod(evict):
+            weakref.finalize(evict.__self__, account.clear)
+        return account
+
+    def set_limit(self, limit: int):
+        with self.lock:
+            self.limit = limit
+            victims = self._select_victims(HIGH, None)
+        self._evict(victims)
+
+    def _count(self, account: Account, size: int):
+        account.used += size
+        self.used += size
+        self.usage[account.subsystem] += size
+
+    def _charge(self, account: Account, key, size: int):
+        with self.lock:
+            previous = account.entries.get(key)
+            if previous is None:
+                self.entries[account.subsystem] += 1
+                previous = 0
+            account.entries[key] = size
+            self._count(account, size - previous)
+            if key not in account.pinned:
+                lru = self.lru[account.priority]
+                lru[(account, key)] = None
+                lru.move_to_end((account, key))
+            victims = self._select_victims(account.priority, (account, key))
+        self._evict(victims)
+
+    def _touch(self, account: Account, key):
+        with self.lock:
+            lru = self.lru[account.priority]
+            if (account, key) in lru:
+                lru.move_to_end((account, key))
+
+    def _release(self, account: Account, key):
+        with self.lock:
+            self._forget(account, key)
+
+    def _forget(self, account: Account, key):
+        size = account.entries.pop(key, None)
+        if size is None:
+            return
+        self.entries[account.subsystem] -= 1
+        self._count(account, -size)
+        account.pinned.discard(key)
+        self.lru[account.priority].pop((account, key), None)
+
+    def _pin(self, account: Account, key, pinned: bool):
+        with self.lock:
+            if key not in account.entries:
+                return
+            lru = self.lru[account.priority]
+            if pinned:
+                account.pinned.add(key)
+                lru.pop((account, key), None)
+                return
+            account.pinned.discard(key)
+            lru[(account, key)] = None
+            victims = self._select_victims(account.priority, (account, key))
+        self._evict(victims)
+
+    def _select_victims(self, highest: int, keep) -> list:
+        """
+        Drop entries until within the limit, up to a priority and keep excepted
+
+        Charging a flattened curve never pushes out a shard: when the entries
+        up to its priority are not enough, the budget stays exceeded.
+        """
+        victims = []
+        for priority in sorted(p for p in self.lru if p <= highest):
+            lru = self.lru[priority]
+            while self.used > self.limit and lru:
+                entry = next(iter(lru))
+                if entry == keep:
+                    # The entry being charged goes last, and stays if alone
+                    lru.move_to_end(entry)
+                    if len(lru) == 1:
+                        return victims
+                    entry = next(iter(lru))
+                account, key = entry
+                self._forget(account, key)
+                self.evictions[account.subsystem] += 1
+                victims.append(entry)
+        return victims
+
+    @staticmethod
+    def _evict(victims):
+        # Outside the lock: caches take their own locks to forget entries
+        for account, key in victims:
+            account.evict(key)
+
+    def rows(self) -> List[str]:
+        """Usage per subsystem, for the profiler overlay"""
+        with self.lock:
+            lines = [f"memory {format_bytes(self.used):>10} / {format_bytes(self.limit)}"]
+            for subsystem, used in sorted(self.usage.items(), key=lambda item: -item[1]):
+                lines.append(f"  {subsystem:<14}{format_bytes(used):>10} "
+                             f"{self.entries[subsystem]:6d} -{self.evictions[subsystem]}")
+        return lines
+
+
+# Shared by every cache of the application
+memory_budget = MemoryBudget(budget_from_env())
+
+
+if __name__ == "__main__":
+    import time
+
+    from bezier import BezierPath, synthetic_stroke
+    # The instance the caches imported, not this script's own copy
+    from memory_budget import memory_budget
+
+    # Flatten far more curves than fit, the oldest buckets are evicted
+    memory_budget.set_limit(4 * 2 ** 20)
+    paths = [BezierPath.fit(synthetic_stroke(200, seed)) for seed in range(500)]
+    start = time.perf_counter()
+    for scale in (0.25, 1.0, 4.0, 16.0):
+        for path in paths:
+            path.at_scale(scale)
+    print(f"flattened in {time.perf_counter() - start:.2f} s")
+    print("\n".join(memory_budget.rows()))
@@ -0,0 +1,189 @@
+from typing import Dict, Hashable, Optional
+
+import numpy as np
+
+from spatial_index import GridIndex, BBox, bbox_intersects
+
+POINT_BLOCK = 4096  # Points tested at once, bounds the (points x edges) temporaries
+
+
+class Polygon:
+    """
+    Closed ring of vertices with cached geometry
+
+    The vertices are never modified in place: an edited figure builds a new
+    Polygon, so the cached bounding box and edge bands can't go stale.
+    """
+
+    def __init__(self, points):
+        vertices = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        # Figures repeat their first point to close the outline
+        if len(vertices) > 1 and np.array_equal(vertices[0], vertices[-1]):
+            vertices = vertices[:-1]
+        if len(vertices) < 3:
+            raise ValueError("A polygon needs at least 3 vertices")
+        self.vertices = vertices
+        self._bbox = None
+        self._bands = None
+
+    def __len__(self):
+        return len(self.vertices)
+
+    @property
+    def bbox(self) -> BBox:
+        if self._bbox is None:
+            low = self.vertices.min(axis=0)
+            high = self.vertices.max(axis=0)
+            self._bbox = (low[0], low[1], high[0], high[1])
+        return self._bbox
+
+    def edges(self):
+        """Start and end points of every edge, closing edge included"""
+        return self.vertices, np.roll(self.vertices, -1, axis=0)
+
+    @property
+    def signed_area(self) -> float:
+        x, y = self.vertices[:, 0], self.vertices[:, 1]
+        return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+    @property
+    def area(self) -> float:
+        return abs(self.signed_area)
+
+    @property
+    def centroid(self):
+        x, y = self.vertices[:, 0], self.vertices[:, 1]
+        x1, y1 = np.roll(x, -1), np.roll(y, -1)
+        cross = x * y1 - x1 * y
+        factor = 1.0 / (6.0 * self.signed_area)
+        return (float(((x + x1) * cross).sum() * factor),
+                float(((y + y1) * cross).sum() * factor))
+
+    def _edge_bands(self):
+        """
+        Edges grouped by horizontal band, computed once
+
+        A point only needs the edges crossing its own band, which keeps the
+        point in polygon test far from (points x all edges) on big outlines.
+        """
+        if self._bands is None:
+            start, end = self.edges()
+            min_y, max_y = self.bbox[1], self.bbox[3]
+            count = max(1, int(np.sqrt(len(self.vertices))))
+            limits = np.linspace(min_y, max_y, count + 1)
+            low = np.minimum(start[:, 1], end[:, 1])
+            high = np.maximum(start[:, 1], end[:, 1])
+            bands = [np.flatnonzero((low <= limits[i + 1]) & (high >= limits[i]))
+                     for i in range(count)]
+            self._bands = (limits, bands)
+        return self._bands
+
+    def contains(self, points) -> np.ndarray:
+        """
+        Even-odd point in polygon test for many points at once
+
+        :param points: Array-like of shape (n, 2)
+        :return: Boolean array of length n
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        result = np.zeros(len(points), dtype=bool)
+        min_x, min_y, max_x, max_y = self.bbox
+        candidates = np.flatnonzero((points[:, 0] >= min_x) & (points[:, 0] <= max_x) &
+                                    (points[:, 1] >= min_y) & (points[:, 1] <= max_y))
+        if not len(candidates):
+            return result
+
+        start, end = self.edges()
+        limits, bands = self._edge_bands()
+        point_bands = np.clip(np.searchsorted(limits, points[candidates, 1], side="right") - 1,
+                              0, len(bands) - 1)
+        for band in np.unique(point_bands):
+            edges = bands[band]
+            x0, y0 = start[edges, 0], start[edges, 1]
+            x1, y1 = end[edges, 0], end[edges, 1]
+            in_band = candidates[point_bands == band]
+            for i in range(0, len(in_band), POINT_BLOCK):
+                block = in_band[i:i + POINT_BLOCK]
+                px = points[block, 0][:, None]
+                py = points[block, 1][:, None]
+                # Edges straddling the horizontal line through each point
+                straddles = (y0 > py) != (y1 > py)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    cross_x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+                crossings = np.count_nonzero(straddles & (px < cross_x), axis=1)
+                result[block] = crossings % 2 == 1
+        return result
+
+    def overlaps(self, other: "Polygon") -> bool:
+        """True if the interiors or outlines of both polygons meet"""
+        if not bbox_intersects(self.bbox, other.bbox):
+            return False
+        if self.contains(other.vertices[:1])[0] or other.contains(self.vertices[:1])[0]:
+            return True
+        return segments_intersect(*self.edges(), *other.edges())
+
+
+def segments_intersect(a_start, a_end, b_start, b_end) -> bool:
+    """True if any segment of the first set crosses any segment of the second"""
+    for i in range(0, len(a_start), POINT_BLOCK):
+        p, p2 = a_start[i:i + POINT_BLOCK, None], a_end[i:i + POINT_BLOCK, None]
+        r = p2 - p
+        s = b_end - b_start
+        qp = b_start - p
+        denominator = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denominator
+            u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denominator
+        if np.any((denominator != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)):
+            return True
+    return False
+
+
+class RegionIndex:
+    """
+    Polygons indexed by their bounding boxes, for region queries
+
+    Keys can be anything hashable, a Biome for instance.
+    """
+
+    def __init__(self, cell_size: float = 256.0):
+        self.polygons: Dict[Hashable, Polygon] = {}
+        self.grid = GridIndex(cell_size)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def add(self, key: Hashable, polygon: Polygon):
+        self.polygons[key] = polygon
+        self.grid.insert(key, polygon.bbox)
+
+    def remove(self, key: Hashable):
+        self.polygons.pop(key, None)
+        self.grid.remove(key)
+
+    def regions_at(self, points) -> list:
+        """For each point, the key of a region containing it, or None"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        result = [None] * len(points)
+        if not len(points):
+            return result
+        low = points.min(axis=0)
+        high = points.max(axis=0)
+        for key in self.grid.query((low[0], low[1], high[0], high[1])):
+            for i in np.flatnonzero(self.polygons[key].contains(points)):
+                result[i] = key
+        return result
+
+    def region_at(self, x: float, y: float) -> Optional[Hashable]:
+        return self.regions_at([(x, y)])[0]
+
+    def overlapping(self, polygon: Polygon) -> list:
+        """Keys of the regions overlapping a polygon"""
+        return [key for key in self.grid.query(polygon.bbox)
+                if self.polygons[key].overlaps(polygon)]
+
+
+def biome_polygon(biome) -> Polygon:
+    """Polygon outlined by the coordinates of a Biome"""
+    return Polygon([(c.x, c.y) for c in biome.coordinates])
+
@@ -0,0 +1,274 @@
+"""
+Map projections between geographic and scene coordinates
+
+Every transform works on whole NumPy arrays. Geographic coordinates are in
+degrees; map-elements' Coordinates hold the latitude in x and the longitude
+in y, as in Coordinates(27.9881, 86.9250) for Everest. Scene coordinates are
+metres on the sphere times scene_scale, with y growing downwards like Qt's.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from memory_budget import NORMAL, array_bytes, memory_budget
+
+EARTH_RADIUS = 6371008.8  # Mean radius in metres
+MAX_MERCATOR_LATITUDE = 85.0511287798
+
+
+class Projection(ABC):
+    """Base class: subclasses implement project() and unproject() in metres"""
+
+    name = "projection"
+
+    def __init__(self, scene_scale=1e-3, radius=EARTH_RADIUS):
+        self.scene_scale = scene_scale
+        self.radius = radius
+
+    @property
+    def key(self):
+        """Identifies the projection and its parameters, for caches"""
+        return (self.name, self.scene_scale, self.radius)
+
+    @abstractmethod
+    def project(self, lon, lat):
+        """Radians to metres, x eastwards and y northwards"""
+
+    @abstractmethod
+    def unproject(self, x, y):
+        """Metres to radians, (lon, lat)"""
+
+    def to_scene(self, lon, lat):
+        """Degrees to scene coordinates, as an (n, 2) array"""
+        x, y = self.project(np.radians(np.asarray(lon, dtype=np.float64)),
+                            np.radians(np.asarray(lat, dtype=np.float64)))
+        return np.column_stack((x * self.scene_scale, -y * self.scene_scale))
+
+    def to_geographic(self, scene_x, scene_y):
+        """Scene coordinates to degrees, as an (n, 2) array of (lon, lat)"""
+        lon, lat = self.unproject(np.asarray(scene_x, dtype=np.float64) / self.scene_scale,
+                                  -np.asarray(scene_y, dtype=np.float64) / self.scene_scale)
+        return np.column_stack((np.degrees(lon), np.degrees(lat)))
+
+
+class Equirectangular(Projection):
+    name = "equirectangular"
+
+    def __init__(self, standard_parallel=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.cos_parallel = np.cos(np.radians(standard_parallel))
+
+    @property
+    def key(self):
+        return super().key + (self.cos_parallel,)
+
+    def project(self, lon, lat):
+        return self.radius * lon * self.cos_parallel, self.radius * lat
+
+    def unproject(self, x, y):
+        return x / (self.radius * self.cos_parallel), y / self.radius
+
+
+class Mercator(Projection):
+    name = "mercator"
+
+    def project(self, lon, lat):
+        limit = np.radians(MAX_MERCATOR_LATITUDE)
+        lat = np.clip(lat, -limit, limit)
+        return self.radius * lon, self.radius * np.log(np.tan(np.pi / 4 + lat / 2))
+
+    def unproject(self, x, y):
+        return x / self.radius, 2 * np.arctan(np.exp(y / self.radius)) - np.pi / 2
+
+
+class LambertCylindricalEqualArea(Projection):
+    name = "lambert-cylindrical"
+
+    def project(self, lon, lat):
+        return self.radius * lon, self.radius * np.sin(lat)
+
+    def unproject(self, x, y):
+        return x / self.radius, np.arcsin(np.clip(y / self.radius, -1.0, 1.0))
+
+
+class Sinusoidal(Projection):
+    name = "sinusoidal"
+
+    def project(self, lon, lat):
+        return self.radius * lon * np.cos(lat), self.radius * lat
+
+    def unproject(self, x, y):
+        lat = y / self.radius
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lon = np.where(np.abs(np.cos(lat)) > 1e-12, x / (self.radius * np.cos(lat)), 0.0)
+        return lon, lat
+
+
+class Mollweide(Projection):
+    name = "mollweide"
+
+    def project(self, lon, lat):
+        # Solve 2t + sin 2t = pi sin(lat) for every point at once
+        lat = np.asarray(lat, dtype=np.float64)
+        theta = lat.copy()
+        target = np.pi * np.sin(lat)
+        # Newton iterations, only on the points that haven't converged yet
+        active = np.flatnonzero(np.abs(np.abs(lat) - np.pi / 2) > 1e-10)
+        for _ in range(50):
+            if not len(active):
+                break
+            t = theta[active]
+            step = (2 * t + np.sin(2 * t) - target[active]) / (2 + 2 * np.cos(2 * t))
+            theta[active] = t - step
+            active = active[np.abs(step) > 1e-12]
+        x = self.radius * 2 * np.sqrt(2) / np.pi * lon * np.cos(theta)
+        y = self.radius * np.sqrt(2) * np.sin(theta)
+        return x, y
+
+    def unproject(self, x, y):
+        theta = np.arcsin(np.clip(y / (self.radius * np.sqrt(2)), -1.0, 1.0))
+        lat = np.arcsin(np.clip((2 * theta + np.sin(2 * theta)) / np.pi, -1.0, 1.0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lon = np.where(np.abs(np.cos(theta)) > 1e-12,
+                           np.pi * x / (2 * self.radius * np.sqrt(2) * np.cos(theta)), 0.0)
+        return lon, lat
+
+
+PROJECTIONS = {cls.name: cls for cls in (Equirectangular, Mercator,
+                                         LambertCylindricalEqualArea, Sinusoidal, Mollweide)}
+
+
+def coordinates_to_lonlat(coordinates) -> np.ndarray:
+    """Coordinates (latitude in x, longitude in y) to an (n, 2) array of (lon, lat)"""
+    return np.array([(c.y, c.x) for c in coordinates], dtype=np.float64).reshape(-1, 2)
+
+
+def project_many(projection: Projection, arrays):
+    """
+    Project several (n, 2) lon/lat arrays with a single vectorized call
+
+    :return: List of projected arrays, in the same order
+    """
+    arrays = list(arrays)
+    if not arrays:
+        return []
+    stacked = np.vstack(arrays)
+    projected = projection.to_scene(stacked[:, 0], stacked[:, 1])
+    splits = np.cumsum([len(a) for a in arrays])[:-1]
+    return np.split(projected, splits)
+
+
+class ProjectionCache:
+    """
+    Projected geometry, kept per projection
+
+    Geometry is identified by a key and a version number that the owner bumps
+    on every edit. Switching back to a projection reuses what was projected
+    before, and prefetch() projects everything on a worker thread so the GUI
+    thread doesn't stall when the user switches views; NumPy releases the GIL
+    during the heavy parts. Entries are charged to the memory budget.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="projection")
+        self.account = memory_budget.register("projection", self._evict, NORMAL, any_thread=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _store(self, cache_key, array):
+        dropped = []
+        with self.lock:
+            self.entries[cache_key] = array
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                dropped.append(self.entries.popitem(last=False)[0])
+        # The budget may evict from this cache, which takes the lock again
+        for key in dropped:
+            self.account.release(key)
+        self.account.charge(cache_key, array_bytes(array))
+
+    def _evict(self, cache_key):
+        with self.lock:
+            self.entries.pop(cache_key, None)
+
+    def lookup(self, projection: Projection, key, version=0):
+        """Cached scene coordinates, or None"""
+        cache_key = (projection.key, key, version)
+        with self.lock:
+            array = self.entries.get(cache_key)
+            if array is not None:
+                self.entries.move_to_end(cache_key)
+        if array is not None:
+            self.account.touch(cache_key)
+        return array
+
+    def get(self, projection: Projection, key, lonlat, version=0):
+        """Scene coordinates of a geometry, projected now if not cached"""
+        array = self.lookup(projection, key, version)
+        if array is None:
+            lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+            array = projection.to_scene(lonlat[:, 0], lonlat[:, 1])
+            self._store((projection.key, key, version), array)
+        return array
+
+    def project_all(self, projection: Projection, geometries):
+        """
+        Project every missing geometry in one vectorized call
+
+        :param geometries: Iterable of (key, lonlat array, version)
+        """
+        missing = [(key, np.asarray(lonlat, dtype=np.float64).reshape(-1, 2), version)
+                   for key, lonlat, version in geometries
+                   if self.lookup(projection, key, version) is None]
+        for (key, _, version), array in zip(missing,
+                                            project_many(projection, (g[1] for g in missing))):
+            self._store((projection.key, key, version), array)
+        return len(missing)
+
+    def prefetch(self, projection: Projection, geometries):
+        """project_all() on the worker thread, returns a Future"""
+        return self.executor.submit(self.project_all, projection, list(geometries))
+
+    def invalidate(self, key):
+        """Forget every projection of a geometry"""
+        with self.lock:
+            dropped = [k for k in self.entries if k[1] == key]
+            for cache_key in dropped:
+                del self.entries[cache_key]
+        for cache_key in dropped:
+            self.account.release(cache_key)
+
+
+# Shared by everything drawing geographic data
+projection_cache = ProjectionCache()
+
+
+if __name__ == "__main__":
+    from prototype_loader import load_prototype
+    map_elements = load_prototype("map-elements")
+
+    places = {"Everest": map_elements.Coordinates(27.9881, 86.9250),
+              "Paris": map_elements.Coordinates(48.8566, 2.3522)}
+    lonlat = coordinates_to_lonlat(places.values())
+    for name, cls in PROJECTIONS.items():
+        projection = cls()
+        scene = projection.to_scene(lonlat[:, 0], lonlat[:, 1])
+        back = projection.to_geographic(scene[:, 0], scene[:, 1])
+        print(f"{name:<20} " + "  ".join(f"{p}: ({x:9.1f}, {y:9.1f})"
+                                          for p, (x, y) in zip(places, scene))
+              + f"  round trip error {np.abs(back - lonlat).max():.1e} deg")
+
+    points = np.column_stack((np.random.uniform(-180, 180, 1000000),
+                              np.random.uniform(-80, 80, 1000000)))
+    for name, cls in PROJECTIONS.items():
+        start = time.perf_counter()
+        cls().to_scene(points[:, 0], points[:, 1])
+        print(f"{name:<20} 1M points in {(time.perf_counter() - start) * 1000:.0f} ms")
@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+PROTOTYPE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_prototype(name):
+    """
+    Import a prototype whose file name is not a valid module name
+
+    Some prototypes use dashes in their names (map-elements.py,
+    vector-zooming-efficient-memory.py), so a plain import cannot reach them.
+
+    :param name: File name of the prototype, without the .py extension
+    :return: The loaded module, shared between all callers
+    """
+    module_name = "prototype_" + name.replace("-", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    path = os.path.join(PROTOTYPE_DIR, name + ".py")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Register before executing so dataclasses and pickling can find the module
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
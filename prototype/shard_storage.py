@@ -0,0 +1,623 @@
+"""
+Map documents stored as independent shards, one per cell of the scene
+
+    python shard_storage.py split map.json map.shards --cell-size 4096 --workers 4
+    python shard_storage.py join map.shards map.json --workers 4
+    python shard_storage.py export map.shards map.geojson --region 0 0 2000 1000 --workers 4
+
+A shard holds the strokes, figures and elements whose centre falls in its
+cell, as a map document of its own. manifest.json lists the shards with the
+bounding box of what they hold, which can spill over the cell, so a region
+only loads the shards it can see. Shards are read, written, indexed and
+exported by a process pool, and a ShardedMap remembers which shards its
+edits touched: saving rewrites those and the manifest, nothing else.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from geo_export import LAYERS, ShapeFilter, svg_header, svg_layer, geojson_layer, _make_filters
+from map_document import (MapDocument, Raster, Stroke, document_from_dict, document_to_dict,
+                          load_map, save_map)
+from memory_budget import HIGH, memory_budget
+from spatial_index import BBox, GridIndex, bbox_intersects, points_bbox
+
+CELL_SIZE = 4096.0  # Side of a shard, in scene units
+INDEX_CELL_SIZE = 256.0
+MANIFEST = "manifest.json"
+SPILL_DIRECTORY = "spill"  # Inside the shard directory, while a ShardSink imports
+KINDS = ("strokes", "figures", "elements")
+# Estimated memory of a loaded shard: a boxed (x, y) tuple and its list slot, and a shape
+POINT_BYTES = 120
+SHAPE_BYTES = 400
+
+Cell = Tuple[int, int]
+ShapeKey = Tuple[Cell, str, int]  # (shard cell, kind, position in the shard's list)
+
+
+def cell_name(cell: Cell) -> str:
+    return f"{cell[0]}_{cell[1]}"
+
+
+def parse_cell(name: str) -> Cell:
+    x, y = name.split("_")
+    return int(x), int(y)
+
+
+def shape_bbox(kind: str, shape) -> BBox:
+    if kind == "elements":
+        return points_bbox([(c.x, c.y) for c in shape.coordinates])
+    return shape.bbox()
+
+
+def union_bbox(a: Optional[BBox], b: Optional[BBox]) -> Optional[BBox]:
+    if a is None or b is None:
+        return a or b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def as_stroke(line) -> Stroke:
+    """
+    Stroke to store for a line
+
+    :param line: A Stroke, or a VectorLine of keep_same_width or
+                 vector-zooming-efficient-memory
+    """
+    if isinstance(line, Stroke):
+        return line
+    from PyQt6.QtGui import QColor
+    if getattr(line, "curve", None) is not None:
+        points = [tuple(p) for p in line.curve.at_scale(1.0).tolist()]
+    elif hasattr(line, "start"):
+        points = [(line.start.x(), line.start.y()), (line.end.x(), line.end.y())]
+    else:
+        points = [(p.x(), p.y()) for p in line.points]
+    return Stroke(points, QColor(line.color).name(), float(line.width))
+
+
+def index_document(document: MapDocument, cell_size=INDEX_CELL_SIZE) -> Dict[str, GridIndex]:
+    """One index per kind of shape, keyed by position in the document's lists"""
+    indexes = {}
+    for kind in KINDS:
+        index = indexes[kind] = GridIndex(cell_size)
+        for position, shape in enumerate(getattr(document, kind)):
+            index.insert(position, shape_bbox(kind, shape))
+    return indexes
+
+
+def document_bytes(document: MapDocument) -> int:
+    size = 0
+    for shape in document.strokes + document.figures:
+        size += SHAPE_BYTES + POINT_BYTES * len(shape.points)
+    for element in document.elements:
+        size += SHAPE_BYTES + POINT_BYTES * len(element.coordinates)
+    return size
+
+
+def document_bbox(document: MapDocument) -> Optional[BBox]:
+    bbox = None
+    for kind in KINDS:
+        for shape in getattr(document, kind):
+            bbox = union_bbox(bbox, shape_bbox(kind, shape))
+    return bbox
+
+
+# Pool tasks, module level so that spawned workers can find them
+
+def _read_shard(path):
+    with open(path, encoding="utf-8") as f:
+        return document_from_dict(json.load(f))
+
+
+def _index_shard(document):
+    return index_document(document)
+
+
+def _write_shard(path, document):
+    """Write a shard, returns its bounding box"""
+    data = document_to_dict(document)
+    del data["raster"]  # Kept once, in the manifest
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    # Readers never see half a shard
+    os.replace(temporary, path)
+    return document_bbox(document)
+
+
+def _merge_spill(path, spill_path):
+    """Append the shapes of a spill file to a shard, created if missing, returns its bounding box"""
+    document = _read_shard(path) if os.path.exists(path) else MapDocument()
+    with open(spill_path, encoding="utf-8") as f:
+        for line in f:
+            spilled = document_from_dict(json.loads(line))
+            for kind in KINDS:
+                getattr(document, kind).extend(getattr(spilled, kind))
+    return _write_shard(path, document)
+
+
+def _export_shard(path, parts, output_format, region, resolution, projection_name, scene_scale):
+    """Serialize every layer of a shard into its part file, returns which have content"""
+    document = _read_shard(path)
+    shapes, formatter = _make_filters(region, resolution, projection_name, scene_scale)
+    written = []
+    for layer, part in parts:
+        has_content = False
+        with open(part, "w", encoding="utf-8") as f:
+            if output_format == "svg":
+                chunks = svg_layer(document, layer, shapes)
+            else:
+                chunks = (feature if i == 0 else ",\n" + feature for i, feature in
+                          enumerate(geojson_layer(document, layer, shapes, formatter)))
+            for chunk in chunks:
+                f.write(chunk)
+                has_content = True
+        written.append(has_content)
+    return written
+
+
+def pool_map(function, workers, *iterables) -> list:
+    """function over the iterables, in spawned processes when workers > 1"""
+    arguments = [list(iterable) for iterable in iterables]
+    count = len(arguments[0]) if arguments else 0
+    if workers <= 1 or count <= 1:
+        return list(map(function, *arguments))
+    workers = min(workers, count)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        # A few tasks per message, shards being many and small
+        return list(pool.map(function, *arguments, chunksize=max(1, count // (workers * 4))))
+
+
+class Shard:
+    """
+    Shapes of one cell
+
+    :param bbox: Bounding box of the shapes, None when the shard is empty
+    """
+
+    def __init__(self, cell: Cell, document: Optional[MapDocument] = None,
+                 bbox: Optional[BBox] = None):
+        self.cell = cell
+        # None until loaded
+        self.document = document
+        # Built by ShardedMap.index() when first queried
+        self.index: Optional[Dict[str, GridIndex]] = None
+        self.bbox = bbox
+
+    @property
+    def loaded(self) -> bool:
+        return self.document is not None
+
+    def __len__(self):
+        return sum(len(getattr(self.document, kind)) for kind in KINDS) if self.loaded else 0
+
+
+class ShardedMap:
+    """
+    Map document split into shards by cell of the scene
+
+    Shapes are addressed by ShapeKey. Removing a shape moves the ones after
+    it in the same shard down by one, as in a list; other shards keep their
+    keys. Loaded shards are charged to the memory budget, which unloads the
+    least recently used when it runs short; shards with unsaved changes are
+    pinned until saved.
+
+    :param directory: Directory holding the manifest and the shards
+    :param cell_size: Side of a shard's cell, in scene units
+    """
+
+    def __init__(self, directory: str, cell_size=CELL_SIZE):
+        self.directory = directory
+        self.cell_size = cell_size
+        self.raster: Optional[Raster] = None
+        self.shards: Dict[Cell, Shard] = {}
+        self.dirty: Set[Cell] = set()
+        self._deleted: Set[Cell] = set()
+        self._manifest_dirty = False
+        self.account = memory_budget.register("shards", self._evict, HIGH)
+
+    @classmethod
+    def open(cls, directory: str) -> "ShardedMap":
+        """Read the manifest of a sharded map, shards are loaded on demand"""
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        sharded = cls(directory, manifest["cell_size"])
+        raster = manifest.get("raster")
+        if raster:
+            sharded.raster = Raster(**raster)
+            # The raster path is relative to the shard directory
+            if not os.path.isabs(sharded.raster.path):
+                sharded.raster.path = os.path.join(os.path.abspath(directory), sharded.raster.path)
+        for name, entry in manifest["shards"].items():
+            cell = parse_cell(name)
+            sharded.shards[cell] = Shard(cell, bbox=tuple(entry["bbox"]))
+        return sharded
+
+    def path(self, cell: Cell) -> str:
+        return os.path.join(self.directory, cell_name(cell) + ".json")
+
+    def cell_of(self, bbox: BBox) -> Cell:
+        return (math.floor((bbox[0] + bbox[2]) / 2 / self.cell_size),
+                math.floor((bbox[1] + bbox[3]) / 2 / self.cell_size))
+
+    def cells(self, region: Optional[BBox] = None) -> List[Cell]:
+        """Shards holding shapes that may reach into region (min_x, min_y, max_x, max_y)"""
+        return [cell for cell, shard in self.shards.items()
+                if shard.bbox is not None and (region is None or bbox_intersects(shard.bbox, region))]
+
+    def load(self, region: Optional[BBox] = None, workers=1) -> List[Shard]:
+        """
+        Load the shards reaching into a region, all of them by default
+
+        :return: Those shards
+        """
+        cells = self.cells(region)
+        missing = [cell for cell in cells if not self.shards[cell].loaded]
+        for cell, document in zip(missing, pool_map(
+                _read_shard, workers, [self.path(cell) for cell in missing])):
+            self.shards[cell].document = document
+        shards = [self.shards[cell] for cell in cells]
+        for shard in shards:
+            self._charge(shard)
+        return shards
+
+    def shard(self, cell: Cell) -> Shard:
+        """A loaded shard, created empty when the cell has none"""
+        shard = self.shards.get(cell)
+        if shard is None:
+            shard = self.shards[cell] = Shard(cell, MapDocument())
+            shard.index = index_document(shard.document)
+            self._deleted.discard(cell)
+        elif not shard.loaded:
+            shard.document = _read_shard(self.path(cell))
+        self._charge(shard)
+        return shard
+
+    def _charge(self, shard: Shard):
+        if shard.cell in self.account:
+            self.account.touch(shard.cell)
+        elif shard.loaded:  # Not when evicted by the shards loaded with it
+            self.account.charge(shard.cell, document_bytes(shard.document))
+
+    def _evict(self, cell: Cell):
+        shard = self.shards.get(cell)
+        if shard is not None and cell not in self.dirty:
+            shard.document = shard.index = None
+
+    def mark_dirty(self, cell: Cell):
+        """Have the next save() write a shard, which stays loaded until then"""
+        self.dirty.add(cell)
+        self.account.pin(cell)
+
+    def index(self, workers=1):
+        """Index the loaded shards without an index, after loading or a removal"""
+        shards = [shard for shard in self.shards.values() if shard.loaded and shard.index is None]
+        for shard, index in zip(shards, pool_map(_index_shard, workers,
+                                                 [shard.document for shard in shards])):
+            shard.index = index
+
+    def unload(self):
+        """Forget the documents of the shards without unsaved changes"""
+        for cell, shard in self.shards.items():
+            if cell not in self.dirty:
+                shard.document = shard.index = None
+                self.account.release(cell)
+
+    def add(self, kind: str, shape) -> ShapeKey:
+        bbox = shape_bbox(kind, shape)
+        cell = self.cell_of(bbox)
+        shard = self.shard(cell)
+        shapes = getattr(shard.document, kind)
+        position = len(shapes)
+        shapes.append(shape)
+        if shard.index is not None:
+            shard.index[kind].insert(position, bbox)
+        shard.bbox = union_bbox(shard.bbox, bbox)
+        self.mark_dirty(cell)
+        return cell, kind, position
+
+    def add_stroke(self, line) -> ShapeKey:
+        """Add a Stroke or a VectorLine"""
+        return self.add("strokes", as_stroke(line))
+
+    def add_figure(self, figure) -> ShapeKey:
+        return self.add("figures", figure)
+
+    def add_element(self, element) -> ShapeKey:
+        return self.add("elements", element)
+
+    def get(self, key: ShapeKey):
+        cell, kind, position = key
+        return getattr(self.shard(cell).document, kind)[position]
+
+    def remove(self, key: ShapeKey):
+        cell, kind, position = key
+        shard = self.shard(cell)
+        del getattr(shard.document, kind)[position]
+        # Positions moved, index() rebuilds it
+        shard.index = None
+        if len(shard):
+            self.mark_dirty(cell)
+        else:
+            del self.shards[cell]
+            self.dirty.discard(cell)
+            self.account.release(cell)
+            self._deleted.add(cell)
+            self._manifest_dirty = True
+
+    def replace(self, key: ShapeKey, shape) -> ShapeKey:
+        """
+        Put a shape in place of another, moving it to another shard if its centre left the cell
+
+        :return: Key of the new shape
+        """
+        cell, kind, position = key
+        bbox = shape_bbox(kind, shape)
+        if self.cell_of(bbox) != cell:
+            self.remove(key)
+            return self.add(kind, shape)
+        shard = self.shard(cell)
+        getattr(shard.document, kind)[position] = shape
+        if shard.index is not None:
+            shard.index[kind].insert(position, bbox)
+        shard.bbox = union_bbox(shard.bbox, bbox)
+        self.mark_dirty(cell)
+        return key
+
+    def query(self, region: BBox, kinds=KINDS, workers=1) -> Iterator[ShapeKey]:
+        """Keys of the shapes whose bounding box intersects region, loading shards as needed"""
+        cells = [shard.cell for shard in self.load(region, workers)]
+        self.index(workers)
+        for cell in cells:
+            # Loading the last shards may have evicted the first ones on a tight budget
+            shard = self.shard(cell)
+            if shard.index is None:
+                shard.index = index_document(shard.document)
+            for kind in kinds:
+                for position in shard.index[kind].query(region):
+                    yield shard.cell, kind, position
+
+    def document(self, region: Optional[BBox] = None, workers=1) -> MapDocument:
+        """The shards reaching into a region, all of them by default, as one document"""
+        document = MapDocument(raster=self.raster)
+        for cell in sorted(shard.cell for shard in self.load(region, workers)):
+            shard = self.shard(cell)
+            for kind in KINDS:
+                getattr(document, kind).extend(getattr(shard.document, kind))
+        return document
+
+    def save(self, workers=1) -> int:
+        """
+        Write the shards changed since the last save, and the manifest
+
+        :return: Number of shards written
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        cells = sorted(self.dirty)
+        boxes = pool_map(_write_shard, workers, [self.path(cell) for cell in cells],
+                         [self.shards[cell].document for cell in cells])
+        for cell, bbox in zip(cells, boxes):
+            # Exact again, it only grew since the last save
+            self.shards[cell].bbox = bbox
+        self.dirty.clear()
+        for cell in cells:
+            self.account.charge(cell, document_bytes(self.shards[cell].document))
+            self.account.unpin(cell)
+        for cell in self._deleted:
+            if os.path.exists(self.path(cell)):
+                os.remove(self.path(cell))
+        if cells or self._manifest_dirty or not os.path.exists(os.path.join(self.directory, MANIFEST)):
+            self.write_manifest()
+        self._deleted.clear()
+        self._manifest_dirty = False
+        return len(cells)
+
+    def set_raster(self, raster: Optional[Raster]):
+        self.raster = raster
+        self._manifest_dirty = True
+
+    def write_manifest(self):
+        raster = None
+        if self.raster is not None:
+            raster = vars(self.raster).copy()
+            if os.path.isabs(raster["path"]):
+                raster["path"] = os.path.relpath(raster["path"], os.path.abspath(self.directory))
+        manifest = {
+            "cell_size": self.cell_size,
+            "raster": raster,
+            "shards": {cell_name(cell): {"bbox": list(shard.bbox)}
+                       for cell, shard in sorted(self.shards.items()) if shard.bbox is not None},
+        }
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+
+class ShardSink:
+    """
+    geo_import sink writing features into a ShardedMap
+
+    Features are gathered by shard and, every flush_size features, appended
+    to one spill file per shard, which keeps an import of any size within a
+    bounded memory. close() merges each spill file into its shard: every
+    shard is read and written once, however the input is ordered.
+    """
+
+    def __init__(self, sharded: ShardedMap, workers=1, flush_size=100000):
+        self.sharded = sharded
+        self.workers = workers
+        self.flush_size = flush_size
+        self.pending = 0
+        self.buffers: Dict[Cell, MapDocument] = {}
+        # Bounding box of everything spilled to each shard
+        self.boxes: Dict[Cell, BBox] = {}
+        self.spill_directory = os.path.join(sharded.directory, SPILL_DIRECTORY)
+
+    def spill_path(self, cell: Cell) -> str:
+        return os.path.join(self.spill_directory, cell_name(cell) + ".jsonl")
+
+    def _add(self, kind: str, shape):
+        bbox = shape_bbox(kind, shape)
+        cell = self.sharded.cell_of(bbox)
+        document = self.buffers.get(cell)
+        if document is None:
+            document = self.buffers[cell] = MapDocument()
+        getattr(document, kind).append(shape)
+        self.boxes[cell] = union_bbox(self.boxes.get(cell), bbox)
+        self.pending += 1
+        if self.pending >= self.flush_size:
+            self.flush()
+
+    def add_element(self, element):
+        self._add("elements", element)
+
+    def add_stroke(self, stroke):
+        self._add("strokes", as_stroke(stroke))
+
+    def add_figure(self, figure):
+        self._add("figures", figure)
+
+    def flush(self):
+        """Append the gathered features to their shards' spill files, a line each"""
+        os.makedirs(self.spill_directory, exist_ok=True)
+        for cell, document in self.buffers.items():
+            data = document_to_dict(document)
+            del data["raster"]
+            with open(self.spill_path(cell), "a", encoding="utf-8") as f:
+                f.write(json.dumps(data) + "\n")
+        self.buffers.clear()
+        self.pending = 0
+
+    def close(self):
+        """Merge the spill files into the shards, then write the manifest"""
+        self.flush()
+        sharded = self.sharded
+        # Shards on disk are the ones merged into, without loaded copies going stale
+        sharded.save(self.workers)
+        sharded.unload()
+        cells = sorted(self.boxes)
+        boxes = pool_map(_merge_spill, self.workers, [sharded.path(cell) for cell in cells],
+                         [self.spill_path(cell) for cell in cells])
+        for cell, bbox in zip(cells, boxes):
+            shard = sharded.shards.get(cell)
+            if shard is None:
+                sharded.shards[cell] = Shard(cell, bbox=bbox)
+            else:
+                shard.bbox = bbox
+        sharded.write_manifest()
+        shutil.rmtree(self.spill_directory, ignore_errors=True)
+        self.boxes.clear()
+
+
+def split_map(document: MapDocument, directory: str, cell_size=CELL_SIZE, workers=1) -> ShardedMap:
+    """Store a whole document as shards"""
+    sharded = ShardedMap(directory, cell_size)
+    sharded.set_raster(document.raster)
+    for kind in KINDS:
+        for shape in getattr(document, kind):
+            sharded.add(kind, shape)
+    sharded.save(workers)
+    return sharded
+
+
+def export_shards(directory, output, output_format=None, layers=LAYERS, region=None,
+                  resolution=0.0, projection_name=None, scene_scale=1e-3, workers=1):
+    """
+    geo_export.export_map for a sharded map, serializing shards in parallel
+
+    Only the shards reaching into the region are read. Parts are joined
+    layer by layer, so the output has the layout of export_map's.
+    """
+    if output_format is None:
+        output_format = "svg" if output.lower().endswith(".svg") else "geojson"
+    sharded = ShardedMap.open(directory)
+    rect = None if region is None else (region[0], region[1],
+                                        region[0] + region[2], region[1] + region[3])
+    cells = sorted(sharded.cells(rect))
+
+    with tempfile.TemporaryDirectory() as temporary:
+        parts = [[(layer, os.path.join(temporary, f"{cell_name(cell)}.{layer}.part"))
+                  for layer in layers] for cell in cells]
+        has_content = pool_map(
+            _export_shard, workers, [sharded.path(cell) for cell in cells], parts,
+            [output_format] * len(cells), [region] * len(cells), [resolution] * len(cells),
+            [projection_name] * len(cells), [scene_scale] * len(cells))
+
+        with open(output, "w", encoding="utf-8") as f:
+            if output_format == "svg":
+                if region is None:
+                    # The manifest knows the extent without reading any shard
+                    extent = None
+                    for cell in cells:
+                        extent = union_bbox(extent, sharded.shards[cell].bbox)
+                    x0, y0, x1, y1 = extent or (0, 0, 0, 0)
+                    region = (x0, y0, x1 - x0, y1 - y0)
+                f.writelines(svg_header(None, ShapeFilter(region, resolution)))
+            else:
+                f.write('{"type":"FeatureCollection","features":[\n')
+            first = True
+            for i, layer in enumerate(layers):
+                if output_format == "svg":
+                    f.write(f'<g id="{layer}">\n')
+                for shard_parts, shard_content in zip(parts, has_content):
+                    _, part = shard_parts[i]
+                    content = shard_content[i]
+                    if output_format != "svg" and content and not first:
+                        f.write(",\n")
+                    first = first and not content
+                    with open(part, encoding="utf-8") as part_file:
+                        shutil.copyfileobj(part_file, f)
+                if output_format == "svg":
+                    f.write("</g>\n")
+            f.write("</svg>\n" if output_format == "svg" else "\n]}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded map storage")
+    commands = parser.add_subparsers(dest="command", required=True)
+    split = commands.add_parser("split", help="Shard a map document")
+    split.add_argument("map", help="Map document (JSON)")
+    split.add_argument("directory", help="Shard directory to write")
+    split.add_argument("--cell-size", type=float, default=CELL_SIZE)
+    join = commands.add_parser("join", help="Join shards back into one map document")
+    join.add_argument("directory")
+    join.add_argument("map")
+    export = commands.add_parser("export", help="Export the vector layers of a sharded map")
+    export.add_argument("directory")
+    export.add_argument("output", help="Output file, .svg or .geojson")
+    export.add_argument("--format", choices=("svg", "geojson"), default=None)
+    export.add_argument("--layers", nargs="+", choices=LAYERS, default=list(LAYERS))
+    export.add_argument("--region", nargs=4, type=float, default=None,
+                        metavar=("X", "Y", "WIDTH", "HEIGHT"))
+    export.add_argument("--resolution", type=float, default=0.0)
+    for command in (split, join, export):
+        command.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "split":
+        sharded = split_map(load_map(args.map), args.directory, args.cell_size, args.workers)
+        print(f"{len(sharded.shards)} shards", end=" ")
+    elif args.command == "join":
+        document = ShardedMap.open(args.directory).document(workers=args.workers)
+        save_map(document, args.map)
+        print(f"{len(document.strokes)} strokes, {len(document.figures)} figures, "
+              f"{len(document.elements)} elements", end=" ")
+    else:
+        export_shards(args.directory, args.output, args.format, args.layers, args.region,
+                      args.resolution, workers=args.workers)
+        print(f"{args.output} written", end=" ")
+    print(f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
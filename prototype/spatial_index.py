@@ -0,0 +1,93 @@
+import math
+from typing import Dict, Hashable, Iterable, Set, Tuple
+
+BBox = Tuple[float, float, float, float]  # (min_x, min_y, max_x, max_y)
+
+
+def points_bbox(points, padding: float = 0.0) -> BBox:
+    """Bounding box of a list of (x, y) points, grown by padding on each side"""
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) - padding, min(ys) - padding,
+            max(xs) + padding, max(ys) + padding)
+
+
+def bbox_intersects(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class GridIndex:
+    """
+    Uniform grid over bounding boxes
+
+    Every key is registered in each cell its bounding box touches, so a query
+    only looks at the cells covered by the query rectangle instead of every
+    stored object.
+    """
+
+    def __init__(self, cell_size: float = 256.0):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self.bboxes: Dict[Hashable, BBox] = {}
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def __contains__(self, key):
+        return key in self.bboxes
+
+    def _cell_range(self, bbox: BBox):
+        size = self.cell_size
+        return (math.floor(bbox[0] / size), math.floor(bbox[1] / size),
+                math.floor(bbox[2] / size), math.floor(bbox[3] / size))
+
+    def insert(self, key: Hashable, bbox: BBox):
+        if key in self.bboxes:
+            self.remove(key)
+        self.bboxes[key] = bbox
+        x0, y0, x1, y1 = self._cell_range(bbox)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(key)
+
+    def remove(self, key: Hashable):
+        bbox = self.bboxes.pop(key, None)
+        if bbox is None:
+            return
+        x0, y0, x1, y1 = self._cell_range(bbox)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    cell.discard(key)
+                    if not cell:
+                        del self.cells[(cx, cy)]
+
+    def query(self, rect: BBox) -> Set[Hashable]:
+        """Keys whose bounding box intersects rect"""
+        x0, y0, x1, y1 = self._cell_range(rect)
+        found = set()
+        # A huge query rect may cover more cells than exist: walk the cells instead
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            candidates = (key for (cx, cy), keys in self.cells.items()
+                          if x0 <= cx <= x1 and y0 <= cy <= y1 for key in keys)
+        else:
+            candidates = (key for cx in range(x0, x1 + 1)
+                          for cy in range(y0, y1 + 1)
+                          for key in self.cells.get((cx, cy), ()))
+        for key in candidates:
+            if key not in found and bbox_intersects(self.bboxes[key], rect):
+                found.add(key)
+        return found
+
+    def bounds(self) -> BBox:
+        """Bounding box of everything in the index"""
+        if not self.bboxes:
+            return (0.0, 0.0, 0.0, 0.0)
+        boxes = self.bboxes.values()
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    def update(self, items: Iterable[Tuple[Hashable, BBox]]):
+        for key, bbox in items:
+            self.insert(key, bbox)
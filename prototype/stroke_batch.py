@@ -0,0 +1,304 @@
+"""
+All the strokes of a layer painted by a single scene item
+
+One QGraphicsItem per stroke makes Qt pay for a bounding rect, a BSP
+insertion, sorting and a paint call per stroke, which dominates with 100k
+strokes. A StrokeBatchItem keeps its strokes as prebuilt QPolygonF buffers
+grouped by pen, indexes them itself and, on each paint, sets each pen once
+and draws the polylines found in the exposed rectangle.
+"""
+import math
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, Hashable, Optional, Tuple
+
+from PyQt6.QtWidgets import QApplication, QMainWindow, QGraphicsScene, QGraphicsView, QGraphicsItem
+from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtGui import QPaintEngine, QPen, QColor, QPolygonF
+
+from layers import LayerStack, LayeredView
+from memory_budget import LOW, memory_budget, points_bytes
+from spatial_index import BBox, GridIndex
+
+PenKey = Tuple[int, float, bool]  # (rgba, width, cosmetic)
+
+# Budget entry of all the polylines, a tuple so it never clashes with a stroke key
+POLYLINES = ("batch", "polylines")
+
+
+def pen_key(color, width: float, cosmetic=False) -> PenKey:
+    return (QColor(color).rgba(), float(width), cosmetic)
+
+
+def make_pen(key: PenKey) -> QPen:
+    rgba, width, cosmetic = key
+    pen = QPen(QColor.fromRgba(rgba), width, Qt.PenStyle.SolidLine,
+               Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin)
+    # Cosmetic pens keep their width in pixels, whatever the zoom
+    pen.setCosmetic(cosmetic)
+    return pen
+
+
+def to_polygon(points) -> QPolygonF:
+    """QPolygonF of QPointF or (x, y) points"""
+    if points and isinstance(points[0], QPointF):
+        return QPolygonF(list(points))
+    return QPolygonF([QPointF(x, y) for x, y in points])
+
+
+def rect_bbox(rect: QRectF, padding: float = 0.0) -> BBox:
+    return (rect.left() - padding, rect.top() - padding,
+            rect.right() + padding, rect.bottom() + padding)
+
+
+@dataclass
+class BatchedStroke:
+    pen: PenKey
+    bbox: BBox
+    polygon: Optional[QPolygonF] = None
+    # Curves are flattened for the zoom on paint, see bezier.BezierPath
+    curve: object = None
+    curve_bucket: Optional[int] = None
+
+
+class PenGroup:
+    """Strokes sharing a pen, with their own index"""
+
+    def __init__(self, key: PenKey, cell_size: float):
+        self.pen = make_pen(key)
+        self.index = GridIndex(cell_size)
+
+
+class StrokeBatchItem(QGraphicsItem):
+    """
+    Single scene item painting many strokes
+
+    :param cell_size: Cell size of the stroke index, in scene units
+    """
+
+    def __init__(self, cell_size=256.0):
+        super().__init__()
+        self.cell_size = cell_size
+        self.strokes: Dict[Hashable, BatchedStroke] = {}
+        self.groups: Dict[PenKey, PenGroup] = {}
+        self._next_key = 0
+        self._bounds: Optional[BBox] = None
+        # Widest cosmetic pen, in pixels: how far strokes reach outside their points
+        self._cosmetic_margin = 0.0
+        self.view_scale = 1.0
+        # Bumped on every change, for renderers keeping their own copy of the strokes
+        self.version = 0
+        # Bumped when strokes go away; until then strokes are only appended to
+        # self.strokes, which keeps their order, so renderers can copy just the new ones
+        self.removals = 0
+        # Renderer drawing the batch natively instead of through QPainter, see gl_viewport
+        self.native = None
+        # Strokes flattened again at each zoom, which native renderers rebuild for
+        self._curve_count = 0
+        # Polylines are counted as one pinned entry, flattened curves can be evicted
+        self.account = memory_budget.register("stroke batches", self._evict_polygon, LOW)
+        self._polyline_bytes = 0
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def _insert(self, key, stroke: BatchedStroke) -> Hashable:
+        if key is None:
+            key = self._next_key
+            self._next_key += 1
+        elif key in self.strokes:
+            self.remove_stroke(key)
+        group = self.groups.get(stroke.pen)
+        if group is None:
+            group = self.groups[stroke.pen] = PenGroup(stroke.pen, self.cell_size)
+        group.index.insert(key, stroke.bbox)
+        self.strokes[key] = stroke
+        self.version += 1
+        if stroke.curve is not None:
+            self._curve_count += 1
+
+        _, width, cosmetic = stroke.pen
+        if cosmetic and width > self._cosmetic_margin:
+            self.prepareGeometryChange()
+            self._cosmetic_margin = width
+        bounds = self._bounds
+        x0, y0, x1, y1 = stroke.bbox
+        if bounds is None or not (bounds[0] <= x0 and bounds[1] <= y0 and
+                                  x1 <= bounds[2] and y1 <= bounds[3]):
+            # A geometry change repaints and reindexes the whole batch: grow by
+            # a cell at once, so the next strokes drawn nearby fit already
+            self.prepareGeometryChange()
+            slack = self.cell_size
+            self._bounds = (x0 - slack, y0 - slack, x1 + slack, y1 + slack) if bounds is None else (
+                bounds[0] if bounds[0] <= x0 else x0 - slack,
+                bounds[1] if bounds[1] <= y0 else y0 - slack,
+                bounds[2] if x1 <= bounds[2] else x1 + slack,
+                bounds[3] if y1 <= bounds[3] else y1 + slack)
+        # Only the stroke's own area is repainted otherwise
+        self.update(self._stroke_rect(stroke))
+        return key
+
+    def add_stroke(self, points, color, width: float, cosmetic=False, key: Hashable = None,
+                   bbox: BBox = None) -> Hashable:
+        """
+        Add a polyline
+
+        :param points: QPointF or (x, y) points, in scene coordinates
+        :param width: Pen width, in scene units or in pixels for a cosmetic pen
+        :param key: Key of the stroke, a new one by default
+        :param bbox: Bounding box of the points, grown by half the width unless
+                     the pen is cosmetic, when the caller keeps one already
+        :return: The key
+        """
+        polygon = to_polygon(points)
+        if bbox is None:
+            padding = 0.0 if cosmetic else width / 2
+            bbox = rect_bbox(polygon.boundingRect(), padding)
+        key = self._insert(key, BatchedStroke(pen_key(color, width, cosmetic), bbox, polygon))
+        self._count_polylines(points_bytes(len(polygon)))
+        return key
+
+    def add_curve(self, curve, color, width: float, cosmetic=False, key: Hashable = None) -> Hashable:
+        """Add a bezier.BezierPath, flattened for the zoom when painted"""
+        padding = 0.0 if cosmetic else width / 2
+        x0, y0, x1, y1 = curve.bbox
+        bbox = (x0 - padding, y0 - padding, x1 + padding, y1 + padding)
+        return self._insert(key, BatchedStroke(pen_key(color, width, cosmetic), bbox, curve=curve))
+
+    def remove_stroke(self, key: Hashable):
+        stroke = self.strokes.pop(key, None)
+        if stroke is None:
+            return
+        self.version += 1
+        self.removals += 1
+        if stroke.curve is None:
+            self._count_polylines(-points_bytes(len(stroke.polygon)))
+        else:
+            self._curve_count -= 1
+            self.account.release(key)
+        group = self.groups[stroke.pen]
+        group.index.remove(key)
+        if not len(group.index):
+            del self.groups[stroke.pen]
+        # Bounds only shrink on clear, a few empty pixels cost nothing
+        self.update(self._stroke_rect(stroke))
+
+    def clear(self):
+        self.version += 1
+        self.removals += 1
+        self.prepareGeometryChange()
+        self.strokes.clear()
+        self.groups.clear()
+        self._bounds = None
+        self._cosmetic_margin = 0.0
+        self._curve_count = 0
+        self.account.clear()
+        self._polyline_bytes = 0
+
+    @property
+    def has_curves(self) -> bool:
+        """Whether some strokes are flattened differently at each zoom"""
+        return self._curve_count > 0
+
+    def _count_polylines(self, size: int):
+        self._polyline_bytes += size
+        self.account.charge(POLYLINES, self._polyline_bytes)
+        self.account.pin(POLYLINES)
+
+    def _evict_polygon(self, key):
+        stroke = self.strokes.get(key)
+        if stroke is not None and stroke.curve is not None:
+            stroke.polygon = None
+            stroke.curve_bucket = None
+
+    def _stroke_rect(self, stroke: BatchedStroke) -> QRectF:
+        x0, y0, x1, y1 = stroke.bbox
+        margin = self._cosmetic_margin / self.view_scale
+        return QRectF(x0, y0, x1 - x0, y1 - y0).adjusted(-margin, -margin, margin, margin)
+
+    def set_view_scale(self, scale: float):
+        """Cosmetic pens reach further in scene units when zoomed out"""
+        if self._cosmetic_margin:
+            self.prepareGeometryChange()
+        self.view_scale = scale
+
+    def boundingRect(self):
+        if self._bounds is None:
+            return QRectF()
+        x0, y0, x1, y1 = self._bounds
+        margin = self._cosmetic_margin / self.view_scale
+        return QRectF(x0, y0, x1 - x0, y1 - y0).adjusted(-margin, -margin, margin, margin)
+
+    def polygon_at(self, key: Hashable, scale: float) -> QPolygonF:
+        """Points of a stroke, curves being flattened for the scale"""
+        stroke = self.strokes[key]
+        if stroke.curve is None:
+            return stroke.polygon
+        bucket = math.floor(math.log2(scale))
+        if stroke.curve_bucket != bucket:
+            polygon = stroke.polygon = to_polygon(stroke.curve.at_scale(scale).tolist())
+            stroke.curve_bucket = bucket
+            self.account.charge(key, points_bytes(len(polygon)))
+            return polygon
+        return stroke.polygon
+
+    def paint(self, painter, option, widget=None):
+        if self.native is None and painter.paintEngine().type() == QPaintEngine.Type.OpenGL2:
+            # First paint into an OpenGL viewport, whenever it was enabled
+            from gl_strokes import GLStrokeRenderer
+            self.native = GLStrokeRenderer()
+        if self.native is not None and self.native.paint(painter, self):
+            return
+        scale = painter.worldTransform().m11()
+        exposed = option.exposedRect
+        margin = self._cosmetic_margin / scale
+        rect = (exposed.left() - margin, exposed.top() - margin,
+                exposed.right() + margin, exposed.bottom() + margin)
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        for group in self.groups.values():
+            keys = group.index.query(rect)
+            if not keys:
+                continue
+            # One pen change per group rather than per stroke
+            painter.setPen(group.pen)
+            for key in keys:
+                painter.drawPolyline(self.polygon_at(key, scale))
+
+
+class MainWindow(QMainWindow):
+    def __init__(self, count=100000):
+        super().__init__()
+        self.setWindowTitle("Batched Strokes")
+        self.setGeometry(100, 100, 1000, 800)
+
+        rng = random.Random(1)
+        scene = QGraphicsScene()
+        self.stack = LayerStack(scene)
+        self.batch = StrokeBatchItem()
+        colors = [QColor(40, 90, 200), QColor(120, 40, 40), QColor(30, 120, 50), QColor(0, 0, 0)]
+        start = time.perf_counter()
+        for _ in range(count):
+            x, y = rng.uniform(0, 20000), rng.uniform(0, 20000)
+            points = [(x, y)]
+            for _ in range(rng.randint(1, 8)):
+                x, y = x + rng.uniform(-40, 40), y + rng.uniform(-40, 40)
+                points.append((x, y))
+            self.batch.add_stroke(points, rng.choice(colors), rng.choice((1.0, 2.0, 4.0)))
+        print(f"{count} strokes batched in {time.perf_counter() - start:.1f} s")
+        self.stack.add_layer("Strokes").add_item(self.batch)
+
+        self.view = LayeredView(scene, self.stack)
+        self.view.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.FullViewportUpdate)
+        self.view.scale(0.5, 0.5)
+        self.stack.set_view_scale(0.5)
+        self.setCentralWidget(self.view)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
@@ -0,0 +1,800 @@
+"""
+Collaborative editing of a drawing through a local sync server
+
+Every edit is an operation: a short JSON list sent in batches, one batch
+per line, over an asyncio socket. The server applies the operations to a
+replica of its own, sends editors joining late a snapshot of it, which
+grows with the drawing rather than with the session, and relays each batch
+to the others. An editor that loses the server connects again on its own
+and both sides send each other a snapshot, so nothing done in between is
+lost.
+Operations merge without conflicts whatever order they cross in:
+
+- every point and figure has a unique id, a Lamport timestamp and the
+  editor's site, so ids are totally ordered,
+- inserted points are placed after their predecessor, before any older
+  sibling (a Replicated Growable Array),
+- moves and element changes keep the latest timestamp (last writer wins),
+- removed figures stay as tombstones, so late operations on them are moot.
+
+Remote batches are applied to the scene item by item, without rebuilding it.
+
+    python sync.py server --port 8765
+    python sync.py client --host 127.0.0.1 --port 8765
+    python sync.py demo  # a server and two editors in one process
+    python sync.py check  # headless editors on localhost, fails if they diverge
+"""
+import argparse
+import asyncio
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from PyQt6.QtWidgets import (QApplication, QGraphicsPathItem, QGraphicsSimpleTextItem,
+                             QPushButton)
+from PyQt6.QtCore import Qt, QPointF, QTimer, pyqtSignal
+from PyQt6.QtGui import QPen, QColor, QPainterPath
+
+import complex_editable
+from complex_editable import ControlPoint, DrawingScene, FigureGraphicsItem, view_scale
+from map_document import Figure, MapDocument, Stroke, element_anchor, element_from_dict
+from stroke_batch import StrokeBatchItem
+
+DEFAULT_PORT = 8765
+FLUSH_INTERVAL = 30  # Milliseconds between two batches, moves in between are coalesced
+CLOSE_THRESHOLD = 10.0  # Same as FigureGraphicsItem.try_close_figure
+MAX_PENDING_BATCHES = 1000  # Batches queued for an editor before the server drops it
+SNAPSHOT_BATCH = 500  # Operations per batch when a whole snapshot is sent
+# Longest line read, asyncio's default of 64 KiB is one long stroke
+LINE_LIMIT = 1 << 26
+RECONNECT_DELAY = 1.0  # Seconds between two attempts to reach the server again
+
+Id = Tuple[int, int]  # (Lamport counter, site), unique and totally ordered
+
+
+def _id(value) -> Optional[Id]:
+    """Ids travel as JSON lists"""
+    return tuple(value) if value is not None else None
+
+
+def encode(ops) -> bytes:
+    return json.dumps({"ops": ops}, separators=(",", ":")).encode() + b"\n"
+
+
+def decode(line: bytes) -> list:
+    return json.loads(line)["ops"]
+
+
+def in_batches(ops, size=SNAPSHOT_BATCH):
+    """A long list of operations, a snapshot for instance, as several batches"""
+    for i in range(0, len(ops), size):
+        yield ops[i:i + size]
+
+
+class PointState:
+    __slots__ = ("id", "x", "y", "stamp")
+
+    def __init__(self, point_id: Id, x: float, y: float):
+        self.id = point_id
+        self.x = x
+        self.y = y
+        self.stamp = point_id  # Of the last move
+
+
+class FigureState:
+    def __init__(self):
+        self.points: List[PointState] = []
+        self.by_id: Dict[Id, PointState] = {}
+        self.closed = False
+        self.removed = False
+
+    def position(self, point_id: Id) -> int:
+        return self.points.index(self.by_id[point_id])
+
+
+class SyncDocument:
+    """
+    Replicated state of a drawing, the same on every editor once they have
+    applied the same operations, in any order the server relays them
+
+    Operations:
+        ["f", id]                        new figure
+        ["i", figure, id, after, x, y]   point inserted after another, or first with None
+        ["m", figure, point, stamp, x, y]  point moved
+        ["c", figure, stamp]             figure closed
+        ["r", figure]                    figure removed
+        ["s", id, points, color, width]  new stroke, points as a flat list
+        ["e", key, stamp, data]          element set to element_to_dict data, None removes it
+
+    :param site: Number of this editor, random by default
+    """
+
+    def __init__(self, site: int = None):
+        self.site = random.getrandbits(31) if site is None else site
+        self.clock = 0
+        self.figures: Dict[Id, FigureState] = {}
+        self.strokes: Dict[Id, Stroke] = {}
+        self.elements: Dict[str, Tuple[Id, dict]] = {}
+
+    def tick(self) -> Id:
+        """New id, later than everything this editor has seen"""
+        self.clock += 1
+        return (self.clock, self.site)
+
+    def _witness(self, stamp: Id):
+        self.clock = max(self.clock, stamp[0])
+
+    def apply(self, op):
+        """
+        Apply an operation, local or remote, at most once
+
+        :return: What changed, for the scene: ("figure", id), ("insert", figure,
+            position), ("move", figure, position), ("close", figure), ("remove",
+            figure), ("stroke", id) or ("element", key); None when nothing did
+        """
+        kind = op[0]
+        if kind == "f":
+            figure_id = _id(op[1])
+            self._witness(figure_id)
+            if figure_id in self.figures:
+                return None
+            self.figures[figure_id] = FigureState()
+            return ("figure", figure_id)
+
+        if kind == "s":
+            stroke_id = _id(op[1])
+            self._witness(stroke_id)
+            if stroke_id in self.strokes:
+                return None
+            flat = op[2]
+            self.strokes[stroke_id] = Stroke(list(zip(flat[0::2], flat[1::2])), op[3], op[4])
+            return ("stroke", stroke_id)
+
+        if kind == "e":
+            key, stamp = op[1], _id(op[2])
+            self._witness(stamp)
+            current = self.elements.get(key)
+            if current is not None and current[0] >= stamp:
+                return None
+            self.elements[key] = (stamp, op[3])
+            return ("element", key)
+
+        figure_id = _id(op[1])
+        figure = self.figures.get(figure_id)
+        if figure is None:
+            # The server relays in causal order, a figure always comes before its points
+            raise ValueError(f"Operation on an unknown figure: {op}")
+
+        if kind == "i":
+            point_id, after = _id(op[2]), _id(op[3])
+            self._witness(point_id)
+            if point_id in figure.by_id:
+                return None
+            position = figure.position(after) + 1 if after is not None else 0
+            # Points inserted concurrently at the same place: the latest comes first
+            while position < len(figure.points) and figure.points[position].id > point_id:
+                position += 1
+            point = PointState(point_id, op[4], op[5])
+            figure.points.insert(position, point)
+            figure.by_id[point_id] = point
+            return ("insert", figure_id, position)
+
+        if kind == "m":
+            point, stamp = figure.by_id[_id(op[2])], _id(op[3])
+            self._witness(stamp)
+            if stamp <= point.stamp:
+                return None
+            point.x, point.y, point.stamp = op[4], op[5], stamp
+            return ("move", figure_id, figure.position(point.id))
+
+        if kind == "c":
+            self._witness(_id(op[2]))
+            if figure.closed:
+                return None
+            figure.closed = True
+            return ("close", figure_id)
+
+        if kind == "r":
+            if figure.removed:
+                return None
+            figure.removed = True
+            return ("remove", figure_id)
+
+        raise ValueError(f"Unknown operation: {op}")
+
+    def snapshot(self) -> list:
+        """
+        Operations rebuilding the current state, for editors joining late
+
+        Tombstones are kept, with their points, for late operations on them
+        to stay moot, and every stamp is kept for last writer wins to give
+        the same result on a replica rebuilt from it.
+        """
+        ops = []
+        for figure_id in sorted(self.figures):
+            figure = self.figures[figure_id]
+            ops.append(["f", figure_id])
+            after = None
+            for point in figure.points:
+                ops.append(["i", figure_id, point.id, after, point.x, point.y])
+                if point.stamp != point.id:
+                    ops.append(["m", figure_id, point.id, point.stamp, point.x, point.y])
+                after = point.id
+            if figure.closed:
+                ops.append(["c", figure_id, figure_id])
+            if figure.removed:
+                ops.append(["r", figure_id])
+        for stroke_id, stroke in self.strokes.items():
+            ops.append(["s", stroke_id, [c for point in stroke.points for c in point],
+                        stroke.color, stroke.width])
+        for key, (stamp, data) in self.elements.items():
+            ops.append(["e", key, stamp, data])
+        return ops
+
+    def to_map_document(self) -> MapDocument:
+        """Current state, tombstones left out, as a map document"""
+        document = MapDocument()
+        document.strokes = list(self.strokes.values())
+        for figure_id in sorted(self.figures):
+            figure = self.figures[figure_id]
+            if not figure.removed:
+                document.figures.append(Figure([(p.x, p.y) for p in figure.points],
+                                               figure.closed))
+        document.elements = [element_from_dict(data) for _, data in self.elements.values()
+                             if data is not None]
+        return document
+
+
+class SyncServer:
+    """
+    Relays batches between editors and sends newcomers a snapshot
+
+    Instead of a log of every operation, the server keeps the drawing as a
+    SyncDocument: its memory and the data sent to a newcomer grow with the
+    drawing, not with the session. Each editor gets its own queue, written
+    by its own task that waits until the socket drains; an editor falling
+    MAX_PENDING_BATCHES behind is disconnected rather than buffered without
+    bound. Its SyncClient then connects again and gets a fresh snapshot.
+
+    :param port: 0 picks a free port, read from self.port once started
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.document = SyncDocument(site=0)
+        self.clients: Dict[asyncio.StreamWriter, asyncio.Queue] = {}
+        self.ready = threading.Event()
+
+    async def handle(self, reader, writer):
+        pending = asyncio.Queue(MAX_PENDING_BATCHES)
+        self.clients[writer] = pending
+        sender = asyncio.create_task(self._send(writer, pending, self.document.snapshot()))
+        try:
+            async for line in reader:
+                ops = decode(line)
+                for op in ops:
+                    try:
+                        self.document.apply(op)
+                    except (KeyError, ValueError) as error:
+                        # Editors fail on it the same way, the server goes on serving
+                        print(f"Invalid operation {op}: {error}", file=sys.stderr)
+                message = encode(ops)
+                for other, other_pending in list(self.clients.items()):
+                    if other is writer:
+                        continue
+                    try:
+                        other_pending.put_nowait(message)
+                    except asyncio.QueueFull:
+                        self._drop(other)
+        except (ConnectionError, ValueError) as error:
+            # A line over LINE_LIMIT or a broken one: the editor connects again
+            print(f"Editor dropped: {error}", file=sys.stderr)
+        finally:
+            self._drop(writer)
+            sender.cancel()
+
+    async def _send(self, writer, pending, snapshot):
+        try:
+            # Batches received meanwhile wait in the queue, after the snapshot
+            for ops in in_batches(snapshot):
+                writer.write(encode(ops))
+                await writer.drain()
+            while True:
+                writer.write(await pending.get())
+                await writer.drain()
+        except ConnectionError:
+            self._drop(writer)
+
+    def _drop(self, writer):
+        # Its reader loop then ends, and its handler cleans up
+        self.clients.pop(writer, None)
+        writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=LINE_LIMIT)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+        thread.start()
+        self.ready.wait()
+        return thread
+
+
+# Put among the received batches each time the client gets connected
+JOINED = None
+
+
+class SyncClient:
+    """
+    Connection to the server, run by an event loop in its own thread
+
+    Received batches wait in a queue until the Qt thread collects them. A
+    lost connection is tried again every RECONNECT_DELAY seconds; each time
+    it is made, JOINED is received, upon which the editor sends its own
+    snapshot with join(). Until then, what send() is given is dropped: the
+    snapshot has it already.
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.incoming: "queue.Queue[Optional[list]]" = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+        self.connected = threading.Event()
+        # Whether the server has the editor's snapshot, so that its operations make sense
+        self.joined = False
+        self.closing = False
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._run(),),
+                                       daemon=True)
+
+    @property
+    def online(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    def start(self, timeout=5.0):
+        self.thread.start()
+        if not self.connected.wait(timeout) or self.error is not None:
+            raise ConnectionError(f"Cannot reach the sync server at {self.host}:{self.port}: "
+                                  f"{self.error}")
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port,
+                                                               limit=LINE_LIMIT)
+            except OSError as error:
+                if not self.connected.is_set():
+                    # Never connected: start() reports it
+                    self.error = error
+                    self.connected.set()
+                    return
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.writer = writer
+            self.incoming.put(JOINED)
+            self.connected.set()
+            try:
+                async for line in reader:
+                    self.incoming.put(decode(line))
+            except (ConnectionError, ValueError) as error:
+                if not self.closing:
+                    print(f"Connection to the sync server lost: {error}", file=sys.stderr)
+            self.joined = False
+            self.writer = None
+            writer.close()
+            if not self.closing:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def join(self, snapshot):
+        """Send the editor's snapshot after JOINED, then its operations"""
+        writer = self.writer
+        for ops in in_batches(snapshot):
+            self._write(writer, ops)
+        # Lost again meanwhile: the next JOINED sends it all again
+        self.joined = writer is not None and writer is self.writer
+
+    def send(self, ops):
+        if self.joined:
+            self._write(self.writer, ops)
+
+    def _write(self, writer, ops):
+        if writer is not None:
+            self.loop.call_soon_threadsafe(writer.write, encode(ops))
+
+    def receive(self) -> List[Optional[list]]:
+        """Batches received since the last call, and JOINED"""
+        batches = []
+        while True:
+            try:
+                batches.append(self.incoming.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def close(self):
+        self.closing = True
+        writer = self.writer
+        if writer is not None:
+            self.loop.call_soon_threadsafe(writer.close)
+
+
+class SyncedScene(DrawingScene):
+    """
+    DrawingScene whose edits go through a SyncDocument
+
+    Local edits become operations, applied here at once and sent with the
+    next batch; remote batches go through the same path. Modes are the ones
+    of DrawingScene plus "stroke", drawing freehand strokes, and "city",
+    placing cities.
+    """
+
+    # Whether the client is connected, each time it changes
+    connection_changed = pyqtSignal(bool)
+
+    def __init__(self, document: SyncDocument, client: SyncClient = None):
+        super().__init__()
+        self.document = document
+        self.client = client
+        self.figure_items: Dict[Id, FigureGraphicsItem] = {}
+        self.element_items: Dict[str, QGraphicsSimpleTextItem] = {}
+        self.strokes = StrokeBatchItem()
+        self.addItem(self.strokes)
+        self.current_figure_id: Optional[Id] = None
+        self.dragged: Optional[Tuple[Id, Id]] = None
+        self.stroke_points: List[QPointF] = []
+        self.stroke_preview: Optional[QGraphicsPathItem] = None
+        self.outgoing: list = []
+        # Only the last move of each point since the previous batch is sent
+        self.moves: Dict[Tuple[Id, Id], list] = {}
+        self.online = client is not None and client.online
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.sync)
+        self.timer.start(FLUSH_INTERVAL)
+
+    def local(self, op):
+        touched = set()
+        self._show(self.document.apply(op), touched)
+        for item in touched:
+            item.update_path()
+        if op[0] == "m":
+            self.moves[(op[1], op[2])] = op
+        else:
+            self.outgoing.append(op)
+
+    def sync(self):
+        """Send the local operations and apply the remote ones"""
+        if self.client is None:
+            self.outgoing.clear()
+            self.moves.clear()
+            return
+        ops = self.outgoing + list(self.moves.values())
+        if ops:
+            self.client.send(ops)
+            self.outgoing, self.moves = [], {}
+        for batch in self.client.receive():
+            if batch is JOINED:
+                self.client.join(self.document.snapshot())
+            else:
+                self.apply_batch(batch)
+        if self.client.online != self.online:
+            self.online = self.client.online
+            self.connection_changed.emit(self.online)
+
+    def apply_batch(self, ops):
+        touched = set()
+        for op in ops:
+            self._show(self.document.apply(op), touched)
+        # Each figure's path is rebuilt once per batch, however many of its points changed
+        for item in touched:
+            if item.scene() is self:
+                item.update_path()
+
+    def _show(self, change, touched):
+        if change is None:
+            return
+        kind = change[0]
+        if kind == "figure":
+            item = FigureGraphicsItem()
+            item.smooth = self.smooth
+            item.figure_id = change[1]
+            self.addItem(item)
+            self.figure_items[change[1]] = item
+        elif kind == "stroke":
+            stroke = self.document.strokes[change[1]]
+            self.strokes.add_stroke(stroke.points, stroke.color, stroke.width, key=change[1])
+        elif kind == "element":
+            self._show_element(change[1])
+        else:
+            item = self.figure_items.get(change[1])
+            if item is None:
+                return
+            figure = self.document.figures[change[1]]
+            if kind == "insert":
+                point = figure.points[change[2]]
+                item.points.insert(change[2], QPointF(point.x, point.y))
+                item.control_points.insert(change[2], ControlPoint(QPointF(point.x, point.y), item))
+            elif kind == "move":
+                point = figure.points[change[2]]
+                item.control_points[change[2]].setPos(point.x, point.y)
+            elif kind == "close":
+                item.is_closed = True
+            elif kind == "remove":
+                del self.figure_items[change[1]]
+                self.removeItem(item)
+                return
+            touched.add(item)
+
+    def _show_element(self, key):
+        data = self.document.elements[key][1]
+        item = self.element_items.pop(key, None)
+        if item is not None:
+            self.removeItem(item)
+        if data is None:
+            return
+        x, y = element_anchor(element_from_dict(data))
+        item = self.addSimpleText(data["name"])
+        item.setPos(x + 4, y - 8)
+        self.element_items[key] = item
+
+    def _point_at(self, pos) -> Optional[Tuple[Id, Id]]:
+        for item in self.items(pos):
+            if isinstance(item, ControlPoint):
+                figure_item = item.parentItem()
+                figure = self.document.figures[figure_item.figure_id]
+                index = figure_item.control_points.index(item)
+                return (figure_item.figure_id, figure.points[index].id)
+        return None
+
+    def _insert(self, figure_id: Id, index: int, pos: QPointF):
+        figure = self.document.figures[figure_id]
+        after = figure.points[index - 1].id if index > 0 else None
+        point_id = self.document.tick()
+        self.local(["i", figure_id, point_id, after, round(pos.x(), 2), round(pos.y(), 2)])
+        return point_id
+
+    def mousePressEvent(self, event):
+        pos = event.scenePos()
+        if self.mode == "draw":
+            figure_id = self.current_figure_id
+            if figure_id is None or figure_id not in self.figure_items:
+                figure_id = self.current_figure_id = self.document.tick()
+                self.local(["f", figure_id])
+            item = self.figure_items[figure_id]
+            if (len(item.points) > 2 and
+                    (pos - item.points[0]).manhattanLength() < CLOSE_THRESHOLD):
+                self.local(["c", figure_id, self.document.tick()])
+                self.current_figure_id = None
+            else:
+                self._insert(figure_id, len(item.points), pos)
+
+        elif self.mode == "edit":
+            self.dragged = self._point_at(pos)
+            if self.dragged is not None:
+                return
+            for item in self.items(pos):
+                if isinstance(item, FigureGraphicsItem):
+                    index = item.find_closest_segment(pos, view_scale(event))
+                    if index != -1:
+                        point_id = self._insert(item.figure_id, index, item.projection_point)
+                        self.dragged = (item.figure_id, point_id)
+                        break
+
+        elif self.mode == "remove":
+            for item in self.items(pos):
+                if isinstance(item, FigureGraphicsItem):
+                    self.local(["r", item.figure_id])
+                    break
+
+        elif self.mode == "stroke":
+            self.stroke_points = [pos]
+
+        elif self.mode == "city":
+            data = {"kind": "city", "name": f"City {len(self.document.elements) + 1}",
+                    "coordinates": [[round(pos.x(), 2), round(pos.y(), 2)]],
+                    "population": 0, "is_capital": False}
+            key = f"{self.document.site}-{self.document.clock + 1}"
+            self.local(["e", key, self.document.tick(), data])
+
+    def mouseMoveEvent(self, event):
+        pos = event.scenePos()
+        if self.mode == "draw" and self.current_figure_id in self.figure_items:
+            self.figure_items[self.current_figure_id].update_temp_point(pos)
+        elif self.mode == "edit" and self.dragged is not None:
+            figure_id, point_id = self.dragged
+            self.local(["m", figure_id, point_id, self.document.tick(),
+                        round(pos.x(), 2), round(pos.y(), 2)])
+        elif self.mode == "stroke" and self.stroke_points:
+            self.stroke_points.append(pos)
+            path = QPainterPath(self.stroke_points[0])
+            for point in self.stroke_points[1:]:
+                path.lineTo(point)
+            if self.stroke_preview is None:
+                self.stroke_preview = self.addPath(path, QPen(Qt.GlobalColor.darkBlue, 2))
+            else:
+                self.stroke_preview.setPath(path)
+
+    def mouseReleaseEvent(self, event):
+        self.dragged = None
+        if self.mode == "stroke" and self.stroke_points:
+            if len(self.stroke_points) > 1:
+                flat = [round(c, 2) for p in self.stroke_points for c in (p.x(), p.y())]
+                self.local(["s", self.document.tick(), flat, QColor(Qt.GlobalColor.darkBlue).name(), 2.0])
+            self.stroke_points = []
+            if self.stroke_preview is not None:
+                self.removeItem(self.stroke_preview)
+                self.stroke_preview = None
+
+
+class MainWindow(complex_editable.MainWindow):
+    def __init__(self, client: SyncClient = None, title="Shared Drawing"):
+        super().__init__()
+        self.setWindowTitle(title)
+        self.client = client
+        self.scene = SyncedScene(SyncDocument(), client)
+        self.scene.setSceneRect(0, 0, 780, 520)
+        self.view.setScene(self.scene)
+
+        for label, mode in (("Stroke Mode", "stroke"), ("City Mode", "city")):
+            button = QPushButton(label)
+            button.clicked.connect(lambda checked, mode=mode: self.set_mode(mode))
+            self.centralWidget().layout().addWidget(button)
+        self.scene.connection_changed.connect(self.show_connection)
+
+    def show_connection(self, online):
+        self.statusBar().showMessage(
+            "Connected to the sync server" if online else
+            "Disconnected from the sync server, edits are kept and sent once reconnected")
+
+    def closeEvent(self, event):
+        if self.client is not None:
+            self.client.close()
+        super().closeEvent(event)
+
+
+class HeadlessEditor:
+    """SyncedScene's part of the protocol without a scene, for check()"""
+
+    def __init__(self, site: int, port: int, host="127.0.0.1"):
+        self.document = SyncDocument(site)
+        self.client = SyncClient(host, port)
+        self.client.start()
+
+    def edit(self, op):
+        self.document.apply(op)
+        self.client.send([op])
+
+    def draw_figure(self, points, closed=False) -> Id:
+        figure_id = self.document.tick()
+        self.edit(["f", figure_id])
+        after = None
+        for x, y in points:
+            point_id = self.document.tick()
+            self.edit(["i", figure_id, point_id, after, x, y])
+            after = point_id
+        if closed:
+            self.edit(["c", figure_id, self.document.tick()])
+        return figure_id
+
+    def sync(self):
+        for batch in self.client.receive():
+            if batch is JOINED:
+                self.client.join(self.document.snapshot())
+            else:
+                for op in batch:
+                    self.document.apply(op)
+
+    def state(self) -> list:
+        # Strokes and elements are in arrival order, which differs between editors
+        return sorted(json.dumps(op) for op in self.document.snapshot())
+
+
+def check(host="127.0.0.1", timeout=10.0) -> bool:
+    """
+    Run a server and headless editors on localhost, True if they converge
+
+    Two editors draw and move the same points concurrently, with a figure and
+    a stroke long enough for their lines to go well over 64 KiB; a third one
+    joins late, and the second one loses its connection, edits offline and
+    comes back.
+    """
+    server = SyncServer(host, 0)
+    server.start_in_thread()
+    editors = [HeadlessEditor(site, server.port, host) for site in (1, 2)]
+
+    def converge():
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for editor in editors:
+                editor.sync()
+            states = [editor.state() for editor in editors]
+            if all(state == states[0] for state in states) and \
+                    states[0] == sorted(json.dumps(op) for op in server.document.snapshot()):
+                return True
+            time.sleep(0.05)
+        return False
+
+    first, second = editors
+    # Nothing is sent before the editors have joined
+    if not converge():
+        return False
+    rng = random.Random(1)
+    coast = first.draw_figure([(round(rng.uniform(0, 1000), 2), round(rng.uniform(0, 1000), 2))
+                               for _ in range(3000)], closed=True)
+    first.edit(["s", first.document.tick(), [round(rng.uniform(0, 1000), 2) for _ in range(20000)],
+                "#00008b", 2.0])
+    second.draw_figure([(10, 10), (50, 10), (50, 50)])
+    second.edit(["e", "2-city", second.document.tick(),
+                 {"kind": "city", "name": "Port", "coordinates": [[5, 5]], "population": 0,
+                  "is_capital": False}])
+    if not converge():
+        return False
+
+    # Concurrent moves of the same points, the latest stamp wins everywhere
+    points = first.document.figures[coast].points
+    for editor in editors:
+        for point in points[:50]:
+            editor.edit(["m", coast, point.id, editor.document.tick(),
+                         rng.uniform(0, 1000), rng.uniform(0, 1000)])
+    editors.append(HeadlessEditor(3, server.port, host))
+    if not converge():
+        return False
+
+    # As when the server drops a slow editor
+    second.client.loop.call_soon_threadsafe(second.client.writer.transport.abort)
+    deadline = time.monotonic() + timeout
+    while second.client.joined and time.monotonic() < deadline:
+        time.sleep(0.01)
+    second.draw_figure([(100, 100), (200, 100)])
+    second.edit(["r", coast])
+    first.draw_figure([(300, 300), (400, 300), (400, 400)], closed=True)
+    return converge() and first.document.figures[coast].removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Edit a drawing with others on the same server")
+    parser.add_argument("role", choices=("server", "client", "demo", "check"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    if args.role == "server":
+        print(f"Sync server on {args.host}:{args.port}")
+        asyncio.run(SyncServer(args.host, args.port).serve())
+        return
+    if args.role == "check":
+        start = time.perf_counter()
+        if not check(args.host):
+            print("Editors did not converge", file=sys.stderr)
+            sys.exit(1)
+        print(f"Editors converged in {time.perf_counter() - start:.2f}s")
+        return
+
+    app = QApplication(sys.argv)
+    if args.role == "demo":
+        server = SyncServer(args.host, 0)
+        server.start_in_thread()
+        args.port = server.port
+    windows = []
+    for i in range(2 if args.role == "demo" else 1):
+        client = SyncClient(args.host, args.port)
+        client.start()
+        window = MainWindow(client, f"Shared Drawing - editor {i + 1}")
+        window.move(100 + 820 * i, 100)
+        window.show()
+        windows.append(window)
+    sys.exit(app.exec())
+
+
+if __name__ == "__main__":
+    main()
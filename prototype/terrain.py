@@ -0,0 +1,326 @@
+"""
+Procedural heightmaps, generated chunk by chunk
+
+Heights are fractal value noise over a hashed integer lattice, so any cell
+of an unbounded world can be computed on its own: chunks are generated
+independently, by several processes, and still join without seams. Thermal
+erosion is applied per chunk over a halo wide enough for the result not to
+depend on the chunking. Heights are in metres; cell (row, col) covers the
+scene square at (col, row) * cell_size.
+
+    python terrain.py world.npy --size 16384 16384 --seed 7
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from map_document import map_elements
+from polygon_geometry import Polygon
+
+CHUNK = 1024  # Cells per side of a generated chunk
+PEAK_BLOCK = 2048  # Rows of the heightmap scanned at once for peaks
+ALTITUDE_SAMPLES = 16384  # About how many cells are sampled for an altitude
+
+
+@dataclass
+class TerrainParams:
+    """
+    :param scale: Size in cells of the largest noise features
+    :param persistence: Amplitude kept from one octave to the next
+    :param sharpness: Exponent applied to the noise, higher for steeper peaks
+    :param talus: Height difference between neighbour cells above which erosion moves material
+    """
+    seed: int = 0
+    scale: float = 512.0
+    octaves: int = 7
+    persistence: float = 0.5
+    lacunarity: float = 2.0
+    sharpness: float = 1.6
+    min_height: float = -4000.0
+    max_height: float = 8000.0
+    erosion_iterations: int = 8
+    talus: float = 40.0
+    erosion_rate: float = 0.25
+
+
+def _hash(x, y, seed):
+    """Pseudo-random floats in [0, 1) for integer lattice points"""
+    # Unsigned arithmetic wraps around, as the hash expects
+    x, y = np.broadcast_arrays(x, y)
+    h = x.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    h ^= y.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+    h ^= np.uint64(seed * 0x165667B19E3779F9 & 0xFFFFFFFFFFFFFFFF)
+    # Final mixing of splitmix64
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def _axis(start, count, frequency):
+    """Lattice cells and smoothed weights along one axis of a window"""
+    position = (np.arange(start, start + count, dtype=np.float64) + 0.5) * frequency
+    cell = np.floor(position)
+    t = position - cell
+    return cell.astype(np.int64), (t * t * (3 - 2 * t)).astype(np.float32)
+
+
+def value_noise(x0, y0, width, height, frequency, seed):
+    """
+    One octave of value noise over a window of cells
+
+    The lattice values are hashed once per lattice point, then interpolated
+    along x and y separately, which is a few operations per cell.
+    """
+    cx, wx = _axis(x0, width, frequency)
+    cy, wy = _axis(y0, height, frequency)
+    gx = np.arange(cx[0], cx[-1] + 2)
+    gy = np.arange(cy[0], cy[-1] + 2)
+    lattice = _hash(gx[None, :], gy[:, None], seed).astype(np.float32)
+    ix = cx - gx[0]
+    iy = cy - gy[0]
+    rows = lattice[:, ix] * (1 - wx) + lattice[:, ix + 1] * wx
+    return rows[iy] * (1 - wy)[:, None] + rows[iy + 1] * wy[:, None]
+
+
+def fractal_noise(x0, y0, width, height, params: TerrainParams):
+    """Octaves of value noise summed, normalised to [0, 1]"""
+    total = np.zeros((height, width), dtype=np.float32)
+    amplitude = 1.0
+    frequency = 1.0 / params.scale
+    weight = 0.0
+    for octave in range(params.octaves):
+        octave_seed = params.seed * 1000003 + octave
+        total += np.float32(amplitude) * value_noise(x0, y0, width, height, frequency,
+                                                     octave_seed)
+        weight += amplitude
+        amplitude *= params.persistence
+        frequency *= params.lacunarity
+    total /= weight
+    return total
+
+
+def thermal_erosion(heights, iterations, talus, rate):
+    """
+    Move material down slopes steeper than talus, in place
+
+    Every cell sends part of its excess to each lower 4-neighbour at once,
+    nothing flows out of the array.
+    A cell's result depends on cells up to 2 * iterations away; the border
+    of that width is not exact and is what chunk halos are cut from.
+    """
+    for _ in range(iterations):
+        vertical = heights[:-1] - heights[1:]
+        horizontal = heights[:, :-1] - heights[:, 1:]
+        # Excess of each cell over its neighbour, per direction of flow
+        down = np.maximum(vertical - talus, 0.0)
+        up = np.maximum(-vertical - talus, 0.0)
+        right = np.maximum(horizontal - talus, 0.0)
+        left = np.maximum(-horizontal - talus, 0.0)
+        total = np.zeros_like(heights)
+        largest = np.zeros_like(heights)
+        for flow, target in ((down, np.s_[:-1]), (up, np.s_[1:]),
+                             (right, np.s_[:, :-1]), (left, np.s_[:, 1:])):
+            total[target] += flow
+            np.maximum(largest[target], flow, out=largest[target])
+        # Never send more than a share of the largest excess, or cells would swap
+        factor = np.divide(rate * largest, total, out=np.zeros_like(total), where=total > 0)
+        down *= factor[:-1]
+        up *= factor[1:]
+        right *= factor[:, :-1]
+        left *= factor[:, 1:]
+        heights[:-1] -= down
+        heights[1:] += down
+        heights[1:] -= up
+        heights[:-1] += up
+        heights[:, :-1] -= right
+        heights[:, 1:] += right
+        heights[:, 1:] -= left
+        heights[:, :-1] += left
+    return heights
+
+
+def generate_chunk(params: TerrainParams, x0, y0, width, height) -> np.ndarray:
+    """Heights in metres of the cells (x0..x0+width, y0..y0+height)"""
+    halo = 2 * params.erosion_iterations
+    noise = fractal_noise(x0 - halo, y0 - halo, width + 2 * halo, height + 2 * halo, params)
+    heights = params.min_height + np.float32(params.max_height - params.min_height) \
+        * noise ** np.float32(params.sharpness)
+    if params.erosion_iterations:
+        thermal_erosion(heights, params.erosion_iterations, params.talus, params.erosion_rate)
+    return heights[halo:halo + height, halo:halo + width].astype(np.float32)
+
+
+def _generate_into(path, params_dict, x0, y0, width, height):
+    heights = np.load(path, mmap_mode="r+")
+    heights[y0:y0 + height, x0:x0 + width] = generate_chunk(
+        TerrainParams(**params_dict), x0, y0, width, height)
+    heights.flush()
+    return width * height
+
+
+def generate_heightmap(path, width, height, params: TerrainParams, chunk=CHUNK, workers=None):
+    """
+    Generate a width x height heightmap into a .npy file, chunks in parallel
+
+    :return: The heightmap, memory-mapped read-only
+    """
+    heights = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                        shape=(height, width))
+    del heights
+    jobs = [(x0, y0, min(chunk, width - x0), min(chunk, height - y0))
+            for y0 in range(0, height, chunk) for x0 in range(0, width, chunk)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(_generate_into, path, asdict(params), *job) for job in jobs]
+        for future in futures:
+            future.result()
+    return np.load(path, mmap_mode="r")
+
+
+def region_cells(polygon: Polygon, shape, cell_size=1.0, step=1):
+    """
+    Row and column indices of the cells whose centre is inside a polygon
+
+    :param step: Only look at every step-th row and column, for large regions
+    """
+    x0, y0, x1, y1 = polygon.bbox
+    cols = np.arange(max(0, int(x0 // cell_size)), min(shape[1], int(x1 // cell_size) + 1), step)
+    rows = np.arange(max(0, int(y0 // cell_size)), min(shape[0], int(y1 // cell_size) + 1), step)
+    if not len(cols) or not len(rows):
+        return rows[:0], cols[:0]
+    grid_cols, grid_rows = np.meshgrid(cols, rows)
+    centres = np.column_stack(((grid_cols.ravel() + 0.5) * cell_size,
+                               (grid_rows.ravel() + 0.5) * cell_size))
+    inside = polygon.contains(centres)
+    return grid_rows.ravel()[inside], grid_cols.ravel()[inside]
+
+
+def sample_step(polygon: Polygon, cell_size=1.0, samples=ALTITUDE_SAMPLES) -> int:
+    """Step between sampled rows and columns for about samples cells in a polygon's bbox"""
+    x0, y0, x1, y1 = polygon.bbox
+    cells = (x1 - x0) * (y1 - y0) / cell_size ** 2
+    return max(1, int(np.sqrt(cells / samples)))
+
+
+def altitude_stats(heights, polygon: Polygon, cell_size=1.0, step=1):
+    """Altitude (min, max, mean) of the terrain under a polygon, sampled every step cells"""
+    rows, cols = region_cells(polygon, heights.shape, cell_size, step)
+    if not len(rows):
+        return map_elements.Altitude()
+    # Only the sampled cells are read from a memory-mapped heightmap, not their whole block
+    values = np.asarray(heights[rows, cols])
+    return map_elements.Altitude(min_height=float(values.min()),
+                                 max_height=float(values.max()),
+                                 mean_height=float(values.mean()))
+
+
+def apply_altitudes(features, heights, cell_size=1.0, altitude_samples=ALTITUDE_SAMPLES):
+    """
+    Set the altitude of every GeographicalFeature outlined by 3 points or more
+
+    :param altitude_samples: About how many cells are sampled for each altitude
+    """
+    for feature in features:
+        if (isinstance(feature, map_elements.GeographicalFeature)
+                and len(feature.coordinates) >= 3):
+            polygon = Polygon([(c.x, c.y) for c in feature.coordinates])
+            step = sample_step(polygon, cell_size, altitude_samples)
+            feature.altitude = altitude_stats(heights, polygon, cell_size, step)
+
+
+def _window_max(values, radius, axis):
+    """Maximum over a sliding window of 2 * radius + 1 cells along an axis"""
+    result = values.copy()
+    for shift in range(1, radius + 1):
+        forward = [slice(None)] * values.ndim
+        backward = [slice(None)] * values.ndim
+        forward[axis], backward[axis] = slice(shift, None), slice(None, -shift)
+        np.maximum(result[tuple(backward)], values[tuple(forward)], out=result[tuple(backward)])
+        np.maximum(result[tuple(forward)], values[tuple(backward)], out=result[tuple(forward)])
+    return result
+
+
+def _before_max(values, radius, axis):
+    """Maximum over the radius cells before each one along an axis, -inf before the first"""
+    result = np.full_like(values, -np.inf)
+    for shift in range(1, radius + 1):
+        forward = [slice(None)] * values.ndim
+        backward = [slice(None)] * values.ndim
+        forward[axis], backward[axis] = slice(shift, None), slice(None, -shift)
+        np.maximum(result[tuple(forward)], values[tuple(backward)], out=result[tuple(forward)])
+    return result
+
+
+def find_peaks(heights, radius=32, min_height=2000.0, limit=500):
+    """
+    Local maxima standing above min_height, highest first
+
+    A peak is the highest cell within radius cells around it. On a plateau,
+    only the first of the cells as high in that window is one: a peak is
+    strictly higher than the cells before it, in row order. The heightmap is
+    scanned in row blocks overlapping by radius, so it is never loaded whole.
+    """
+    found = []
+    for start in range(0, heights.shape[0], PEAK_BLOCK):
+        top = max(0, start - radius)
+        bottom = min(heights.shape[0], start + PEAK_BLOCK + radius)
+        block = np.asarray(heights[top:bottom], dtype=np.float32)
+        row_max = _window_max(block, radius, 1)
+        local_max = _window_max(row_max, radius, 0)
+        # Rows above within the window, then the cells to the left on the row
+        before = np.maximum(_before_max(row_max, radius, 0), _before_max(block, radius, 1))
+        peaks = (block == local_max) & (block > before) & (block >= min_height)
+        # Only report the rows this block owns, the overlap belongs to its neighbours
+        peaks[:start - top] = False
+        peaks[start - top + PEAK_BLOCK:] = False
+        rows, cols = np.nonzero(peaks)
+        found.extend(zip(block[rows, cols].tolist(), (rows + top).tolist(), cols.tolist()))
+    found.sort(reverse=True)
+    return found[:limit]
+
+
+def place_mountains(heights, cell_size=1.0, radius=32, min_height=2000.0, limit=500):
+    """Mountain elements at the highest peaks of a heightmap"""
+    mountains = []
+    for i, (height, row, col) in enumerate(find_peaks(heights, radius, min_height, limit)):
+        position = map_elements.Coordinates((col + 0.5) * cell_size, (row + 0.5) * cell_size)
+        mountains.append(map_elements.Mountain(
+            f"Peak {i + 1}", [position],
+            map_elements.Altitude(min_height=height, max_height=height, mean_height=height)))
+    return mountains
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a procedural heightmap")
+    parser.add_argument("output", help="Heightmap file (.npy, float32 metres)")
+    parser.add_argument("--size", nargs=2, type=int, default=(4096, 4096),
+                        metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=512.0)
+    parser.add_argument("--erosion", type=int, default=8, help="Erosion iterations")
+    parser.add_argument("--chunk", type=int, default=CHUNK)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--peaks", type=int, default=20, help="Highest peaks to report")
+    args = parser.parse_args()
+
+    params = TerrainParams(seed=args.seed, scale=args.scale, erosion_iterations=args.erosion)
+    start = time.perf_counter()
+    heights = generate_heightmap(args.output, args.size[0], args.size[1], params,
+                                 args.chunk, args.workers)
+    print(f"{args.size[0]}x{args.size[1]} heightmap in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    mountains = place_mountains(heights, limit=args.peaks)
+    print(f"{len(mountains)} peaks found in {time.perf_counter() - start:.2f}s")
+    for mountain in mountains[:5]:
+        print(f"  {mountain.get_description()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QPointF
+from PyQt6.QtGui import (QStaticText, QPixmap, QPainter, QFont, QFontMetricsF,
+                         QColor, QTransform)
+
+from memory_budget import NORMAL, memory_budget, pixmap_bytes, text_bytes
+
+
+class TextCache:
+    """
+    Least recently used cache of shaped and rasterized text
+
+    Shaping a string (font lookup, glyph positioning) costs far more than
+    drawing it. QStaticText keeps the shaped layout, and sprites go further by
+    keeping the rendered pixels, so repainting a known label is a blit.
+
+    Entries are keyed by (text, font, device pixel ratio), plus the colour for
+    sprites, and charged to the memory budget, which may evict them before
+    max_entries is reached.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.account = memory_budget.register("text", self._evict, NORMAL)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key, build, size):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.account.touch(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = build()
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            oldest, _ = self.entries.popitem(last=False)
+            self.account.release(oldest)
+        self.account.charge(key, size(entry))
+        return entry
+
+    def _evict(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.account.clear()
+
+    def static_text(self, text: str, font: QFont, dpr: float = 1.0) -> QStaticText:
+        """Shaped text, to draw with QPainter.drawStaticText"""
+        def build():
+            static = QStaticText(text)
+            static.setTextFormat(Qt.TextFormat.PlainText)
+            static.setPerformanceHint(QStaticText.PerformanceHint.AggressiveCaching)
+            static.prepare(QTransform(), font)
+            return static
+        return self._get(("static", text, font.key(), dpr), build, lambda _: text_bytes(text))
+
+    def sprite(self, text: str, font: QFont, color=Qt.GlobalColor.black,
+               dpr: float = 1.0) -> QPixmap:
+        """Text rendered once into a transparent pixmap at the device resolution"""
+        color = QColor(color)
+
+        def build():
+            metrics = QFontMetricsF(font)
+            width = max(1, int(metrics.horizontalAdvance(text) * dpr) + 2)
+            height = max(1, int(metrics.height() * dpr) + 2)
+            pixmap = QPixmap(width, height)
+            pixmap.setDevicePixelRatio(dpr)
+            pixmap.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.RenderHint.TextAntialiasing)
+            painter.setFont(font)
+            painter.setPen(color)
+            painter.drawText(QPointF(0, metrics.ascent()), text)
+            painter.end()
+            return pixmap
+        return self._get(("sprite", text, font.key(), color.rgba(), dpr), build, pixmap_bytes)
+
+    def draw_text(self, painter: QPainter, top_left: QPointF, text: str, font: QFont,
+                  color=Qt.GlobalColor.black):
+        """Blit a text sprite, top_left in the painter's current coordinates"""
+        dpr = painter.device().devicePixelRatioF()
+        # Whole pixels keep the blit a plain copy instead of a resampling
+        painter.drawPixmap(QPointF(round(top_left.x()), round(top_left.y())),
+                           self.sprite(text, font, color, dpr))
+
+
+# Shared by every label and text widget of the application
+text_cache = TextCache()
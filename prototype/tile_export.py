@@ -0,0 +1,195 @@
+"""
+Headless export of a map to image tiles
+
+Tiles follow the usual z/x/y layout: at zoom z one scene unit is 2**z pixels,
+so tile (x, y) covers the scene square starting at (x, y) * tile_size / 2**z.
+
+    python tile_export.py map.json tiles --region 0 0 2000 1000 --zoom 0 4
+"""
+import argparse
+import atexit
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+from map_document import load_map
+from spatial_index import GridIndex
+
+# Qt must be told to run without a display before it is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtGui import (QGuiApplication, QImage, QPainter, QPen, QColor,
+                         QPolygonF, QFont, QBrush)
+from PyQt6.QtCore import Qt, QPointF
+
+from label_placement import LabelPlacer, paint_labels
+import instrumentation
+
+
+class TileRenderer:
+    """Paints tiles of a map document with an offscreen QPainter"""
+
+    def __init__(self, document, tile_size=256, background=Qt.GlobalColor.white):
+        self.document = document
+        self.tile_size = tile_size
+        self.background = QColor(background)
+        self.raster = QImage(document.raster.path) if document.raster else None
+        # Placement is global to each zoom, so labels agree across tile borders
+        self.labels = LabelPlacer(document.elements, QFont("Sans", 9))
+
+        # Index everything once so each tile only looks at what it covers
+        self.stroke_index = GridIndex()
+        self.stroke_index.update((i, s.bbox()) for i, s in enumerate(self.document.strokes))
+        self.figure_index = GridIndex()
+        self.figure_index.update((i, f.bbox()) for i, f in enumerate(self.document.figures))
+
+    def tile_rect(self, z, x, y):
+        """Scene rectangle covered by a tile"""
+        span = self.tile_size / 2 ** z
+        return (x * span, y * span, (x + 1) * span, (y + 1) * span)
+
+    def render_tile(self, z, x, y) -> QImage:
+        image = QImage(self.tile_size, self.tile_size,
+                       QImage.Format.Format_ARGB32_Premultiplied)
+        image.fill(self.background)
+
+        rect = self.tile_rect(z, x, y)
+        scale = 2 ** z
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.scale(scale, scale)
+        painter.translate(-rect[0], -rect[1])
+
+        if self.raster is not None:
+            raster = self.document.raster
+            painter.drawImage(QPointF(raster.x, raster.y), self.raster)
+
+        # Figures first, strokes over them
+        for i in sorted(self.figure_index.query(rect)):
+            figure = self.document.figures[i]
+            polygon = QPolygonF([QPointF(px, py) for px, py in figure.points])
+            painter.setPen(QPen(QColor(figure.color), figure.width))
+            if figure.is_closed:
+                painter.setBrush(QBrush(QColor(figure.fill)) if figure.fill
+                                 else Qt.BrushStyle.NoBrush)
+                painter.drawPolygon(polygon)
+            else:
+                painter.drawPolyline(polygon)
+
+        for i in sorted(self.stroke_index.query(rect)):
+            stroke = self.document.strokes[i]
+            painter.setPen(QPen(QColor(stroke.color), stroke.width, Qt.PenStyle.SolidLine,
+                                Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin))
+            painter.drawPolyline(QPolygonF([QPointF(px, py) for px, py in stroke.points]))
+
+        # Labels starting in a neighbouring tile may still overlap this one
+        margin = self.labels.margin() / scale
+        paint_labels(painter, self.labels, scale,
+                     (rect[0] - margin, rect[1] - margin, rect[2] + margin, rect[3] + margin))
+        painter.end()
+        return image
+
+
+def tiles_for_region(region, zoom, tile_size):
+    """All (z, x, y) tiles covering a scene region (x, y, width, height)"""
+    x, y, width, height = region
+    span = tile_size / 2 ** zoom
+    for ty in range(math.floor(y / span), math.ceil((y + height) / span)):
+        for tx in range(math.floor(x / span), math.ceil((x + width) / span)):
+            yield (zoom, tx, ty)
+
+
+# Per-process state, set up once by the pool initializer
+_app = None
+_renderer = None
+
+
+def _init_worker(map_path, tile_size):
+    global _app, _renderer
+    _app = QGuiApplication.instance() or QGuiApplication([sys.argv[0]])
+    _renderer = TileRenderer(load_map(map_path), tile_size)
+
+    # With MAP_PROFILE=trace.json each worker writes trace.json.<pid>
+    trace_path = os.environ.get("MAP_PROFILE")
+    if trace_path:
+        instrumentation.profiler.enabled = True
+        instrumentation.instrument_class(TileRenderer)
+        atexit.register(instrumentation.profiler.dump, f"{trace_path}.{os.getpid()}")
+
+
+def _render_batch(tiles, output_dir, image_format):
+    written = 0
+    for z, x, y in tiles:
+        directory = os.path.join(output_dir, str(z), str(x))
+        os.makedirs(directory, exist_ok=True)
+        image = _renderer.render_tile(z, x, y)
+        if image.save(os.path.join(directory, f"{y}.{image_format}"), image_format.upper()):
+            written += 1
+    return written
+
+
+def export_tiles(map_path, output_dir, region, min_zoom, max_zoom,
+                 tile_size=256, image_format="png", workers=None, batch_size=64, progress=None):
+    """
+    Render every tile of a region for a range of zooms, in parallel
+
+    :param region: Scene rectangle (x, y, width, height) to export
+    :param workers: Number of processes, all cores by default
+    :param progress: Called with the number of tiles rendered so far and the total,
+                     after each batch
+    :return: Number of tiles written
+    """
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        tiles.extend(tiles_for_region(region, zoom, tile_size))
+    batches = [tiles[i:i + batch_size] for i in range(0, len(tiles), batch_size)]
+
+    # Qt does not survive fork(), every worker starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(map_path, tile_size)) as pool:
+        futures = {pool.submit(_render_batch, batch, output_dir, image_format): len(batch)
+                   for batch in batches}
+        done = 0
+        for future in as_completed(futures):
+            written += future.result()
+            done += futures[future]
+            if progress is not None:
+                progress(done, len(tiles))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a map to image tiles")
+    parser.add_argument("map", help="Map document (JSON)")
+    parser.add_argument("output", help="Directory receiving z/x/y tiles")
+    parser.add_argument("--region", nargs=4, type=float, required=True,
+                        metavar=("X", "Y", "WIDTH", "HEIGHT"),
+                        help="Scene rectangle to export")
+    parser.add_argument("--zoom", nargs=2, type=int, default=(0, 0),
+                        metavar=("MIN", "MAX"))
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--format", choices=("png", "webp"), default="png")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.format == "webp":
+        # Checked here because workers would otherwise fail on every tile
+        app = QGuiApplication.instance() or QGuiApplication(sys.argv)
+        from PyQt6.QtGui import QImageWriter
+        if b"webp" not in [bytes(f) for f in QImageWriter.supportedImageFormats()]:
+            parser.error("this Qt build cannot write WebP images")
+
+    start = time.perf_counter()
+    written = export_tiles(args.map, args.output, args.region, args.zoom[0], args.zoom[1],
+                           args.tile_size, args.format, args.workers)
+    print(f"{written} tiles written in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import sys
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Set, Tuple
+
+import numpy as np
+
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsScene, QGraphicsView,
+                             QGraphicsPathItem, QGraphicsEllipseItem)
+from PyQt6.QtCore import Qt, QPointF
+from PyQt6.QtGui import QPen, QColor, QBrush, QPainter, QPainterPath
+
+from polygon_geometry import Polygon
+
+
+@dataclass
+class Arc:
+    """Border between two nodes, shared by every polygon running along it"""
+    start: int
+    end: int
+    points: np.ndarray  # Interior vertices, shape (n, 2)
+
+
+class Topology:
+    """
+    Polygons made of shared arcs
+
+    A border between two regions is stored once, as an arc, and each polygon
+    only keeps a list of (arc id, reversed) references. Arc ends are nodes,
+    also shared, so moving a junction moves it in every arc and polygon.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[int, np.ndarray] = {}
+        self.arcs: Dict[int, Arc] = {}
+        self.rings: Dict[Hashable, List[Tuple[int, bool]]] = {}
+        self.arc_users: Dict[int, Set[Hashable]] = {}
+        self.node_arcs: Dict[int, Set[int]] = {}
+        self._polygons: Dict[Hashable, Polygon] = {}
+
+    @classmethod
+    def from_rings(cls, rings: Dict[Hashable, list], tolerance: float = 1e-6):
+        """
+        Build a topology from independent outlines
+
+        Vertices closer than tolerance are merged, then every run of edges used
+        by the same set of outlines becomes a single arc.
+
+        :param rings: Outline points of each polygon, keyed by anything hashable
+        """
+        topology = cls()
+
+        # Snap vertices so that shared borders use the very same keys
+        keyed = {}
+        positions = {}
+        for key, points in rings.items():
+            vertices = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            if len(vertices) > 1 and np.array_equal(vertices[0], vertices[-1]):
+                vertices = vertices[:-1]
+            snapped = [tuple(v) for v in np.round(vertices / tolerance).astype(np.int64)]
+            # Drop repeated vertices, they would create empty edges
+            ring = [v for i, v in enumerate(snapped) if v != snapped[i - 1]]
+            keyed[key] = ring
+            for vertex, position in zip(snapped, vertices):
+                positions.setdefault(vertex, position)
+
+        # Which outlines use each undirected edge
+        edge_owners = {}
+        for key, ring in keyed.items():
+            for i in range(len(ring)):
+                edge = frozenset((ring[i], ring[(i + 1) % len(ring)]))
+                edge_owners.setdefault(edge, set()).add(key)
+
+        # A junction is a vertex where the owners of consecutive edges change
+        neighbours = {}
+        for edge in edge_owners:
+            a, b = tuple(edge)
+            neighbours.setdefault(a, set()).add(b)
+            neighbours.setdefault(b, set()).add(a)
+        junctions = set()
+        for key, ring in keyed.items():
+            for i, vertex in enumerate(ring):
+                before = frozenset((ring[i - 1], vertex))
+                after = frozenset((vertex, ring[(i + 1) % len(ring)]))
+                if len(neighbours[vertex]) > 2 or edge_owners[before] != edge_owners[after]:
+                    junctions.add(vertex)
+
+        node_ids = {}
+        arc_ids = {}
+
+        def node(vertex):
+            if vertex not in node_ids:
+                node_ids[vertex] = topology._add_node(positions[vertex])
+            return node_ids[vertex]
+
+        for key, ring in keyed.items():
+            starts = [i for i, v in enumerate(ring) if v in junctions]
+            if not starts:
+                # Island: one closed arc starting and ending at its first vertex
+                starts = [0]
+                junctions.add(ring[0])
+            # Rotate so the ring begins at a junction, then cut it at each one
+            first = starts[0]
+            ring = ring[first:] + ring[:first]
+            cuts = [i - first for i in starts] + [len(ring)]
+            refs = []
+            for a, b in zip(cuts, cuts[1:]):
+                chain = tuple(ring[a:b + 1]) if b < len(ring) else tuple(ring[a:]) + (ring[0],)
+                reverse = chain[::-1]
+                if chain in arc_ids:
+                    refs.append((arc_ids[chain], False))
+                elif reverse in arc_ids:
+                    refs.append((arc_ids[reverse], True))
+                else:
+                    interior = np.array([positions[v] for v in chain[1:-1]]).reshape(-1, 2)
+                    arc_id = topology._add_arc(node(chain[0]), node(chain[-1]), interior)
+                    arc_ids[chain] = arc_id
+                    refs.append((arc_id, False))
+            topology.add_polygon(key, refs)
+        return topology
+
+    def _add_node(self, position) -> int:
+        node_id = len(self.nodes)
+        self.nodes[node_id] = np.array(position, dtype=np.float64)
+        self.node_arcs[node_id] = set()
+        return node_id
+
+    def _add_arc(self, start: int, end: int, points: np.ndarray) -> int:
+        arc_id = len(self.arcs)
+        self.arcs[arc_id] = Arc(start, end, points)
+        self.arc_users[arc_id] = set()
+        self.node_arcs[start].add(arc_id)
+        self.node_arcs[end].add(arc_id)
+        return arc_id
+
+    def add_polygon(self, key: Hashable, refs: List[Tuple[int, bool]]):
+        self.rings[key] = refs
+        for arc_id, _ in refs:
+            self.arc_users[arc_id].add(key)
+        self._polygons.pop(key, None)
+
+    def arc_points(self, arc_id: int) -> np.ndarray:
+        """Every vertex of an arc, ends included"""
+        arc = self.arcs[arc_id]
+        return np.vstack((self.nodes[arc.start], arc.points, self.nodes[arc.end]))
+
+    def ring(self, key: Hashable) -> np.ndarray:
+        """Outline of a polygon assembled from its arcs"""
+        parts = []
+        for arc_id, reverse in self.rings[key]:
+            points = self.arc_points(arc_id)
+            if reverse:
+                points = points[::-1]
+            # The last point of an arc is the first of the next one
+            parts.append(points[:-1])
+        return np.vstack(parts)
+
+    def polygon(self, key: Hashable) -> Polygon:
+        """Polygon of a region, cached until one of its arcs changes"""
+        if key not in self._polygons:
+            self._polygons[key] = Polygon(self.ring(key))
+        return self._polygons[key]
+
+    def vertex_count(self) -> int:
+        """Stored vertices: each shared border counts once"""
+        return len(self.nodes) + sum(len(arc.points) for arc in self.arcs.values())
+
+    def _touch_arcs(self, arc_ids) -> Set[Hashable]:
+        users = set()
+        for arc_id in arc_ids:
+            users |= self.arc_users[arc_id]
+        for key in users:
+            self._polygons.pop(key, None)
+        return users
+
+    def move_node(self, node_id: int, position) -> Tuple[Set[int], Set[Hashable]]:
+        """
+        Move a junction, in every arc and polygon using it
+
+        :return: Changed arcs and changed polygons
+        """
+        self.nodes[node_id] = np.array(position, dtype=np.float64)
+        arcs = set(self.node_arcs[node_id])
+        return arcs, self._touch_arcs(arcs)
+
+    def move_arc_point(self, arc_id: int, index: int, position):
+        """Move an interior vertex of an arc, see move_node"""
+        self.arcs[arc_id].points[index] = position
+        return {arc_id}, self._touch_arcs([arc_id])
+
+    def insert_arc_point(self, arc_id: int, index: int, position):
+        """Insert an interior vertex in an arc, see move_node"""
+        arc = self.arcs[arc_id]
+        arc.points = np.insert(arc.points, index, position, axis=0)
+        return {arc_id}, self._touch_arcs([arc_id])
+
+
+def arc_path(topology: Topology, arc_id: int) -> QPainterPath:
+    points = topology.arc_points(arc_id)
+    path = QPainterPath()
+    path.moveTo(QPointF(*points[0]))
+    for x, y in points[1:]:
+        path.lineTo(x, y)
+    return path
+
+
+def ring_path(topology: Topology, key: Hashable) -> QPainterPath:
+    path = QPainterPath()
+    points = topology.ring(key)
+    path.moveTo(QPointF(*points[0]))
+    for x, y in points[1:]:
+        path.lineTo(x, y)
+    path.closeSubpath()
+    return path
+
+
+class TopologyItems:
+    """
+    Scene items for a topology: one stroked item per arc, one filled item per
+    polygon. Borders are drawn once whatever the number of regions sharing them.
+    """
+
+    def __init__(self, scene: QGraphicsScene, topology: Topology,
+                 pen=QPen(Qt.GlobalColor.black, 2), fills=None):
+        self.topology = topology
+        self.fill_items = {}
+        self.arc_items = {}
+        fills = fills or {}
+        for key in topology.rings:
+            item = QGraphicsPathItem(ring_path(topology, key))
+            item.setPen(QPen(Qt.PenStyle.NoPen))
+            item.setBrush(QBrush(fills.get(key, QColor(200, 200, 200, 120))))
+            scene.addItem(item)
+            self.fill_items[key] = item
+        for arc_id in topology.arcs:
+            item = QGraphicsPathItem(arc_path(topology, arc_id))
+            item.setPen(pen)
+            item.setZValue(1)
+            scene.addItem(item)
+            self.arc_items[arc_id] = item
+
+    def refresh(self, arcs, polygons):
+        """Rebuild only the items touched by an edit"""
+        for arc_id in arcs:
+            self.arc_items[arc_id].setPath(arc_path(self.topology, arc_id))
+        for key in polygons:
+            self.fill_items[key].setPath(ring_path(self.topology, key))
+
+
+class NodeHandle(QGraphicsEllipseItem):
+    """Draggable junction: moving it moves every border meeting there"""
+
+    def __init__(self, items: TopologyItems, node_id: int):
+        super().__init__(-4, -4, 8, 8)
+        self.items = items
+        self.node_id = node_id
+        self.setPos(QPointF(*items.topology.nodes[node_id]))
+        self.setBrush(Qt.GlobalColor.blue)
+        self.setZValue(2)
+        self.setFlags(self.GraphicsItemFlag.ItemIsMovable |
+                      self.GraphicsItemFlag.ItemSendsGeometryChanges)
+
+    def itemChange(self, change, value):
+        if change == self.GraphicsItemChange.ItemPositionHasChanged:
+            arcs, polygons = self.items.topology.move_node(self.node_id, (value.x(), value.y()))
+            self.items.refresh(arcs, polygons)
+        return super().itemChange(change, value)
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Shared Borders")
+        self.setGeometry(100, 100, 800, 600)
+
+        # Three countries, each outline written independently
+        rings = {
+            "west": [(0, 0), (200, 0), (200, 200), (0, 200)],
+            "east": [(200, 0), (400, 0), (400, 200), (200, 200)],
+            "south": [(0, 200), (200, 200), (400, 200), (400, 350), (0, 350)],
+        }
+        self.topology = Topology.from_rings(rings)
+        stored = sum(len(r) for r in rings.values())
+        print(f"{stored} vertices in outlines, {self.topology.vertex_count()} in topology, "
+              f"{len(self.topology.arcs)} arcs")
+
+        scene = QGraphicsScene()
+        fills = {"west": QColor(220, 120, 120, 120), "east": QColor(120, 120, 220, 120),
+                 "south": QColor(120, 220, 120, 120)}
+        self.items = TopologyItems(scene, self.topology, fills=fills)
+        for node_id in self.topology.nodes:
+            scene.addItem(NodeHandle(self.items, node_id))
+
+        view = QGraphicsView(scene)
+        view.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.setCentralWidget(view)
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec())
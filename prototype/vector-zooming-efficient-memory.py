@@ -5,9 +5,15 @@ from typing import List, Tuple
 
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QGraphicsView,
                            QGraphicsScene, QVBoxLayout, QWidget, QToolBar,
-                           QColorDialog)
+                           QColorDialog, QGraphicsLineItem)
 from PyQt6.QtGui import QPainter, QPen, QColor, QAction
-from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtCore import Qt, QPointF
+
+from gl_viewport import viewport_from_env
+from instrumentation import install_from_env
+from layers import LayerStack
+from spatial_index import BBox
+from stroke_batch import StrokeBatchItem
 
 @dataclass
 class VectorLine:
@@ -16,6 +22,14 @@ class VectorLine:
     end: QPointF
     color: QColor
     width: float = 2.0
+    # (min_x, min_y, max_x, max_y) with half the width around, lines don't change once drawn
+    bbox: BBox = field(init=False, repr=False)
+
+    def __post_init__(self):
+        padding = self.width / 2
+        x0, x1 = sorted((self.start.x(), self.end.x()))
+        y0, y1 = sorted((self.start.y(), self.end.y()))
+        self.bbox = (x0 - padding, y0 - padding, x1 + padding, y1 + padding)
 
 class DrawingCanvas(QGraphicsView):
     def __init__(self):
@@ -25,6 +39,13 @@ class DrawingCanvas(QGraphicsView):
         self.scene = QGraphicsScene()
         self.scene.setBackgroundBrush(Qt.GlobalColor.white)
         self.setScene(self.scene)
+
+        # Every stroke is painted by one batch item, the preview is drawn over them
+        self.layers = LayerStack(self.scene)
+        self.stroke_batch = StrokeBatchItem()
+        self.layers.add_layer("Strokes").add_item(self.stroke_batch, key="batch")
+        self.layers.add_layer("Preview")
+        self.batched_lines = 0
         
         # Enable antialiasing for smoother drawing
         self.setRenderHint(QPainter.RenderHint.Antialiasing)
@@ -57,58 +78,30 @@ class DrawingCanvas(QGraphicsView):
     def clear_preview(self):
         """Clear any existing preview line"""
         if self.preview_line:
-            self.scene.removeItem(self.preview_line)
+            self.layers["Preview"].clear()
             self.preview_line = None
 
-    def is_line_visible(self, line: VectorLine, viewport_rect: QRectF) -> bool:
+    def render_lines(self):
         """
-        Check if the line is within or intersects the visible viewport
+        Render only lines within the visible viewport
 
-        Uses a simple bounding box check with a small padding for line width
+        Lines are handed once to the stroke batch, which culls them against
+        the exposed area itself on every paint.
         """
-        # Create a bounding rect for the line with padding
-        padding = line.width  # Add some padding for line width
-        line_rect = QRectF(
-            min(line.start.x(), line.end.x()) - padding,
-            min(line.start.y(), line.end.y()) - padding,
-            abs(line.end.x() - line.start.x()) + 2 * padding,
-            abs(line.end.y() - line.start.y()) + 2 * padding
-        )
-
-        # Check if line rect intersects with viewport
-        return line_rect.intersects(viewport_rect)
-
-    def render_lines(self):
-        """Render only lines within the visible viewport"""
-        # Clear the scene first
-        self.scene.clear()
-
-        # Get the current viewport rect in scene coordinates
-        viewport_rect = self.mapToScene(self.viewport().rect()).boundingRect()
-
-        # Re-add only visible vector lines
-        for line in self.vector_lines:
-            if self.is_line_visible(line, viewport_rect):
-                pen = QPen(line.color, line.width, Qt.PenStyle.SolidLine)
-                self.scene.addLine(
-                    line.start.x(), line.start.y(),
-                    line.end.x(), line.end.y(),
-                    pen
-                )
-
-    def render_lines_deprecated(self):
-        """Render all stored vector lines"""
-        # Clear the scene first
-        self.scene.clear()
-        
-        # Re-add all vector lines
-        for line in self.vector_lines:
-            pen = QPen(line.color, line.width, Qt.PenStyle.SolidLine)
-            self.scene.addLine(
-                line.start.x(), line.start.y(),
-                line.end.x(), line.end.y(),
-                pen
-            )
+        if len(self.vector_lines) < self.batched_lines:
+            # The list was replaced, start over
+            self.stroke_batch.clear()
+            self.batched_lines = 0
+
+        if self.batched_lines == len(self.vector_lines):
+            # Zooming and resizing need nothing from the batch
+            return
+        for key in range(self.batched_lines, len(self.vector_lines)):
+            line = self.vector_lines[key]
+            self.stroke_batch.add_stroke((line.start, line.end), line.color, line.width,
+                                         key=key, bbox=line.bbox)
+        self.batched_lines = len(self.vector_lines)
+        self.layers["Strokes"].reindex("batch")
 
     def mousePressEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
@@ -146,13 +139,14 @@ class DrawingCanvas(QGraphicsView):
             
             # Draw preview line
             preview_pen = QPen(self.current_color, self.current_pen_width, Qt.PenStyle.SolidLine)
-            self.preview_line = self.scene.addLine(
+            self.preview_line = QGraphicsLineItem(
                 self.last_point.x(),
                 self.last_point.y(),
                 current_point.x(),
-                current_point.y(),
-                preview_pen
+                current_point.y()
             )
+            self.preview_line.setPen(preview_pen)
+            self.layers["Preview"].add_item(self.preview_line)
 
     def wheelEvent(self, event):
         """Handle zooming"""
@@ -206,6 +200,8 @@ class DrawingWindow(QMainWindow):
 def main():
     app = QApplication(sys.argv)
     window = DrawingWindow()
+    viewport_from_env(window.canvas)
+    install_from_env(window.canvas)
     window.show()
     sys.exit(app.exec())
 